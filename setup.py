@@ -13,6 +13,7 @@ https://github.com/schipholgroup/takeoff-base
 """
 setup_dependencies = [
     "azure==4.0.0",
+    "cryptography>=1.1.0",
     "databricks-cli==0.9.0",
     "docker==4.0.2",
     "flake8==3.7.2",
@@ -1,7 +1,9 @@
+import functools
 import logging
 import pprint
+import threading
 from dataclasses import dataclass
-from typing import List, Set
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
 
 import voluptuous as vol
 from azure.mgmt.eventhub import EventHubManagementClient
@@ -18,9 +20,12 @@ from takeoff.context import Context, ContextKey
 from takeoff.credentials.secret import Secret
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
+from takeoff.util import Lazy, run_concurrently
 
 logger = logging.getLogger(__name__)
 
+MAX_CONCURRENT_EVENTHUB_REQUESTS = 8
+
 SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
     {
         vol.Required("task"): "configure_eventhub",
@@ -84,6 +89,80 @@ class ConnectingString(object):
     connection_string: str
 
 
+class EventHubTopology(object):
+    """In-memory snapshot of the event hubs in a namespace, with their consumer groups and authorization rules
+
+    Every listing is requested from Azure only once, after which existence checks are answered from memory.
+    Resources created by Takeoff are added to the snapshot, so it stays accurate throughout the step.
+    """
+
+    def __init__(self, client: EventHubManagementClient, resource_group: str, namespace: str):
+        self.client = client
+        self.resource_group = resource_group
+        self.namespace = namespace
+        self._lock = threading.RLock()
+        self._hubs: Optional[Set[str]] = None
+        self._consumer_groups: Dict[str, Set[str]] = {}
+        self._authorization_rules: Dict[str, Set[str]] = {}
+
+    def prefetch(self, hubs: Iterable[str]):
+        """Lists the consumer groups and authorization rules of the given hubs concurrently
+
+        Args:
+            hubs: Names of the EventHub entities to fetch. Entities that do not exist are ignored.
+        """
+        tasks = {}
+        for hub in sorted(set(hubs) & self.hubs()):
+            tasks[f"list consumer groups of {hub}"] = functools.partial(self.consumer_groups, hub)
+            tasks[f"list authorization rules of {hub}"] = functools.partial(self.authorization_rules, hub)
+        run_concurrently(tasks, max_workers=MAX_CONCURRENT_EVENTHUB_REQUESTS)
+
+    def hubs(self) -> Set[str]:
+        """Returns the names of all EventHub entities in the namespace"""
+        with self._lock:
+            if self._hubs is None:
+                self._hubs = {
+                    _.name
+                    for _ in self.client.event_hubs.list_by_namespace(self.resource_group, self.namespace)
+                }
+            return self._hubs
+
+    def consumer_groups(self, hub: str) -> Set[str]:
+        """Returns the names of all consumer groups of the given EventHub entity"""
+        return self._cached(
+            self._consumer_groups,
+            hub,
+            lambda: self.client.consumer_groups.list_by_event_hub(self.resource_group, self.namespace, hub),
+        )
+
+    def authorization_rules(self, hub: str) -> Set[str]:
+        """Returns the names of all authorization rules of the given EventHub entity"""
+        return self._cached(
+            self._authorization_rules,
+            hub,
+            lambda: self.client.event_hubs.list_authorization_rules(self.resource_group, self.namespace, hub),
+        )
+
+    def add_consumer_group(self, hub: str, name: str):
+        with self._lock:
+            self.consumer_groups(hub).add(name)
+
+    def add_authorization_rule(self, hub: str, name: str):
+        with self._lock:
+            self.authorization_rules(hub).add(name)
+
+    def _cached(
+        self, cache: Dict[str, Set[str]], hub: str, list_resources: Callable[[], Iterable]
+    ) -> Set[str]:
+        # The listing itself happens outside of the lock, so different hubs can be fetched concurrently
+        with self._lock:
+            if hub in cache:
+                return cache[hub]
+        names = {_.name for _ in list_resources()}
+        with self._lock:
+            return cache.setdefault(hub, names)
+
+
 class ConfigureEventHub(Step):
     """Configures EventHub
 
@@ -97,15 +176,49 @@ class ConfigureEventHub(Step):
         super().__init__(env, config)
         self.vault_name, self.vault_client = KeyVaultClient.vault_and_client(self.config, self.env)
         self.eventhub_client = self._get_eventhub_client()
+        self._topologies: Dict[Tuple[str, str], EventHubTopology] = {}
+        self._topologies_lock = threading.Lock()
+        self._databricks_secrets: Dict[str, Secret] = {}
+        self._databricks_secrets_lock = threading.Lock()
+        self._connection_strings: Dict[Tuple[str, str, str], Lazy] = {}
+        self._connection_strings_lock = threading.Lock()
 
     def schema(self) -> vol.Schema:
         return SCHEMA
 
     def run(self):
+        self._prefetch_topology()
         if "create_consumer_groups" in self.config:
             self._setup_consumer_groups()
         if "create_producer_policies" in self.config:
             self._setup_producer_policies()
+        self.create_databricks_secrets(list(self._databricks_secrets.values()))
+
+    def _prefetch_topology(self):
+        """Fetches the state of all EventHub entities used by this step in one go"""
+        entities = self.config.get("create_consumer_groups", []) + self.config.get(
+            "create_producer_policies", []
+        )
+        hubs = [get_eventhub_entity_name(_["eventhub_entity_naming"], self.env) for _ in entities]
+        self._topology(
+            get_resource_group_name(self.config, self.env), get_eventhub_name(self.config, self.env)
+        ).prefetch(hubs)
+
+    def _topology(self, resource_group: str, namespace: str) -> EventHubTopology:
+        """Returns the snapshot of the given EventHub namespace, shared for the duration of the step
+
+        Args:
+            resource_group: The name of the resource group
+            namespace: The name of the EventHub namespace
+
+        Returns:
+            The topology of the namespace
+        """
+        with self._topologies_lock:
+            key = (resource_group, namespace)
+            if key not in self._topologies:
+                self._topologies[key] = EventHubTopology(self.eventhub_client, resource_group, namespace)
+            return self._topologies[key]
 
     def _setup_consumer_groups(self):
         """Constructs consumer groups for all EventHub entities requested."""
@@ -145,10 +258,18 @@ class ConfigureEventHub(Step):
         logger.info(f"Using Azure resource group: {resource_group}")
         logger.info(f"Using Azure EventHub namespace: {eventhub_namespace}")
 
-        secrets = [
-            self._create_producer_policy(policy, resource_group, eventhub_namespace, self.application_name)
-            for policy in producer_policies
-        ]
+        secrets = self._provision_concurrently(
+            {
+                f"producer policy on {policy.eventhub_entity_name} #{i}": functools.partial(
+                    self._create_producer_policy,
+                    policy,
+                    resource_group,
+                    eventhub_namespace,
+                    self.application_name,
+                )
+                for i, policy in enumerate(producer_policies)
+            }
+        )
         Context().create_or_update(ContextKey.EVENTHUB_PRODUCER_POLICY_SECRETS, secrets)
 
     def _create_producer_policy(
@@ -179,6 +300,9 @@ class ConfigureEventHub(Step):
             self.eventhub_client.event_hubs.create_or_update_authorization_rule(
                 **common_azure_parameters, rights=[AccessRights.send]
             )
+            self._topology(resource_group, eventhub_namespace).add_authorization_rule(
+                common_azure_parameters["event_hub_name"], common_azure_parameters["authorization_rule_name"]
+            )
             connection_string = self.eventhub_client.event_hubs.list_keys(
                 **common_azure_parameters
             ).primary_connection_string
@@ -188,7 +312,7 @@ class ConfigureEventHub(Step):
 
         secret = Secret(f"{policy.eventhub_entity_name}-connection-string", connection_string)
         if policy.create_databricks_secret:
-            self.create_databricks_secrets([secret])
+            self._queue_databricks_secret(secret)
         return secret
 
     def _eventhub_exists(self, group: EventHubConsumerGroup) -> bool:
@@ -200,12 +324,8 @@ class ConfigureEventHub(Step):
         Returns:
             True if the entity exists, otherwise False
         """
-        hubs = list(
-            self.eventhub_client.event_hubs.list_by_namespace(
-                group.eventhub.resource_group, group.eventhub.namespace
-            )
-        )
-        if group.eventhub.name in set(_.name for _ in hubs):
+        hubs = self._topology(group.eventhub.resource_group, group.eventhub.namespace).hubs()
+        if group.eventhub.name in hubs:
             return True
         raise ValueError(
             f"EventHub with name {group.eventhub.name} does not exist. " f"Please create it first"
@@ -219,13 +339,8 @@ class ConfigureEventHub(Step):
         Returns:
             True if the consumer group exists, otherwise False
         """
-        consumer_groups = list(
-            self.eventhub_client.consumer_groups.list_by_event_hub(
-                group.eventhub.resource_group, group.eventhub.namespace, group.eventhub.name
-            )
-        )
-
-        if group.consumer_group in set(_.name for _ in consumer_groups):
+        topology = self._topology(group.eventhub.resource_group, group.eventhub.namespace)
+        if group.consumer_group in topology.consumer_groups(group.eventhub.name):
             logging.warning(
                 f"Consumer group with name {group.consumer_group} in hub {group.eventhub.name}"
                 " already exists, not creating."
@@ -243,28 +358,32 @@ class ConfigureEventHub(Step):
         Returns:
             True if the authorization rule exists, otherwise False
         """
-        logging.info(
-            f"Retrieving rules, Resource Group {hub.resource_group}, "
-            f"EventHub Namespace {hub.namespace}, "
-            f"EventHub Entity: {hub.name}"
-        )
-        existing_policies = list(
-            self.eventhub_client.event_hubs.list_authorization_rules(
-                hub.resource_group, hub.namespace, hub.name
-            )
-        )
-        if name in set(_.name for _ in existing_policies):
+        existing_policies = self._topology(hub.resource_group, hub.namespace).authorization_rules(hub.name)
+        if name in existing_policies:
             print(f"Authorization rule with name {name} in hub {hub.name}" " already exists, not creating.")
             return True
         return False
 
+    def _queue_databricks_secret(self, secret: Secret):
+        """Registers a secret to be created in Databricks at the end of the step
+
+        When the same key is queued more than once, the last value wins.
+
+        Args:
+            secret: The secret to create
+        """
+        with self._databricks_secrets_lock:
+            self._databricks_secrets[secret.key] = secret
+
     def create_databricks_secrets(self, secrets: List[Secret]):
-        """Creates a Databricks secret from the provided secrets
+        """Creates a Databricks secret from the provided secrets, using a single Databricks client
 
         Args:
             secrets: A list of secrets
-            application_name: The name of this application
         """
+        if not secrets:
+            return
+        logger.info(f"Creating {len(secrets)} Databricks secret(s) in scope {self.application_name}")
         databricks_secrets = CreateDatabricksSecretFromValue(self.env, self.config)
         databricks_secrets._create_scope(self.application_name)
         databricks_secrets._add_secrets(self.application_name, secrets)
@@ -277,13 +396,17 @@ class ConfigureEventHub(Step):
             group: Object containing names of EventHub namespace and entity
         """
         try:
-            logger.info(f"Creating consumer group {group}")
-            self.eventhub_client.consumer_groups.create_or_update(
-                group.eventhub.resource_group,
-                group.eventhub.namespace,
-                group.eventhub.name,
-                group.consumer_group,
-            )
+            if not self._group_exists(group):
+                logger.info(f"Creating consumer group {group}")
+                self.eventhub_client.consumer_groups.create_or_update(
+                    group.eventhub.resource_group,
+                    group.eventhub.namespace,
+                    group.eventhub.name,
+                    group.consumer_group,
+                )
+                self._topology(group.eventhub.resource_group, group.eventhub.namespace).add_consumer_group(
+                    group.eventhub.name, group.consumer_group
+                )
             connection_string = self._create_connection_string(group.eventhub)
         except CloudError as e:
             logger.error("Something went wrong during creating consumer group")
@@ -292,13 +415,16 @@ class ConfigureEventHub(Step):
         secret = Secret(f"{group.eventhub.name}-connection-string", connection_string.connection_string)
 
         if group.create_databricks_secret:
-            self.create_databricks_secrets([secret])
+            self._queue_databricks_secret(secret)
 
         return secret
 
     def _create_connection_string(self, eventhub_entity: EventHub) -> ConnectingString:
         """Creates connections strings for all given EventHub entities.
 
+        The listen policy of each EventHub entity is resolved once per run, also when multiple
+        consumer groups of the same entity are created concurrently.
+
         Args:
             eventhub_entity: Object containing EventHub metadata
 
@@ -306,7 +432,24 @@ class ConfigureEventHub(Step):
             Connection string
         """
         policy_name = f"{self.application_name}-policy"
+        key = (eventhub_entity.namespace, eventhub_entity.name, policy_name)
+        with self._connection_strings_lock:
+            if key not in self._connection_strings:
+                self._connection_strings[key] = Lazy(
+                    functools.partial(self._resolve_connection_string, eventhub_entity, policy_name)
+                )
+        return self._connection_strings[key].get()
+
+    def _resolve_connection_string(self, eventhub_entity: EventHub, policy_name: str) -> ConnectingString:
+        """Creates the listen policy on the EventHub entity if needed, and lists its connection string
 
+        Args:
+            eventhub_entity: Object containing EventHub metadata
+            policy_name: Name of the listen policy
+
+        Returns:
+            Connection string
+        """
         if not self._authorization_rules_exists(eventhub_entity, policy_name):
             self.eventhub_client.event_hubs.create_or_update_authorization_rule(
                 eventhub_entity.resource_group,
@@ -315,6 +458,9 @@ class ConfigureEventHub(Step):
                 policy_name,
                 [AccessRights.listen],
             )
+            self._topology(eventhub_entity.resource_group, eventhub_entity.namespace).add_authorization_rule(
+                eventhub_entity.name, policy_name
+            )
 
         connection_string = self.eventhub_client.event_hubs.list_keys(
             eventhub_entity.resource_group, eventhub_entity.namespace, eventhub_entity.name, policy_name
@@ -354,5 +500,25 @@ class ConfigureEventHub(Step):
             consumer_groups: A list of EventHubConsumerGroup containing the name of the consumer
             group to create.
         """
-        secrets = [self._create_consumer_group(group=group) for group in consumer_groups]
+        secrets = self._provision_concurrently(
+            {
+                f"consumer group {group.consumer_group} on {group.eventhub.name} #{i}": functools.partial(
+                    self._create_consumer_group, group=group
+                )
+                for i, group in enumerate(consumer_groups)
+            }
+        )
         Context().create_or_update(ContextKey.EVENTHUB_CONSUMER_GROUP_SECRETS, secrets)
+
+    @staticmethod
+    def _provision_concurrently(tasks: Dict[str, Callable[[], Secret]]) -> List[Secret]:
+        """Runs the provisioning tasks on a bounded pool
+
+        Args:
+            tasks: Mapping of a descriptive name to a function creating one resource
+
+        Returns:
+            The secrets of all resources, in the same order as `tasks`
+        """
+        results = run_concurrently(tasks, max_workers=MAX_CONCURRENT_EVENTHUB_REQUESTS, buffer_logs=True)
+        return [_.result for _ in results]
@@ -1,7 +1,14 @@
 import abc
+import functools
+import hashlib
+import hmac
+import json
 import logging
+import os
+import secrets as random_secrets
+import threading
 from pprint import pprint
-from typing import List
+from typing import Callable, List, Dict, Optional, Set
 
 import voluptuous as vol
 from databricks_cli.secrets.api import SecretApi
@@ -10,32 +17,75 @@ from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.databricks import Databricks
 from takeoff.azure.credentials.keyvault import KeyVaultClient
 from takeoff.azure.credentials.keyvault_credentials_provider import KeyVaultCredentialsMixin
+from takeoff.context import Singleton
 from takeoff.credentials.DeploymentYamlEnvironmentVariablesMixin import (
     DeploymentYamlEnvironmentVariablesMixin,
 )
 from takeoff.credentials.secret import Secret
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step, SubStep
+from takeoff.util import run_concurrently
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# The maximum number of secrets put or deleted at the same time, to stay within Databricks API rate limits
+MAX_CONCURRENT_SECRET_REQUESTS = 8
+
+
+class SecretScopeRegistry(metaclass=Singleton):
+    """Run scoped record of the secret scopes in each Databricks workspace
+
+    The scopes of a workspace are listed once, the first time they are needed. Scopes created during
+    the run are recorded, so later existence checks don't need to list the scopes again.
+    """
+
+    def __init__(self):
+        self._scopes: Dict[str, Set[str]] = {}
+        self._lock = threading.Lock()
+
+    def exists(self, workspace: str, scope_name: str, list_scopes: Callable[[], dict]) -> bool:
+        """Checks if the scope exists in the workspace
+
+        Args:
+            workspace: The url of the Databricks workspace
+            scope_name: The scope to search for
+            list_scopes: Function listing all scopes of the workspace, only called if not listed before
+
+        Returns:
+            Whether the scope_name already exists.
+        """
+        with self._lock:
+            if workspace not in self._scopes:
+                self._scopes[workspace] = {_["name"] for _ in list_scopes().get("scopes", [])}
+            return scope_name in self._scopes[workspace]
+
+    def add(self, workspace: str, scope_name: str):
+        with self._lock:
+            self._scopes.setdefault(workspace, set()).add(scope_name)
+
+    def clear(self) -> "SecretScopeRegistry":
+        with self._lock:
+            self._scopes = {}
+        return self
+
 
 class CreateDatabricksSecretsMixin(object):
     def __init__(self):
         raise BaseException("Should not instantiate this class")
 
-    def _scope_exists(self, scopes: dict, scope_name: str) -> bool:
+    def _scope_exists(self, scope_name: str) -> bool:
         """Checks if the Databricks secret scope exists
 
         Args:
-            scopes: All existing Databricks secret scopes
             scope_name: The scope to search for
 
         Returns:
             Whether the scope_name already exists.
         """
-        return scope_name in set(_["name"] for _ in scopes["scopes"])
+        return SecretScopeRegistry().exists(
+            self.databricks_client.url, scope_name, self.get_secret_api().list_scopes
+        )
 
     @abc.abstractmethod
     def get_secret_api(self):
@@ -47,9 +97,9 @@ class CreateDatabricksSecretsMixin(object):
         Args:
             scope_name: The name of the scope to create
         """
-        scopes = self.get_secret_api().list_scopes()
-        if not self._scope_exists(scopes, scope_name):
+        if not self._scope_exists(scope_name):
             self.get_secret_api().create_scope(scope_name, None)
+            SecretScopeRegistry().add(self.databricks_client.url, scope_name)
 
     def _add_secrets(self, scope_name: str, secrets: List[Secret]):
         """Add Databricks secrets to the provided scope
@@ -58,13 +108,137 @@ class CreateDatabricksSecretsMixin(object):
             scope_name: The name of the scope to create secrets in
             secrets: List of secrets
         """
-        for secret in secrets:
-            logger.info(f"Set secret {scope_name}: {secret.key}")
-            self.get_secret_api().put_secret(scope_name, secret.key, secret.val, None)
+        run_concurrently(
+            {
+                f"put secret {scope_name}: {_.key}": functools.partial(
+                    self.get_secret_api().put_secret, scope_name, _.key, _.val, None
+                )
+                for _ in secrets
+            },
+            max_workers=MAX_CONCURRENT_SECRET_REQUESTS,
+        )
+
+    def _delete_secrets(self, scope_name: str, keys: List[str]):
+        """Delete Databricks secrets from the provided scope
+
+        Args:
+            scope_name: The name of the scope to delete secrets from
+            keys: The keys of the secrets to delete
+        """
+        run_concurrently(
+            {
+                f"delete secret {scope_name}: {_}": functools.partial(
+                    self.get_secret_api().delete_secret, scope_name, _
+                )
+                for _ in keys
+            },
+            max_workers=MAX_CONCURRENT_SECRET_REQUESTS,
+        )
+
+    def _list_secret_timestamps(self, scope_name: str) -> Dict[str, Optional[int]]:
+        secrets = self.get_secret_api().list_secrets(scope_name).get("secrets", [])
+        return {_["key"]: _.get("last_updated_timestamp") for _ in secrets}
+
+    def _sync_secrets(
+        self, scope_name: str, secrets: List[Secret], fingerprint_file: str, delete_removed: bool = False
+    ):
+        """Only puts the secrets that changed since the previous sync into the provided scope
+
+        The fingerprint file keeps a salted hash of every secret synced before, together with the
+        timestamp Databricks reported after the put. A secret is put again when its value changed,
+        or when it was updated or removed outside of Takeoff.
+
+        Args:
+            scope_name: The name of the scope to sync secrets to
+            secrets: List of secrets
+            fingerprint_file: Path of the fingerprint of the scope
+            delete_removed: Whether to delete secrets that were synced before but are no longer provided
+        """
+        fingerprint = SecretsFingerprint.load(fingerprint_file)
+        current = self._list_secret_timestamps(scope_name)
+
+        changed = [_ for _ in secrets if _.key not in current or not fingerprint.matches(_, current[_.key])]
+        removed = (
+            sorted(_ for _ in fingerprint.keys() - {_.key for _ in secrets} if _ in current)
+            if delete_removed
+            else []
+        )
+        logger.info(f"{len(changed)} of {len(secrets)} secrets changed in scope {scope_name}")
+
+        self._add_secrets(scope_name, changed)
+        self._delete_secrets(scope_name, removed)
+
+        if changed:
+            current = self._list_secret_timestamps(scope_name)
+        kept = [_ for _ in fingerprint.keys() if _ in current and _ not in removed]
+        fingerprint.update(secrets, current, keep=kept)
+        fingerprint.save(fingerprint_file)
+
+
+class SecretsFingerprint(object):
+    """Salted hashes of the secrets synced to a Databricks secret scope
+
+    Databricks does not return secret values, so the values synced before are remembered by their
+    hash. The salt is generated per fingerprint, so the hashes can not be matched against hashes of
+    known values.
+    """
+
+    def __init__(self, salt: str, secrets: Dict[str, dict]):
+        self.salt = salt
+        self.secrets = secrets
+
+    @staticmethod
+    def load(path: str) -> "SecretsFingerprint":
+        if not os.path.isfile(path):
+            return SecretsFingerprint(random_secrets.token_hex(16), {})
+        with open(path) as f:
+            content = json.load(f)
+        return SecretsFingerprint(content["salt"], content["secrets"])
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"salt": self.salt, "secrets": self.secrets}, f, indent=2, sort_keys=True)
+        os.chmod(path, 0o600)
+
+    def keys(self) -> set:
+        return set(self.secrets.keys())
+
+    def hash(self, secret: Secret) -> str:
+        message = f"{secret.key}\0{secret.val}".encode()
+        return hmac.new(self.salt.encode(), message, hashlib.sha256).hexdigest()
+
+    def matches(self, secret: Secret, last_updated_timestamp: Optional[int]) -> bool:
+        """Whether the secret is unchanged since it was synced"""
+        synced = self.secrets.get(secret.key)
+        if synced is None:
+            return False
+        unchanged_value = synced["hash"] == self.hash(secret)
+        return unchanged_value and synced["last_updated_timestamp"] == last_updated_timestamp
+
+    def update(self, secrets: List[Secret], timestamps: Dict[str, Optional[int]], keep: List[str]):
+        """Replaces the fingerprint with the given secrets, keeping the secrets in `keep`"""
+        self.secrets = {
+            **{_: self.secrets[_] for _ in keep},
+            **{
+                _.key: {"hash": self.hash(_), "last_updated_timestamp": timestamps.get(_.key)}
+                for _ in secrets
+            },
+        }
 
 
 SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
-    {vol.Required("task"): "create_databricks_secrets_from_vault"}, extra=vol.ALLOW_EXTRA
+    {
+        vol.Required("task"): "create_databricks_secrets_from_vault",
+        vol.Optional(
+            "sync",
+            description="Only put secrets that changed since the previous deployment",
+        ): {
+            vol.Optional("fingerprint_path", default=".takeoff_secret_fingerprints"): str,
+            vol.Optional("delete_removed", default=False): bool,
+        },
+    },
+    extra=vol.ALLOW_EXTRA,
 )
 
 
@@ -98,7 +272,16 @@ class CreateDatabricksSecretsFromVault(Step, CreateDatabricksSecretsMixin):
         secrets = self._combine_secrets()
 
         self._create_scope(self.application_name)
-        self._add_secrets(self.application_name, secrets)
+        if "sync" in self.config:
+            fingerprint_file = os.path.join(
+                self.config["sync"]["fingerprint_path"],
+                f"{self.env.environment}-{self.application_name}.json",
+            )
+            self._sync_secrets(
+                self.application_name, secrets, fingerprint_file, self.config["sync"]["delete_removed"]
+            )
+        else:
+            self._add_secrets(self.application_name, secrets)
 
         logging.info(f'------  {len(secrets)} secrets created in "{self.env.environment}"')
         pprint(self.secret_api.list_secrets(self.application_name))
@@ -1,6 +1,7 @@
 from msrestazure.azure_active_directory import UserPassCredentials
 
 from takeoff.azure.credentials.keyvault_credentials_provider import KeyVaultCredentialsMixin
+from takeoff.azure.credentials.token_cache import AadTokenCache
 from takeoff.util import current_filename
 
 
@@ -14,4 +15,6 @@ class ActiveDirectoryUserCredentials(KeyVaultCredentialsMixin):
         credential_kwargs = super()._transform_key_to_credential_kwargs(
             config["azure"]["keyvault_keys"][current_filename(__file__)]
         )
-        return UserPassCredentials(**credential_kwargs)
+        credentials = UserPassCredentials(**credential_kwargs, cache=AadTokenCache().get(config))
+        AadTokenCache().persist(config)
+        return credentials
@@ -1,12 +1,110 @@
+import logging
+import threading
+from collections import Counter
+from typing import Callable, Dict, Hashable
+
 from databricks_cli.sdk import ApiClient
+from databricks_cli.sdk.api_client import TlsV1HttpAdapter
+from requests import Response
+from urllib3.util.retry import Retry
 
 from takeoff.azure.credentials.keyvault_credentials_provider import KeyVaultCredentialsMixin
+from takeoff.context import RunSummary, Singleton
 from takeoff.util import current_filename
 
+logger = logging.getLogger(__name__)
+
+# Sized for the concurrent calls made by the Databricks steps
+POOL_MAXSIZE = 32
+MAX_RETRIES = 6
+RETRY_BACKOFF_FACTOR = 1
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+
+class DatabricksRetry(Retry):
+    """Retries throttled requests for every method, and server errors for idempotent methods only
+
+    A throttled request was not processed, so it is safe to retry. A request failing with a server
+    error might have been processed, so e.g. creating a job is not retried. When Databricks sends
+    a `Retry-After` header, it is honored.
+    """
+
+    def is_retry(self, method: str, status_code: int, has_retry_after: bool = False) -> bool:
+        if status_code == 429:
+            return bool(self.total)
+        return super().is_retry(method, status_code, has_retry_after)
+
+
+class DatabricksClientPool(metaclass=Singleton):
+    """Run scoped Databricks API clients, shared by all steps
+
+    Each client keeps a pool of connections to its workspace and retries throttled or failed
+    requests with exponential backoff. The number of requests, retries and responses per status
+    code are part of the run summary.
+    """
+
+    def __init__(self):
+        self._clients: Dict[Hashable, ApiClient] = {}
+        self._counters: Dict[str, Counter] = {}
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, create: Callable[[], ApiClient]) -> ApiClient:
+        """Returns the client for the key, creating it on first use
+
+        Args:
+            key: Identifies the credentials of the client
+            create: Function creating the client
+
+        Returns:
+            The shared client
+        """
+        with self._lock:
+            if key not in self._clients:
+                self._clients[key] = self._configure(create())
+            return self._clients[key]
+
+    def clear(self) -> "DatabricksClientPool":
+        with self._lock:
+            self._clients = {}
+            self._counters = {}
+        return self
+
+    def _configure(self, client: ApiClient) -> ApiClient:
+        retry = DatabricksRetry(
+            total=MAX_RETRIES,
+            backoff_factor=RETRY_BACKOFF_FACTOR,
+            status_forcelist=RETRY_STATUSES,
+            raise_on_status=False,
+        )
+        adapter = TlsV1HttpAdapter(pool_maxsize=POOL_MAXSIZE, max_retries=retry)
+        client.session.mount(client.url, adapter)
+
+        counter = self._counters.setdefault(client.url, Counter())
+        client.session.hooks["response"].append(lambda response, **_: self._count(counter, response))
+        RunSummary().register(f"Databricks requests to {client.url}", lambda: dict(sorted(counter.items())))
+        return client
+
+    def _count(self, counter: Counter, response: Response):
+        history = getattr(getattr(response.raw, "retries", None), "history", ())
+        with self._lock:
+            counter["requests"] += 1
+            counter["retries"] += len(history)
+            for attempt in history:
+                if attempt.status:
+                    counter[f"status {attempt.status}"] += 1
+            counter[f"status {response.status_code}"] += 1
+
 
 class Databricks(KeyVaultCredentialsMixin):
     def api_client(self, config: dict) -> ApiClient:
-        credential_kwargs = super()._transform_key_to_credential_kwargs(
-            config["azure"]["keyvault_keys"][current_filename(__file__)]
-        )
+        """Returns the Databricks client of this run, creating it on first use
+
+        The client is shared per vault and set of keyvault keys, so the credentials are only looked up once.
+        """
+        keyvault_keys = config["azure"]["keyvault_keys"][current_filename(__file__)]
+        key = (self.vault_name, tuple(sorted(keyvault_keys.items())))
+        return DatabricksClientPool().get(key, lambda: self._create_client(keyvault_keys))
+
+    def _create_client(self, keyvault_keys: Dict[str, str]) -> ApiClient:
+        credential_kwargs = super()._transform_key_to_credential_kwargs(keyvault_keys)
         return ApiClient(**credential_kwargs)
@@ -0,0 +1,149 @@
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import yaml
+from cryptography import x509
+from cryptography.fernet import InvalidToken
+from cryptography.hazmat.backends import default_backend
+
+from takeoff.azure.credentials.token_cache import fernet_from_environment
+from takeoff.context import Singleton
+from takeoff.util import Lazy, b64_decode
+
+logger = logging.getLogger(__name__)
+
+# Kubeconfigs of which the credentials expire within this many seconds are fetched again
+EXPIRY_MARGIN_SECONDS = 300
+
+
+def _certificate_expiry(certificate_data: str) -> float:
+    certificate = x509.load_pem_x509_certificate(b64_decode(certificate_data).encode(), default_backend())
+    return certificate.not_valid_after.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def credentials_expiry(kubeconfig: str) -> Optional[float]:
+    """Determines when the first of the credentials in a kubeconfig expires
+
+    Both client certificates and tokens of the Azure auth provider are taken into account. Static
+    tokens don't expire.
+
+    Args:
+        kubeconfig: The kubeconfig, as yaml
+
+    Returns:
+        The expiry as a unix timestamp, or None if none of the credentials expire
+    """
+    expiries = []
+    for user in yaml.safe_load(kubeconfig).get("users") or []:
+        user = user.get("user") or {}
+        if "client-certificate-data" in user:
+            expiries.append(_certificate_expiry(user["client-certificate-data"]))
+        expires_on = (user.get("auth-provider") or {}).get("config", {}).get("expires-on")
+        if expires_on:
+            expiries.append(float(expires_on))
+    return min(expiries) if expiries else None
+
+
+class KubeconfigCache(metaclass=Singleton):
+    """Run scoped cache of the kubeconfigs of AKS clusters
+
+    Kubeconfigs are cached per subscription, resource group and cluster, so the cluster credentials are
+    requested from Azure once per run. Optionally the kubeconfigs are persisted to disk, encrypted with
+    a key taken from an environment variable, so consecutive Takeoff invocations within the same CI job
+    can reuse them until they are `max_age_seconds` old, or their credentials are about to expire.
+
+    Example:
+
+        In `.takeoff/config.yml`::
+
+            azure:
+              kubeconfig_cache:
+                path: .takeoff_kubeconfig_cache
+                encryption_key: TAKEOFF_KUBECONFIG_CACHE_KEY
+    """
+
+    def __init__(self):
+        self._kubeconfigs: Dict[Tuple[str, str, str], Lazy] = {}
+        self._lock = threading.Lock()
+        self._disk_lock = threading.Lock()
+
+    def get(self, config: dict, cluster: Tuple[str, str, str], fetch: Callable[[], str]) -> str:
+        """Returns the kubeconfig of the cluster, fetching it if it is not cached
+
+        Args:
+            config: The Takeoff config
+            cluster: The subscription id, resource group and name of the cluster
+            fetch: Function fetching the kubeconfig from Azure, as yaml
+
+        Returns:
+            The kubeconfig, as yaml
+        """
+        with self._lock:
+            if cluster not in self._kubeconfigs:
+                self._kubeconfigs[cluster] = Lazy(lambda: self._load_or_fetch(config, cluster, fetch))
+        return self._kubeconfigs[cluster].get()
+
+    def clear(self) -> "KubeconfigCache":
+        """Clears all kubeconfigs from memory. Persisted kubeconfigs are read again on next use.
+
+        Returns:
+            Empty KubeconfigCache
+        """
+        with self._lock:
+            self._kubeconfigs = {}
+        return self
+
+    def _load_or_fetch(self, config: dict, cluster: Tuple[str, str, str], fetch: Callable[[], str]) -> str:
+        cache_config = self._cache_config(config)
+        if not cache_config:
+            return fetch()
+
+        key = "/".join(cluster)
+        with self._disk_lock:
+            entry = self._read(cache_config).get(key)
+        if entry and entry["expires"] > time.time() + EXPIRY_MARGIN_SECONDS:
+            logger.info(f"Reusing kubeconfig of {cluster[2]} from disk")
+            return entry["kubeconfig"]
+
+        kubeconfig = fetch()
+        expires = time.time() + cache_config["max_age_seconds"]
+        credentials_expire = credentials_expiry(kubeconfig)
+        if credentials_expire is not None:
+            expires = min(expires, credentials_expire)
+
+        with self._disk_lock:
+            entries = self._read(cache_config)
+            entries[key] = {"kubeconfig": kubeconfig, "expires": expires}
+            self._write(cache_config, entries)
+        return kubeconfig
+
+    @staticmethod
+    def _read(cache_config: dict) -> dict:
+        if not os.path.isfile(cache_config["path"]):
+            return {}
+        with open(cache_config["path"], "rb") as f:
+            encrypted = f.read()
+        try:
+            entries = json.loads(fernet_from_environment(cache_config["encryption_key"]).decrypt(encrypted))
+        except InvalidToken:
+            logger.warning(f"Could not decrypt kubeconfig cache {cache_config['path']}, ignoring it")
+            return {}
+        # drop the kubeconfigs that expired, so they don't linger on disk
+        return {key: entry for key, entry in entries.items() if entry["expires"] > time.time()}
+
+    @staticmethod
+    def _write(cache_config: dict, entries: dict):
+        fernet = fernet_from_environment(cache_config["encryption_key"])
+        encrypted = fernet.encrypt(json.dumps(entries).encode())
+        with open(cache_config["path"], "wb") as f:
+            f.write(encrypted)
+        os.chmod(cache_config["path"], 0o600)
+
+    @staticmethod
+    def _cache_config(config: dict) -> Optional[dict]:
+        return config.get("azure", {}).get("kubeconfig_cache")
@@ -1,5 +1,6 @@
 from msrestazure.azure_active_directory import ServicePrincipalCredentials as SpCredentials
 
+from takeoff.azure.credentials.token_cache import AadTokenCache
 from takeoff.credentials.environment_credentials_provider import EnvironmentCredentialsMixin
 from takeoff.util import current_filename
 
@@ -9,4 +10,6 @@ class ServicePrincipalCredentials(EnvironmentCredentialsMixin):
         credential_kwargs = super()._transform_environment_key_to_credential_kwargs(
             config[f"ci_environment_keys_{env}"][current_filename(__file__)]
         )
-        return SpCredentials(**credential_kwargs)
+        credentials = SpCredentials(**credential_kwargs, cache=AadTokenCache().get(config))
+        AadTokenCache().persist(config)
+        return credentials
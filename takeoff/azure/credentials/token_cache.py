@@ -0,0 +1,119 @@
+import base64
+import hashlib
+import logging
+import os
+from typing import Optional
+
+from adal import TokenCache
+from cryptography.fernet import Fernet, InvalidToken
+
+from takeoff.context import Singleton
+
+logger = logging.getLogger(__name__)
+
+
+class AadTokenCache(metaclass=Singleton):
+    """Process wide cache for AAD tokens.
+
+    All AAD credentials constructed by Takeoff share a single ADAL token cache. ADAL indexes
+    tokens on authority (which includes the tenant), client id, resource and user, and only
+    returns tokens that are not about to expire. This means the many credential objects created
+    throughout a run reuse a single token instead of re-authenticating.
+
+    Optionally the cache is persisted to disk, encrypted with a key taken from an environment
+    variable, so consecutive Takeoff invocations within the same CI job can reuse tokens as well.
+
+    Example:
+
+        In `.takeoff/config.yml`::
+
+            azure:
+              token_cache:
+                path: .takeoff_token_cache
+                encryption_key: TAKEOFF_TOKEN_CACHE_KEY
+    """
+
+    def __init__(self):
+        self.cache = TokenCache()
+        self._loaded = False
+
+    def get(self, config: dict) -> TokenCache:
+        """Returns the shared token cache, loading any persisted tokens on first use.
+
+        Args:
+            config: The Takeoff config
+
+        Returns:
+            The ADAL token cache to pass to AAD credentials
+        """
+        if not self._loaded:
+            self._loaded = True
+            state = self._read_state(config)
+            if state:
+                self.cache.deserialize(state)
+                logger.info("Loaded AAD tokens from disk")
+        return self.cache
+
+    def persist(self, config: dict):
+        """Writes the token cache to disk, if configured and the cache has changed.
+
+        Args:
+            config: The Takeoff config
+        """
+        cache_config = self._cache_config(config)
+        if not cache_config or not self.cache.has_state_changed:
+            return
+
+        encrypted = self._fernet(cache_config).encrypt(self.cache.serialize().encode())
+        with open(cache_config["path"], "wb") as f:
+            f.write(encrypted)
+        os.chmod(cache_config["path"], 0o600)
+        self.cache.has_state_changed = False
+
+    def clear(self) -> "AadTokenCache":
+        """Clears all tokens from memory. Persisted tokens are read again on next use.
+
+        Returns:
+            Empty AadTokenCache
+        """
+        self.cache = TokenCache()
+        self._loaded = False
+        return self
+
+    def _read_state(self, config: dict) -> Optional[str]:
+        cache_config = self._cache_config(config)
+        if not cache_config or not os.path.isfile(cache_config["path"]):
+            return None
+
+        with open(cache_config["path"], "rb") as f:
+            encrypted = f.read()
+        try:
+            return self._fernet(cache_config).decrypt(encrypted).decode()
+        except InvalidToken:
+            logger.warning(f"Could not decrypt token cache {cache_config['path']}, ignoring it")
+            return None
+
+    @staticmethod
+    def _cache_config(config: dict) -> Optional[dict]:
+        return config.get("azure", {}).get("token_cache")
+
+    @staticmethod
+    def _fernet(cache_config: dict) -> Fernet:
+        return fernet_from_environment(cache_config["encryption_key"])
+
+
+def fernet_from_environment(os_key: str) -> Fernet:
+    """Constructs a cipher from the secret in the given environment variable.
+
+    Any secret string can be used, it is stretched to a valid Fernet key using sha256.
+
+    Args:
+        os_key: Name of the environment variable containing the secret
+
+    Returns:
+        The cipher
+    """
+    if os_key not in os.environ:
+        raise ValueError(f"Could not find environment variable {os_key}")
+    digest = hashlib.sha256(os.environ[os_key].encode()).digest()
+    return Fernet(base64.urlsafe_b64encode(digest))
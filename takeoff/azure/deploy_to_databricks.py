@@ -1,11 +1,15 @@
+import functools
 import json
 import logging
 import pprint
 import re
+import threading
+import time
 from dataclasses import dataclass
-from typing import List, Optional, Dict
+from typing import Callable, List, Optional, Dict
 
 import voluptuous as vol
+from databricks_cli.instance_pools.api import InstancePoolsApi
 from databricks_cli.jobs.api import JobsApi
 from databricks_cli.runs.api import RunsApi
 
@@ -15,10 +19,28 @@ from takeoff.azure.credentials.databricks import Databricks
 from takeoff.azure.credentials.keyvault import KeyVaultClient
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
-from takeoff.util import has_prefix_match, get_whl_name, get_main_py_name
+from takeoff.util import Lazy, has_prefix_match, get_whl_name, get_main_py_name, run_concurrently
 
 logger = logging.getLogger(__name__)
 
+# The life cycle states of a run that has not ended yet, in the order a run goes through them
+RUN_READY_STATES = ["PENDING", "RUNNING"]
+
+INSTANCE_POOL_SCHEMA = {
+    vol.Required("name"): str,
+    vol.Required("node_type_id"): str,
+    vol.Optional("min_idle_instances", default=0): int,
+    vol.Optional("max_capacity"): int,
+    vol.Optional("idle_instance_autotermination_minutes", default=60): int,
+    vol.Optional("preloaded_spark_versions", default=[]): [str],
+    vol.Optional(
+        "prewarm_instances",
+        default=0,
+        description="The number of idle instances to start before the jobs are run",
+    ): int,
+    vol.Optional("prewarm_timeout_seconds", default=600): int,
+}
+
 SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
     {
         vol.Required("task"): "deploy_to_databricks",
@@ -31,6 +53,15 @@ SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
                     vol.Optional("lang", default="python"): vol.All(str, vol.In(["python", "scala"])),
                     vol.Optional("run_stream_job_immediately", default=True): bool,
                     vol.Optional("is_batch", default=False): bool,
+                    vol.Optional("wait_for_termination", default=False): bool,
+                    vol.Optional(
+                        "handover",
+                        default=False,
+                        description=(
+                            "Start the new streaming job before cancelling the runs of the old job, "
+                            "to minimize the processing gap"
+                        ),
+                    ): bool,
                     vol.Optional("arguments", default=[{}]): [{}],
                     vol.Optional("schedule"): {
                         vol.Required("quartz_cron_expression"): str,
@@ -40,12 +71,37 @@ SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
             ],
             vol.Length(min=1),
         ),
+        vol.Optional("run_termination_timeout_seconds", default=600): int,
+        vol.Optional("handover_ready_state", default="RUNNING"): vol.In(RUN_READY_STATES),
+        vol.Optional("handover_timeout_seconds", default=900): int,
+        vol.Optional(
+            "reconcile_jobs",
+            default=False,
+            description=(
+                "Update existing jobs with the same name in place, instead of removing and recreating them"
+            ),
+        ): bool,
+        vol.Optional(
+            "max_concurrent_jobs",
+            default=4,
+            description="The maximum number of jobs deployed at the same time",
+        ): vol.All(int, vol.Range(min=1)),
+        vol.Optional("instance_pool"): INSTANCE_POOL_SCHEMA,
         "common": {vol.Optional("databricks_fs_libraries_mount_path"): str},
     },
     extra=vol.ALLOW_EXTRA,
 )
 
 
+JOBS_PAGE_SIZE = 25
+RUNS_PAGE_SIZE = 25
+RUN_POLL_INITIAL_INTERVAL = 2
+RUN_POLL_MAX_INTERVAL = 30
+TERMINAL_LIFE_CYCLE_STATES = {"TERMINATED", "SKIPPED", "INTERNAL_ERROR"}
+# Job settings Databricks fills in when they are not part of the submitted settings
+SERVER_DEFAULT_JOB_SETTINGS = {"email_notifications", "timeout_seconds", "max_concurrent_runs", "format"}
+
+
 @dataclass(frozen=True)
 class JobConfig(object):
     name: str
@@ -59,6 +115,11 @@ class DeployToDatabricks(Step):
         self.databricks_client = Databricks(self.vault_name, self.vault_client).api_client(self.config)
         self.jobs_api = JobsApi(self.databricks_client)
         self.runs_api = RunsApi(self.databricks_client)
+        self.instance_pools_api = InstancePoolsApi(self.databricks_client)
+        self._job_index: Optional[Dict[str, List[JobConfig]]] = None
+        self._job_index_lock = threading.RLock()
+        self._instance_pool_id: Optional[str] = None
+        self._instance_pool_warm = Lazy(self._poll_warm_instance_pool)
 
     def schema(self) -> vol.Schema:
         return SCHEMA
@@ -81,20 +142,256 @@ class DeployToDatabricks(Step):
         will be set as databricks secrets eventually
         If the job is a streaming job this will directly start the new job_run given the new
         configuration. If the job is batch this will not start it manually.
+
+        Jobs are deployed concurrently, at most `max_concurrent_jobs` at the same time. Jobs sharing a
+        name are deployed one after the other, in the order of the config. The logs of each job are
+        emitted as they happen, prefixed with the name of the job.
+
+        Raises:
+            ConcurrentTaskError if the deployment of any of the jobs failed
         """
+        jobs_by_name: Dict[str, List[dict]] = {}
         for job in self.config["jobs"]:
-            app_name = self._construct_name(job["name"])
-            job_name = f"{app_name}-{self.env.artifact_tag}"
-            job_config = self.create_config(job_name, job)
-            is_streaming = self._job_is_unscheduled(job_config) and not job["is_batch"]
-            run_stream_job_immediately = job["run_stream_job_immediately"]
+            jobs_by_name.setdefault(self._construct_name(job["name"]), []).append(job)
+
+        if "instance_pool" in self.config:
+            self._instance_pool_id = self._ensure_instance_pool()
+
+        # List the workspace before deploying, instead of racing to do so in every task
+        self.job_index
+        try:
+            run_concurrently(
+                {name: functools.partial(self._deploy_jobs, jobs) for name, jobs in jobs_by_name.items()},
+                max_workers=self.config["max_concurrent_jobs"],
+                prefix_logs=True,
+            )
+        finally:
+            if self._instance_pool_id:
+                self._end_prewarm()
+
+    def _deploy_jobs(self, jobs: List[dict]):
+        for job in jobs:
+            self._deploy(job)
+
+    def _deploy(self, job: dict):
+        app_name = self._construct_name(job["name"])
+        job_name = f"{app_name}-{self.env.artifact_tag}"
+        job_config = self.create_config(job_name, job)
+        is_streaming = self._job_is_unscheduled(job_config) and not job["is_batch"]
+        run_stream_job_immediately = job["run_stream_job_immediately"]
+
+        existing_job = self._find_job(app_name, job_name) if self.config["reconcile_jobs"] else None
+        if existing_job:
+            self.reconcile_job(existing_job, job, job_config, is_streaming, run_stream_job_immediately)
+            return
+
+        if is_streaming and run_stream_job_immediately and job["handover"]:
+            self.handover_job(job, job_name, job_config)
+            return
+
+        logger.info(f"Removing old job of {app_name}")
+        self.remove_job(self.env.artifact_tag, job_config=job, is_streaming=is_streaming)
+
+        logger.info(f"Submitting new job {job_name} with configuration:")
+        logger.info(pprint.pformat(job_config))
+        job_id = self.deploy_job(job_config, is_streaming, run_stream_job_immediately)
+        self._add_to_job_index(JobConfig(job_name, job_id))
+
+    def handover_job(self, job: dict, job_name: str, job_config: dict):
+        """Replaces a streaming job, starting the new job before cancelling the runs of the old job.
+
+        The old job is only removed once the run of the new job reached `handover_ready_state`, so the
+        processing gap is limited to the time it takes to hand over the checkpoint. When the new run
+        fails to get ready, the new run is cancelled and the new job is removed, leaving the old job as
+        the only job running.
+
+        Raises:
+            RuntimeError if the new run ended before it was ready
+            TimeoutError if the new run was not ready within `handover_timeout_seconds`
+        """
+        logger.info(f"Submitting new job {job_name} with configuration:")
+        logger.info(pprint.pformat(job_config))
+        new_job = JobConfig(job_name, self._submit_job(job_config))
+        self._add_to_job_index(new_job)
+        try:
+            run_id = self._run_job(new_job.job_id)
+            self._wait_for_run_ready(run_id)
+        except Exception:
+            logger.warning(f"Handover to job {job_name} failed, removing the new job")
+            self._discard_job(new_job)
+            raise
+
+        logger.info(f"Run {run_id} is ready, removing old job of {self._construct_name(job['name'])}")
+        self.remove_job(self.env.artifact_tag, job_config=job, is_streaming=True, keep=new_job)
+
+    def _discard_job(self, job: JobConfig):
+        """Cancels the active runs of a job, without waiting for them to terminate, and deletes the job"""
+        self._kill_it_with_fire(job.job_id)
+        logger.info(f"Deleting Job with ID {job.job_id}")
+        self.jobs_api.delete_job(job.job_id)
+        with self._job_index_lock:
+            for name, indexed_jobs in self.job_index.items():
+                self.job_index[name] = [_ for _ in indexed_jobs if _ != job]
+
+    def _wait_for_run_ready(self, run_id: int):
+        first_ready_state = RUN_READY_STATES.index(self.config["handover_ready_state"])
+        ready_states = RUN_READY_STATES[first_ready_state:]
+
+        def _is_ready() -> bool:
+            life_cycle_state = self.runs_api.get_run(run_id)["state"]["life_cycle_state"]
+            if life_cycle_state not in RUN_READY_STATES:
+                raise RuntimeError(f"Run {run_id} ended in state {life_cycle_state} before it was ready")
+            return life_cycle_state in ready_states
+
+        timeout = self.config["handover_timeout_seconds"]
+        self._poll_with_backoff(_is_ready, timeout, f"run {run_id} to be ready")
+
+    def _instance_pool_settings(self, min_idle_instances: int) -> dict:
+        pool_config = self.config["instance_pool"]
+        settings = {
+            "instance_pool_name": pool_config["name"],
+            "node_type_id": pool_config["node_type_id"],
+            "min_idle_instances": min_idle_instances,
+            "idle_instance_autotermination_minutes": pool_config["idle_instance_autotermination_minutes"],
+            "preloaded_spark_versions": pool_config["preloaded_spark_versions"],
+        }
+        if "max_capacity" in pool_config:
+            settings["max_capacity"] = pool_config["max_capacity"]
+        return settings
+
+    def _ensure_instance_pool(self) -> str:
+        """Creates the configured instance pool, or updates it when its settings differ
+
+        When pre-warming, the pool keeps at least `prewarm_instances` idle instances until all jobs are
+        deployed, so the clusters of the jobs start from running instances.
+
+        Returns:
+            The id of the instance pool
+        """
+        pool_config = self.config["instance_pool"]
+        settings = self._instance_pool_settings(
+            max(pool_config["min_idle_instances"], pool_config["prewarm_instances"])
+        )
+        pools = self.instance_pools_api.list_instance_pools().get("instance_pools", [])
+        existing = next((_ for _ in pools if _["instance_pool_name"] == pool_config["name"]), None)
+
+        if existing is None:
+            logger.info(f"Creating instance pool {pool_config['name']}")
+            return self.instance_pools_api.create_instance_pool(settings)["instance_pool_id"]
+
+        pool_id = existing["instance_pool_id"]
+        if any(existing.get(k) != v for k, v in settings.items()):
+            logger.info(f"Updating instance pool {pool_config['name']} with ID {pool_id}")
+            self.instance_pools_api.edit_instance_pool({"instance_pool_id": pool_id, **settings})
+        return pool_id
+
+    def _end_prewarm(self):
+        """Lets the instance pool scale back to its configured number of idle instances"""
+        pool_config = self.config["instance_pool"]
+        if pool_config["prewarm_instances"] > pool_config["min_idle_instances"]:
+            logger.info(f"Ending pre-warm of instance pool {pool_config['name']}")
+            self.instance_pools_api.edit_instance_pool(
+                {
+                    "instance_pool_id": self._instance_pool_id,
+                    **self._instance_pool_settings(pool_config["min_idle_instances"]),
+                }
+            )
 
-            logger.info("Removing old job")
-            self.remove_job(self.env.artifact_tag, job_config=job, is_streaming=is_streaming)
+    def _wait_for_warm_instance_pool(self):
+        """Waits until the instance pool has `prewarm_instances` idle instances, once per step
 
-            logger.info("Submitting new job with configuration:")
+        Jobs run concurrently share a single poll of the pool, the others block until it is done.
+        Pre-warming only speeds up the deployment, so the jobs are run regardless when the instances
+        are not ready in time.
+        """
+        if self._instance_pool_id and self.config.get("instance_pool", {}).get("prewarm_instances", 0):
+            self._instance_pool_warm.get()
+
+    def _poll_warm_instance_pool(self):
+        pool_config = self.config["instance_pool"]
+        prewarm_instances = pool_config["prewarm_instances"]
+
+        def _is_warm() -> bool:
+            stats = self.instance_pools_api.get_instance_pool(self._instance_pool_id).get("stats", {})
+            return stats.get("idle_count", 0) >= prewarm_instances
+
+        description = f"{prewarm_instances} idle instances in pool {pool_config['name']}"
+        try:
+            self._poll_with_backoff(_is_warm, pool_config["prewarm_timeout_seconds"], description)
+        except TimeoutError:
+            logger.warning(f"Timed out waiting for {description}, running jobs anyway")
+
+    def _attach_instance_pool(self, job_config: dict):
+        """Runs the job cluster on the instance pool, unless the job config specifies a pool itself"""
+        cluster = job_config.get("new_cluster")
+        if cluster is None:
+            return
+        cluster.setdefault("instance_pool_id", self._instance_pool_id)
+        if cluster["instance_pool_id"] == self._instance_pool_id:
+            # The node types are determined by the pool
+            cluster.pop("node_type_id", None)
+            cluster.pop("driver_node_type_id", None)
+
+    def _find_job(self, app_name: str, job_name: str) -> Optional[JobConfig]:
+        with self._job_index_lock:
+            return next((_ for _ in self.job_index.get(app_name, []) if _.name == job_name), None)
+
+    def reconcile_job(
+        self,
+        existing_job: JobConfig,
+        job: dict,
+        job_config: dict,
+        is_streaming: bool,
+        run_stream_job_immediately: bool,
+    ):
+        """Updates an existing job with the same name in place, keeping its job id and run history.
+
+        The settings of the job are only reset when they differ from the rendered job config. Other
+        versions of the job are removed as usual. Streaming jobs are restarted when their settings changed,
+        or when the version is mutable (SNAPSHOT or branch builds), as the artifact may have changed
+        without the job settings changing. A release with unchanged settings is left running.
+        """
+        logger.info(f"Removing other versions of job {existing_job.name}")
+        self.remove_job(self.env.artifact_tag, job_config=job, is_streaming=is_streaming, keep=existing_job)
+
+        current_settings = self.jobs_api.get_job(existing_job.job_id)["settings"]
+        settings_changed = not self._job_settings_equal(job_config, current_settings)
+        if not settings_changed:
+            logger.info(f"Settings of job with ID {existing_job.job_id} are unchanged")
+        else:
+            logger.info(f"Resetting job with ID {existing_job.job_id} to configuration:")
             logger.info(pprint.pformat(job_config))
-            self.deploy_job(job_config, is_streaming, run_stream_job_immediately)
+            self.jobs_api.reset_job({"job_id": existing_job.job_id, "new_settings": job_config})
+
+        if is_streaming and not settings_changed and not self._version_is_mutable():
+            logger.info(f"Job with ID {existing_job.job_id} runs an unchanged release, not restarting it")
+        elif is_streaming:
+            self._kill_it_with_fire(existing_job.job_id, job["wait_for_termination"])
+            if run_stream_job_immediately:
+                self._run_job(existing_job.job_id)
+
+    def _version_is_mutable(self) -> bool:
+        """Whether the artifact of this version can change without its version changing"""
+        return self.env.version == "SNAPSHOT" or self.env.on_feature_branch
+
+    @staticmethod
+    def _job_settings_equal(desired: dict, current: dict) -> bool:
+        """Compares the rendered job config with the settings of an existing job
+
+        Databricks adds defaults to the settings of a job, so only the values present in the rendered
+        job config are compared. The only keys allowed to be missing from the rendered job config are
+        the top level settings Databricks fills in by default.
+        """
+
+        def _is_subset(left, right) -> bool:
+            if isinstance(left, dict) and isinstance(right, dict):
+                return all(k in right and _is_subset(v, right[k]) for k, v in left.items())
+            if isinstance(left, list) and isinstance(right, list):
+                return len(left) == len(right) and all(_is_subset(a, b) for a, b in zip(left, right))
+            return left == right
+
+        unexpected_keys = current.keys() - desired.keys() - SERVER_DEFAULT_JOB_SETTINGS
+        return not unexpected_keys and _is_subset(desired, current)
 
     def create_config(self, job_name: str, job_config: dict):
         common_arguments = dict(
@@ -104,6 +401,7 @@ class DeployToDatabricks(Step):
             parameters=self._construct_arguments(job_config["arguments"]),
             schedule=self._get_schedule(job_config),
             environment=self.env.environment_formatted,
+            instance_pool_id=self._instance_pool_id,
         )
 
         root_library_folder = self.config["common"]["databricks_fs_libraries_mount_path"]
@@ -122,6 +420,8 @@ class DeployToDatabricks(Step):
             run_config = DeployToDatabricks._construct_job_config(
                 **common_arguments, class_name=job_config["main_name"], jar_file=f"{artifact_path}.jar"
             )
+        if self._instance_pool_id:
+            self._attach_instance_pool(run_config)
         return run_config
 
     def _get_schedule(self, job_config: dict) -> Optional[dict]:
@@ -151,17 +451,54 @@ class DeployToDatabricks(Step):
     def _construct_job_config(config_file: str, **kwargs) -> dict:
         return util.render_file_with_jinja(config_file, kwargs, json.loads)
 
-    def remove_job(self, branch: str, job_config: dict, is_streaming: bool):
+    def _list_jobs(self) -> List[JobConfig]:
+        """Lists all jobs in the Databricks workspace, going over all pages
+
+        Returns:
+            Name and id of every job in the workspace
+        """
+        jobs: List[JobConfig] = []
+        while True:
+            page = self.databricks_client.perform_query(
+                "GET", "/jobs/list", data={"offset": len(jobs), "limit": JOBS_PAGE_SIZE}
+            )
+            page_jobs = page.get("jobs", [])
+            jobs.extend(JobConfig(_["settings"]["name"], _["job_id"]) for _ in page_jobs)
+            if not page.get("has_more", False) or not page_jobs:
+                return jobs
+
+    @property
+    def job_index(self) -> Dict[str, List[JobConfig]]:
+        """All jobs belonging to this step, indexed on the names of the jobs configured in this step.
+
+        The workspace is listed once per step. A job name is `<name>-<version>`, so a job is indexed
+        on every prefix of its name that ends before a `-` and matches a configured name.
+        """
+        with self._job_index_lock:
+            if self._job_index is None:
+                self._job_index = {self._construct_name(_["name"]): [] for _ in self.config["jobs"]}
+                for job in self._list_jobs():
+                    self._add_to_job_index(job)
+            return self._job_index
+
+    def _add_to_job_index(self, job: JobConfig):
+        prefixes = {job.name[:i] for i, char in enumerate(job.name) if char == "-"}
+        with self._job_index_lock:
+            for prefix in prefixes & self.job_index.keys():
+                self.job_index[prefix].append(job)
+
+    def remove_job(self, branch: str, job_config: dict, is_streaming: bool, keep: Optional[JobConfig] = None):
         """
         Removes the existing job and cancels any running job_run if the application is streaming.
         If the application is batch, it'll let the batch job finish but it will remove the job,
         making sure no other job_runs can start for that old job.
-        """
 
-        job_configs = [
-            JobConfig(_["settings"]["name"], _["job_id"]) for _ in self.jobs_api.list_jobs()["jobs"]
-        ]
-        job_ids = self._application_job_id(self._construct_name(job_config["name"]), branch, job_configs)
+        Optionally a job can be kept, for example because it is updated in place.
+        """
+        app_name = self._construct_name(job_config["name"])
+        with self._job_index_lock:
+            job_configs = [_ for _ in self.job_index.get(app_name, []) if _ != keep]
+        job_ids = self._application_job_id(app_name, branch, job_configs)
 
         if not job_ids:
             logger.info(f"Could not find jobs in list of {pprint.pformat(job_configs)}")
@@ -169,10 +506,14 @@ class DeployToDatabricks(Step):
         for job_id in job_ids:
             logger.info(f"Found Job with ID {job_id}")
             if is_streaming:
-                self._kill_it_with_fire(job_id)
+                self._kill_it_with_fire(job_id, job_config.get("wait_for_termination", False))
             logger.info(f"Deleting Job with ID {job_id}")
             self.jobs_api.delete_job(job_id)
 
+        with self._job_index_lock:
+            for name, indexed_jobs in self.job_index.items():
+                self.job_index[name] = [_ for _ in indexed_jobs if _.job_id not in job_ids]
+
     @staticmethod
     def _application_job_id(application_name: str, branch: str, jobs: List[JobConfig]) -> List[int]:
         snapshot = "SNAPSHOT"
@@ -181,27 +522,104 @@ class DeployToDatabricks(Step):
 
         return [_.job_id for _ in jobs if has_prefix_match(_.name, application_name, pattern)]
 
-    def _kill_it_with_fire(self, job_id: int):
+    def _list_active_runs(self, job_id: int) -> List[dict]:
+        """Lists all active runs of a job, going over all pages
+
+        Args:
+            job_id: The id of the Databricks job
+
+        Returns:
+            All active runs of the job
+        """
+        runs: List[dict] = []
+        while True:
+            page = self.runs_api.list_runs(
+                job_id, active_only=True, completed_only=None, offset=len(runs), limit=RUNS_PAGE_SIZE
+            )
+            # If the runs is empty, there are no jobs at all
+            page_runs = page.get("runs", [])
+            runs.extend(page_runs)
+            if not page.get("has_more", False) or not page_runs:
+                return runs
+
+    def _kill_it_with_fire(self, job_id: int, wait_for_termination: bool = False):
+        """Cancels all active runs of a job concurrently
+
+        Args:
+            job_id: The id of the Databricks job
+            wait_for_termination: Whether to block until all cancelled runs have terminated
+        """
         logger.info(f"Finding runs for job_id {job_id}")
-        runs = self.runs_api.list_runs(job_id, active_only=True, completed_only=None, offset=None, limit=None)
-        # If the runs is empty, there are no jobs at all
-        # TODO: Check if the has_more flag is true, this means we need to go over the pages
-        if "runs" in runs:
-            active_run_ids = [_["run_id"] for _ in runs["runs"]]
-            logger.info(f"Canceling active runs {active_run_ids}")
-            [self.runs_api.cancel_run(_) for _ in active_run_ids]
-
-    def deploy_job(self, job_config: Dict, is_streaming: bool, run_stream_job_immediately: bool):
+        active_run_ids = [_["run_id"] for _ in self._list_active_runs(job_id)]
+        if not active_run_ids:
+            return
+
+        logger.info(f"Canceling active runs {active_run_ids}")
+        run_concurrently(
+            {f"cancel run {_}": functools.partial(self.runs_api.cancel_run, _) for _ in active_run_ids}
+        )
+        if wait_for_termination:
+            self._wait_for_termination(active_run_ids)
+
+    def _wait_for_termination(self, run_ids: List[int]):
+        """Polls the runs, with exponential backoff, until all of them have terminated
+
+        Args:
+            run_ids: The ids of the runs to wait for
+
+        Raises:
+            TimeoutError if the runs did not terminate within `run_termination_timeout_seconds`
+        """
+        pending = set(run_ids)
+
+        def _all_terminated() -> bool:
+            nonlocal pending
+            pending = {
+                _
+                for _ in pending
+                if self.runs_api.get_run(_)["state"]["life_cycle_state"] not in TERMINAL_LIFE_CYCLE_STATES
+            }
+            return not pending
+
+        self._poll_with_backoff(
+            _all_terminated, self.config["run_termination_timeout_seconds"], f"runs {run_ids} to terminate"
+        )
+        logger.info(f"Runs {run_ids} have terminated")
+
+    @staticmethod
+    def _poll_with_backoff(is_done: Callable[[], bool], timeout: int, description: str):
+        """Polls, with exponential backoff, until `is_done` returns True
+
+        Args:
+            is_done: Function checking whether the wait is over
+            timeout: The maximum number of seconds to wait
+            description: What is waited for, used in logging
+
+        Raises:
+            TimeoutError if `is_done` did not return True within `timeout` seconds
+        """
+        deadline = time.monotonic() + timeout
+        interval = RUN_POLL_INITIAL_INTERVAL
+        while not is_done():
+            if time.monotonic() + interval > deadline:
+                raise TimeoutError(f"Timed out waiting for {description}")
+            logger.info(f"Waiting {interval}s for {description}")
+            time.sleep(interval)
+            interval = min(interval * 2, RUN_POLL_MAX_INTERVAL)
+
+    def deploy_job(self, job_config: Dict, is_streaming: bool, run_stream_job_immediately: bool) -> int:
         job_id = self._submit_job(job_config)
         if is_streaming and run_stream_job_immediately:
             self._run_job(job_id)
+        return job_id
 
     def _submit_job(self, job_config: Dict):
         job_resp = self.jobs_api.create_job(job_config)
         logger.info(f"Created Job with ID {job_resp['job_id']}")
         return job_resp["job_id"]
 
-    def _run_job(self, job_id: str):
+    def _run_job(self, job_id: str) -> int:
+        self._wait_for_warm_instance_pool()
         resp = self.jobs_api.run_now(
             job_id=job_id,
             jar_params=None,
@@ -210,3 +628,4 @@ class DeployToDatabricks(Step):
             spark_submit_params=None,
         )
         logger.info(f"Created run with ID {resp['run_id']}")
+        return resp["run_id"]
@@ -1,28 +1,40 @@
+import datetime
+import functools
 import json
 import logging
 import os
-from pathlib import Path
-from tempfile import NamedTemporaryFile
-from typing import List, Dict
+from dataclasses import dataclass
+from typing import List, Dict, Optional, Union
 
-import kubernetes
 import voluptuous as vol
+import yaml
 from azure.mgmt.containerservice.container_service_client import ContainerServiceClient
-from azure.mgmt.containerservice.models import CredentialResults
-from kubernetes.client import CoreV1Api
+from kubernetes.client import ApiClient, Configuration, CoreV1Api
+from kubernetes.client.rest import ApiException
+from kubernetes.config.kube_config import KubeConfigLoader
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.active_directory_user import ActiveDirectoryUserCredentials
 from takeoff.azure.credentials.keyvault import KeyVaultClient
 from takeoff.azure.credentials.keyvault_credentials_provider import KeyVaultCredentialsMixin
+from takeoff.azure.credentials.kubeconfig_cache import KubeconfigCache
 from takeoff.azure.credentials.subscription_id import SubscriptionId
+from takeoff.azure.kubernetes_apply import AppliedResource, KubernetesApplier, parse_manifest
+from takeoff.azure.kubernetes_rollout import RolloutTracker
 from takeoff.azure.util import get_resource_group_name, get_kubernetes_name
-from takeoff.context import Context, ContextKey
+from takeoff.context import Context, ContextKey, RunSummary
 from takeoff.credentials.container_registry import DockerRegistry
 from takeoff.credentials.secret import Secret
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
-from takeoff.util import b64_encode, ensure_base64, render_string_with_jinja, run_shell_command
+from takeoff.util import (
+    b64_decode,
+    b64_encode,
+    ensure_base64,
+    render_string_with_jinja,
+    run_concurrently,
+    Lazy,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -41,45 +53,66 @@ class BaseKubernetes(Step):
         super().__init__(env, config)
         self.vault_name, self.vault_client = KeyVaultClient.vault_and_client(self.config, self.env)
 
-    @staticmethod
-    def _write_kube_config(credential_results: CredentialResults):
-        """Creates ~/.kube/config and writes the credentials for the Kubernetes cluster to the file
+    def _authenticate_with_kubernetes(self, cluster_name: Optional[str] = None) -> Configuration:
+        """Authenticate with the defined AKS cluster
+
+        The kubeconfig of the cluster is loaded directly into a client configuration, leaving
+        ~/.kube/config untouched. Kubeconfigs are cached for the duration of the run.
 
         Args:
-            credential_results: the cluster credentials for the cluster
-        """
-        kubeconfig = credential_results.kubeconfigs[0].value.decode(encoding="UTF-8")
+            cluster_name: The cluster to authenticate with. Defaults to the one following `kubernetes_naming`
 
-        kubeconfig_dir = Path(os.environ["HOME"]) / ".kube"
+        Returns:
+            Client configuration for the cluster
+        """
+        resource_group = get_resource_group_name(self.config, self.env)
+        cluster_name = cluster_name or get_kubernetes_name(self.config, self.env)
+        subscription_id = SubscriptionId(self.vault_name, self.vault_client).subscription_id(self.config)
 
-        kubeconfig_dir.mkdir(exist_ok=True)
+        kubeconfig = KubeconfigCache().get(
+            self.config,
+            (subscription_id, resource_group, cluster_name),
+            functools.partial(self._fetch_kubeconfig, subscription_id, resource_group, cluster_name),
+        )
 
-        with open(kubeconfig_dir / "config", "w") as f:
-            f.write(kubeconfig)
+        configuration = Configuration()
+        # Configuration() is a shallow copy of a shared default, give each cluster its own credentials
+        configuration.api_key = {}
+        configuration.api_key_prefix = {}
+        KubeConfigLoader(config_dict=yaml.safe_load(kubeconfig)).load_and_set(configuration)
+        logger.info("Kubeconfig loaded")
+        return configuration
 
-        logger.info("Kubeconfig successfully written")
+    def _fetch_kubeconfig(self, subscription_id: str, resource_group: str, cluster_name: str) -> str:
+        """Fetches the user credentials of the AKS cluster
 
-    def _authenticate_with_kubernetes(self):
-        """Authenticate with the defined AKS cluster and write the configuration to a file"""
-        resource_group = get_resource_group_name(self.config, self.env)
-        cluster_name = get_kubernetes_name(self.config, self.env)
+        Args:
+            subscription_id: The subscription containing the cluster
+            resource_group: The resource group containing the cluster
+            cluster_name: The name of the cluster
 
-        # get azure container service client
+        Returns:
+            The kubeconfig of the cluster, as yaml
+        """
         credentials = ActiveDirectoryUserCredentials(
             vault_name=self.vault_name, vault_client=self.vault_client
         ).credentials(self.config)
+        client = ContainerServiceClient(credentials=credentials, subscription_id=subscription_id)
 
-        client = ContainerServiceClient(
-            credentials=credentials,
-            subscription_id=SubscriptionId(self.vault_name, self.vault_client).subscription_id(self.config),
-        )
-
-        # authenticate with Kubernetes
         credential_results = client.managed_clusters.list_cluster_user_credentials(
             resource_group_name=resource_group, resource_name=cluster_name
         )
+        logger.info(f"Fetched credentials of cluster {cluster_name}")
+        return credential_results.kubeconfigs[0].value.decode(encoding="UTF-8")
 
-        self._write_kube_config(credential_results)
+
+@dataclass(frozen=True)
+class KubernetesCluster(object):
+    """A cluster to deploy to, with the clients connected to it"""
+
+    name: str
+    api_client: ApiClient
+    applier: KubernetesApplier
 
 
 IP_ADDRESS_MATCH = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"
@@ -99,7 +132,30 @@ DEPLOY_SCHEMA = TAKEOFF_BASE_SCHEMA.extend(
             vol.Optional("namespace", default="default"): str,
         },
         vol.Optional("custom_values", default={}): {},
+        vol.Optional(
+            "clusters",
+            default=[],
+            description=(
+                "Naming conventions of the clusters to deploy to, which may include the {env} parameter. "
+                "Defaults to the cluster following kubernetes_naming"
+            ),
+        ): [str],
         vol.Optional("restart_unchanged_resources", default=False): bool,
+        vol.Optional(
+            "max_concurrent_applies",
+            default=8,
+            description="The maximum number of Kubernetes resources applied at the same time",
+        ): vol.All(int, vol.Range(min=1)),
+        vol.Optional(
+            "wait_for_rollout",
+            default=False,
+            description="Whether to wait until all Deployments, StatefulSets and DaemonSets are ready",
+        ): bool,
+        vol.Optional(
+            "rollout_timeout_seconds",
+            default=600,
+            description="The maximum time to wait for all workloads to be ready",
+        ): vol.All(int, vol.Range(min=1)),
         "azure": {
             vol.Required(
                 "kubernetes_naming",
@@ -122,7 +178,6 @@ class DeployToKubernetes(BaseKubernetes):
         super().__init__(env, config)
 
         self.vault_name, self.vault_client = KeyVaultClient.vault_and_client(self.config, self.env)
-        self.core_v1_api = CoreV1Api()
 
     def schema(self) -> vol.Schema:
         return DEPLOY_SCHEMA
@@ -157,7 +212,7 @@ class DeployToKubernetes(BaseKubernetes):
         self,
         kubernetes_config_path: str,
         application_name: str,
-        secrets: Dict[str, str],
+        secrets: Dict[str, Union[str, Lazy]],
         custom_values: Dict[str, str],
     ) -> str:
         kubernetes_config = render_string_with_jinja(
@@ -166,21 +221,14 @@ class DeployToKubernetes(BaseKubernetes):
                 "docker_tag": self.env.artifact_tag,
                 "application_name": application_name,
                 "env": self.env.environment,
-                "build_env": {**os.environ},
+                "build_env": os.environ,
                 **secrets,
                 **custom_values,
             },
         )
         return kubernetes_config
 
-    def _write_kubernetes_config(self, kubernetes_config: str) -> str:
-        rendered_kubernetes_config_path = NamedTemporaryFile(delete=False, mode="w")
-        rendered_kubernetes_config_path.write(kubernetes_config)
-        rendered_kubernetes_config_path.close()
-
-        return rendered_kubernetes_config_path.name
-
-    def _render_and_write_kubernetes_config(
+    def _render_kubernetes_manifest(
         self,
         kubernetes_config_path: str,
         application_name: str,
@@ -188,71 +236,142 @@ class DeployToKubernetes(BaseKubernetes):
         custom_values: Dict[str, str],
     ) -> str:
         """
-        Render the jinja-templated kubernetes configuration adn write it out to a temporary file.
+        Render the jinja-templated kubernetes configuration, including the secrets it uses. The rendered
+        configuration is kept in memory only, so the secrets in it never end up on disk.
         Args:
             kubernetes_config_path: The raw, jinja-templated kubernetes configuration path.
             application_name: Current application name
 
         Returns:
-            The path to the temporary file where the rendered kubernetes configuration is stored.
+            The rendered kubernetes configuration
         """
         vault_values = {_.jinja_safe_key: ensure_base64(_.val) for _ in secrets}
 
+        # Only encode the secrets from the context that are used by the template
         context_values = {
             **{
-                _.jinja_safe_key: ensure_base64(_.val)
+                _.jinja_safe_key: Lazy(functools.partial(ensure_base64, _.val))
                 for _ in Context().get_or_else(ContextKey.EVENTHUB_PRODUCER_POLICY_SECRETS, {})
             },
             **{
-                _.jinja_safe_key: ensure_base64(_.val)
+                _.jinja_safe_key: Lazy(functools.partial(ensure_base64, _.val))
                 for _ in Context().get_or_else(ContextKey.EVENTHUB_CONSUMER_GROUP_SECRETS, {})
             },
         }
 
-        kubernetes_config = self._render_kubernetes_config(
+        return self._render_kubernetes_config(
             kubernetes_config_path, application_name, {**vault_values, **context_values}, custom_values
         )
-        return self._write_kubernetes_config(kubernetes_config)
 
-    def _restart_unchanged_resources(self, file_path: str):
+    @staticmethod
+    def _restart_unchanged_resources(cluster: KubernetesCluster, applied: List[AppliedResource]):
         """
-        Trigger a restart of all restartable resources.
+        Trigger a restart of all restartable resources that were not changed by the deployment. Changed
+        resources are rolled out by Kubernetes already.
 
         Args:
-            output: List of output lines that kubectl produced when apply -f was run
+            cluster: The cluster the resources were applied to
+            applied: The resources that were applied, and whether they changed
         """
-        cmd = ["kubectl", "rollout", "restart", "-f", file_path]
-        run_shell_command(cmd)
-        logger.info("Restarted all possible resources")
+        cluster.applier.restart([_.resource for _ in applied if not _.changed])
+        logger.info("Restarted all unchanged resources")
 
-    def _apply_kubernetes_config_file(self, file_path: str):
+    def _wait_for_rollout(
+        self, cluster: KubernetesCluster, applied: List[AppliedResource], started_at: datetime.datetime
+    ):
+        """Waits until all applied workloads are ready, and adds the time each of them took to the run summary
+
+        Args:
+            cluster: The cluster the resources were applied to
+            applied: The resources that were applied
+            started_at: When the resources started to be applied
+
+        Raises:
+            RolloutError if any of the workloads failed to roll out
+            TimeoutError if not all workloads were ready within `rollout_timeout_seconds`
         """
-        Create/Update the kubernetes resources based on the provided file_path to the configuration. This
-        function assumes that the file does NOT contain any Jinja-templated variables anymore (i.e. it's
-        been rendered)
+        tracker = RolloutTracker(cluster.api_client, timeout_seconds=self.config["rollout_timeout_seconds"])
+        ready_after = tracker.wait([_.resource for _ in applied], started_at)
+        RunSummary().register(
+            f"Kubernetes rollout of {self.application_name} on {cluster.name}",
+            lambda: {name: f"{seconds:.1f}s" for name, seconds in ready_after.items()},
+        )
+
+    @staticmethod
+    def _apply_kubernetes_config(cluster: KubernetesCluster, kubernetes_config: str) -> List[AppliedResource]:
+        """
+        Create/Update the kubernetes resources in the provided configuration. This function assumes that
+        the configuration does NOT contain any Jinja-templated variables anymore (i.e. it's been rendered).
+        The whole configuration is parsed before anything is applied, as resources are applied in phases
+        and workloads are annotated with the hashes of the secrets and config maps they reference.
+
+        Resources without a namespace are applied to the `default` namespace, regardless of the namespace
+        of the current kube context, as some CI runners override it.
 
         Args:
-            file_path: Path to the kubernetes configuration
+            cluster: The cluster to apply the configuration to
+            kubernetes_config: The rendered kubernetes configuration
+
+        Returns:
+            The resources in the configuration, and whether they changed
+
+        Raises:
+            ConcurrentTaskError if any of the resources could not be applied
         """
-        # workaround for some CI runners that override the default k8s namespace
-        cmd = ["kubectl", "config", "set-context", self.cluster_name, "--namespace", "default"]
-        exit_code, _ = run_shell_command(cmd)
-        if exit_code != 0:
-            raise ChildProcessError(f"Couldn't set-context for cluster {self.cluster_name}")
-
-        cmd = ["kubectl", "apply", "-f", file_path]
-        exit_code, response = run_shell_command(cmd)
-        if exit_code != 0:
-            raise ChildProcessError(f"Couldn't apply Kubernetes config from path {file_path}")
-
-    def _create_image_pull_secret(self, application_name: str) -> str:
+        return cluster.applier.apply(parse_manifest(kubernetes_config))
+
+    def _image_pull_secret_is_current(self, cluster: KubernetesCluster, pull_secret: str) -> bool:
+        """Checks whether the image pull secret in the cluster already holds the given registry credentials
+
+        Args:
+            cluster: The cluster to check
+            pull_secret: The desired docker config, base64 encoded
+
+        Returns:
+            True if the `.dockerconfigjson` of the live secret holds the same docker config, regardless of
+            its formatting
+        """
+        try:
+            live_secret = CoreV1Api(cluster.api_client).read_namespaced_secret(
+                self.config["image_pull_secret"]["secret_name"], self.config["image_pull_secret"]["namespace"]
+            )
+        except ApiException as e:
+            if e.status == 404:
+                return False
+            raise
+        live_config = self._decode_docker_config((live_secret.data or {}).get(".dockerconfigjson"))
+        return live_config is not None and live_config == self._decode_docker_config(pull_secret)
+
+    @staticmethod
+    def _decode_docker_config(encoded: Optional[str]) -> Optional[dict]:
+        if not encoded:
+            return None
+        try:
+            return json.loads(b64_decode(encoded))
+        except ValueError:
+            return None
+
+    def _ensure_image_pull_secret(self, cluster: KubernetesCluster, application_name: str, pull_secret: str):
+        """Creates or updates the image pull secret, unless the cluster already has the current credentials
+
+        Args:
+            cluster: The cluster to create the secret in
+            application_name: Current application name
+            pull_secret: The docker config with the current registry credentials
+        """
+        if self._image_pull_secret_is_current(cluster, ensure_base64(pull_secret)):
+            logger.info(f"Docker registry secret is unchanged on {cluster.name}, not applying")
+            return
+        self._apply_kubernetes_config(cluster, self._create_image_pull_secret(application_name, pull_secret))
+
+    def _create_image_pull_secret(self, application_name: str, pull_secret: str) -> str:
         pull_secrets_yaml = os.path.join(
             os.path.dirname(os.path.abspath(__file__)), "assets", "kubernetes_image_pull_secrets.yml.j2"
         )
-        return self._render_and_write_kubernetes_config(
+        return self._render_kubernetes_manifest(
             kubernetes_config_path=pull_secrets_yaml,
             application_name=application_name,
-            secrets=[Secret("pull_secret", self._get_docker_registry_secret())],
+            secrets=[Secret("pull_secret", pull_secret)],
             custom_values={
                 "namespace": Secret("namespace", self.config["image_pull_secret"]["namespace"]).val,
                 "secret_name": Secret("secret_name", self.config["image_pull_secret"]["secret_name"]).val,
@@ -270,23 +389,81 @@ class DeployToKubernetes(BaseKubernetes):
                 )
         return {}
 
+    def _cluster_names(self) -> List[str]:
+        """Returns the names of the clusters to deploy to, following the `clusters` naming conventions if
+        given, or the `kubernetes_naming` convention otherwise
+
+        Each convention in `clusters` is resolved like `kubernetes_naming`, so naming plugins apply to them
+        as well.
+        """
+        if not self.config["clusters"]:
+            return [get_kubernetes_name(self.config, self.env)]
+        azure = self.config["azure"]
+        return [
+            get_kubernetes_name({**self.config, "azure": {**azure, "kubernetes_naming": _}}, self.env)
+            for _ in self.config["clusters"]
+        ]
+
+    def _connect(self, cluster_name: str) -> KubernetesCluster:
+        api_client = ApiClient(self._authenticate_with_kubernetes(cluster_name))
+        return KubernetesCluster(
+            cluster_name,
+            api_client,
+            KubernetesApplier(api_client, max_workers=self.config["max_concurrent_applies"]),
+        )
+
+    def _deploy_to_cluster(
+        self, cluster_name: str, application_name: str, kubernetes_config: str, pull_secret: Optional[str]
+    ) -> List[AppliedResource]:
+        """Deploys the rendered configuration to a single cluster
+
+        Args:
+            cluster_name: The cluster to deploy to
+            application_name: Current application name
+            kubernetes_config: The rendered kubernetes configuration
+            pull_secret: The docker config for the image pull secret, or None if it should not be created
+
+        Returns:
+            The resources in the configuration, and whether they changed
+        """
+        cluster = self._connect(cluster_name)
+
+        if pull_secret is not None:
+            self._ensure_image_pull_secret(cluster, application_name, pull_secret)
+            logger.info(f"Docker registry secret available on {cluster_name}")
+
+        # pods of the new version are created as soon as their workload is applied
+        started_at = datetime.datetime.now(datetime.timezone.utc)
+        applied = self._apply_kubernetes_config(cluster, kubernetes_config)
+        logger.info(f"Applied rendered Kubernetes config to {cluster_name}")
+        RunSummary().register(
+            f"Kubernetes deployment of {application_name} to {cluster_name}",
+            lambda: {"changed": sum(_.changed for _ in applied), "total": len(applied)},
+        )
+
+        if self.config["restart_unchanged_resources"]:
+            self._restart_unchanged_resources(cluster, applied)
+
+        if self.config["wait_for_rollout"]:
+            self._wait_for_rollout(cluster, applied, started_at)
+        return applied
+
     def deploy_to_kubernetes(self, kubernetes_config_path: str, application_name: str):
         """Run a full deployment to Kubernetes, given configuration.
 
+        The configuration is rendered once, and deployed to all clusters concurrently. Every cluster is
+        deployed to, regardless of failures on the other clusters.
+
         Args:
             kubernetes_config_path: path to the jinja-templated kubernetes config
             application_name: current application name
-        """
-        self._authenticate_with_kubernetes()
-
-        # load the kubeconfig we just fetched
-        kubernetes.config.load_kube_config()
-        logger.info("Kubeconfig loaded")
 
+        Raises:
+            ConcurrentTaskError if the deployment to any of the clusters failed
+        """
+        pull_secret = None
         if self.config["image_pull_secret"]["create"]:
-            file_path = self._create_image_pull_secret(application_name)
-            self._apply_kubernetes_config_file(file_path)
-            logger.info("Docker registry secret available")
+            pull_secret = self._get_docker_registry_secret()
 
         secrets = KeyVaultCredentialsMixin(self.vault_name, self.vault_client).get_keyvault_secrets(
             self.application_name
@@ -294,16 +471,19 @@ class DeployToKubernetes(BaseKubernetes):
 
         custom_values = self._get_custom_values()
 
-        rendered_kubernetes_config_path = self._render_and_write_kubernetes_config(
+        kubernetes_config = self._render_kubernetes_manifest(
             kubernetes_config_path, application_name, secrets, custom_values
         )
         logger.info("Kubernetes config rendered")
 
-        self._apply_kubernetes_config_file(rendered_kubernetes_config_path)
-        logger.info("Applied rendered Kubernetes config")
-
-        if self.config["restart_unchanged_resources"]:
-            self._restart_unchanged_resources(rendered_kubernetes_config_path)
+        run_concurrently(
+            {
+                f"deploy to {_}": functools.partial(
+                    self._deploy_to_cluster, _, application_name, kubernetes_config, pull_secret
+                )
+                for _ in self._cluster_names()
+            }
+        )
 
     @property
     def kubernetes_namespace(self):
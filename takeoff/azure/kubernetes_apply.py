@@ -0,0 +1,353 @@
+import base64
+import copy
+import datetime
+import functools
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import threading
+from dataclasses import dataclass
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import yaml
+from kubernetes.client import ApiClient
+from kubernetes.client.rest import ApiException
+
+from takeoff.util import Lazy, TaskResult, run_concurrently
+
+logger = logging.getLogger(__name__)
+
+FIELD_MANAGER = "takeoff"
+# Resources other resources depend on are applied first, in this order, before everything else
+APPLY_PHASES = (("Namespace", "CustomResourceDefinition"), ("Secret", "ConfigMap"))
+RESTARTABLE_KINDS = ("Deployment", "StatefulSet", "DaemonSet")
+RESTARTED_AT_ANNOTATION = "kubectl.kubernetes.io/restartedAt"
+CONFIG_HASH_ANNOTATION = "takeoff.io/config-hash"
+INPUTS_HASH_ANNOTATION = "takeoff.io/inputs-hash"
+# Secret holding the key the configuration hashes are computed with
+HASH_KEY_SECRET = "takeoff-config-hash-key"
+# Keys through which containers reference secrets and config maps in their environment
+REFERENCE_KEYS = (
+    ("Secret", "secretKeyRef"),
+    ("Secret", "secretRef"),
+    ("ConfigMap", "configMapKeyRef"),
+    ("ConfigMap", "configMapRef"),
+)
+
+
+@dataclass(frozen=True)
+class KubernetesResource(object):
+    api_version: str
+    kind: str
+    name: str
+    namespace: Optional[str]
+    body: dict
+
+    @staticmethod
+    def from_dict(document: dict) -> "KubernetesResource":
+        metadata = document.get("metadata", {})
+        return KubernetesResource(
+            document["apiVersion"], document["kind"], metadata["name"], metadata.get("namespace"), document
+        )
+
+    def __str__(self) -> str:
+        return f"{self.kind}/{self.name}"
+
+    @property
+    def config_hash(self) -> Optional[str]:
+        return self.body.get("metadata", {}).get("annotations", {}).get(CONFIG_HASH_ANNOTATION)
+
+
+@dataclass(frozen=True)
+class AppliedResource(object):
+    resource: KubernetesResource
+    changed: bool
+
+
+def _hash(key: bytes, message: str) -> str:
+    return hmac.new(key, message.encode(), hashlib.sha256).hexdigest()
+
+
+def _hash_document(key: bytes, document: dict) -> str:
+    return _hash(key, json.dumps(document, sort_keys=True))
+
+
+def _referenced_inputs(pod_spec: dict) -> Iterator[Tuple[str, str]]:
+    """Finds the secrets and config maps a pod uses, through its environment or volumes"""
+    references = []
+    for container in pod_spec.get("initContainers", []) + pod_spec.get("containers", []):
+        references += [_.get("valueFrom", {}) for _ in container.get("env", [])]
+        references += container.get("envFrom", [])
+    for reference in references:
+        for kind, key in REFERENCE_KEYS:
+            if key in reference:
+                yield kind, reference[key]["name"]
+    for volume in pod_spec.get("volumes", []):
+        if "secret" in volume:
+            yield "Secret", volume["secret"]["secretName"]
+        if "configMap" in volume:
+            yield "ConfigMap", volume["configMap"]["name"]
+
+
+def with_config_hashes(
+    resources: Iterable[KubernetesResource], key: bytes, default_namespace: str = "default"
+) -> List[KubernetesResource]:
+    """Annotates resources with a hash of their rendered configuration
+
+    Workloads are also annotated with a hash of the secrets and config maps they reference from the same
+    manifest. This annotation is part of the pod template, so Kubernetes rolls out exactly those workloads
+    whose inputs changed.
+
+    The hashes are HMACs, so the values of secrets can't be guessed from the annotations by anyone who
+    doesn't have the key.
+
+    Args:
+        resources: The rendered resources
+        key: The key to compute the hashes with
+        default_namespace: Namespace of namespaced resources that don't specify one
+
+    Returns:
+        Copies of the resources, with the hashes in their annotations
+    """
+    resources = list(resources)
+    inputs = {
+        (_.kind, _.namespace or default_namespace, _.name): _hash_document(key, _.body)
+        for _ in resources
+        if _.kind in ("Secret", "ConfigMap")
+    }
+
+    annotated = []
+    for resource in resources:
+        body = copy.deepcopy(resource.body)
+        if resource.kind in RESTARTABLE_KINDS:
+            namespace = resource.namespace or default_namespace
+            template = body.get("spec", {}).get("template", {})
+            references = sorted(set(_referenced_inputs(template.get("spec", {}))))
+            hashes = [
+                inputs[(kind, namespace, name)]
+                for kind, name in references
+                if (kind, namespace, name) in inputs
+            ]
+            if hashes:
+                template_annotations = template.setdefault("metadata", {}).setdefault("annotations", {})
+                template_annotations[INPUTS_HASH_ANNOTATION] = _hash(key, "".join(hashes))
+        annotations = body.setdefault("metadata", {}).setdefault("annotations", {})
+        annotations[CONFIG_HASH_ANNOTATION] = _hash_document(key, body)
+        annotated.append(
+            KubernetesResource(resource.api_version, resource.kind, resource.name, resource.namespace, body)
+        )
+    return annotated
+
+
+def parse_manifest(manifest: str) -> Iterator[KubernetesResource]:
+    """Parses a rendered, possibly multi-document, Kubernetes manifest
+
+    Documents of kind `List` are expanded into their items, empty documents are skipped.
+
+    Args:
+        manifest: The rendered manifest
+
+    Returns:
+        The resources in the manifest, in order of appearance
+    """
+    for document in yaml.safe_load_all(manifest):
+        if not document:
+            continue
+        if document.get("kind") == "List":
+            yield from (KubernetesResource.from_dict(_) for _ in document.get("items", []))
+        else:
+            yield KubernetesResource.from_dict(document)
+
+
+class KubernetesApplier(object):
+    """Applies Kubernetes resources in-process, using server-side apply
+
+    This replaces `kubectl apply -f`: the resource endpoints are discovered once per API group and
+    reused, and resources are applied concurrently. Namespaces and custom resource definitions are
+    applied first, as other resources in the same manifest may depend on them, followed by secrets and
+    config maps, so workloads that roll out pick up their new values.
+
+    Resources are annotated with a hash of their configuration. Resources of which the live version
+    carries the same hash are not applied again. The hashes are computed with a random key, kept in the
+    secret `takeoff-config-hash-key` of the default namespace, so only those who can read secrets can
+    verify them.
+
+    Args:
+        api_client: Client for the Kubernetes cluster, configured with the credentials to use
+        default_namespace: Namespace for namespaced resources that don't specify one
+        max_workers: The maximum number of resources applied at the same time
+    """
+
+    def __init__(self, api_client: ApiClient, default_namespace: str = "default", max_workers: int = 8):
+        self.api_client = api_client
+        self.default_namespace = default_namespace
+        self.max_workers = max_workers
+        self._discovery: Dict[str, Dict[str, Tuple[str, bool]]] = {}
+        self._discovery_lock = threading.Lock()
+        self._hash_key = Lazy(self._load_hash_key)
+
+    def apply(self, resources: Iterable[KubernetesResource]) -> List[AppliedResource]:
+        """Applies all resources that changed, logging the time it took to apply each of them
+
+        Args:
+            resources: The resources to apply
+
+        Returns:
+            All resources, and whether they changed
+
+        Raises:
+            ConcurrentTaskError if any of the resources could not be applied
+        """
+        remaining = with_config_hashes(resources, self._hash_key.get(), self.default_namespace)
+        results = []
+        for kinds in APPLY_PHASES:
+            results += self._apply_concurrently([_ for _ in remaining if _.kind in kinds])
+            remaining = [_ for _ in remaining if _.kind not in kinds]
+        results += self._apply_concurrently(remaining)
+
+        applied = [_.result for _ in results]
+        logger.info(f"Applied {sum(_.changed for _ in applied)} changed resource(s), {len(applied)} in total")
+        return applied
+
+    def apply_resource(self, resource: KubernetesResource) -> AppliedResource:
+        """Creates or updates a single resource, unless the live resource has the same configuration hash
+
+        Args:
+            resource: The resource to apply
+
+        Returns:
+            The resource, and whether it changed
+        """
+        live = self._get(resource)
+        live_hash = KubernetesResource.from_dict(live).config_hash if live else None
+        if live_hash and live_hash == resource.config_hash:
+            logger.info(f"{resource} is unchanged, not applying")
+            return AppliedResource(resource, changed=False)
+
+        self._call(
+            "PATCH",
+            self._resource_path(resource),
+            query_params=[("fieldManager", FIELD_MANAGER), ("force", "true")],
+            content_type="application/apply-patch+yaml",
+            # JSON is valid YAML, and the client passes strings through untouched
+            body=json.dumps(resource.body),
+        )
+        return AppliedResource(resource, changed=True)
+
+    def _load_hash_key(self) -> bytes:
+        """Reads the key the configuration hashes are computed with, creating it when it doesn't exist"""
+        secrets_path = f"/api/v1/namespaces/{self.default_namespace}/secrets"
+        try:
+            return base64.b64decode(self._call("GET", f"{secrets_path}/{HASH_KEY_SECRET}")["data"]["key"])
+        except ApiException as e:
+            if e.status != 404:
+                raise
+
+        key = secrets.token_bytes(32)
+        body = {
+            "apiVersion": "v1",
+            "kind": "Secret",
+            "metadata": {"name": HASH_KEY_SECRET, "namespace": self.default_namespace},
+            "data": {"key": base64.b64encode(key).decode()},
+        }
+        try:
+            self._call("POST", secrets_path, body=body)
+        except ApiException as e:
+            # created by a concurrent deployment in the meantime
+            if e.status != 409:
+                raise
+            return base64.b64decode(self._call("GET", f"{secrets_path}/{HASH_KEY_SECRET}")["data"]["key"])
+        logger.info(f"Created secret {HASH_KEY_SECRET} holding the key for configuration hashes")
+        return key
+
+    def _get(self, resource: KubernetesResource) -> Optional[dict]:
+        try:
+            return self._call("GET", self._resource_path(resource))
+        except ApiException as e:
+            if e.status == 404:
+                return None
+            raise
+
+    def restart(self, resources: Iterable[KubernetesResource]) -> List[TaskResult]:
+        """Restarts the pods of all restartable resources, like `kubectl rollout restart` does
+
+        Args:
+            resources: The resources to restart, resources that can't be restarted are ignored
+
+        Returns:
+            The restarted resources, with the time it took to restart them
+        """
+        restarted_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        patch = {"spec": {"template": {"metadata": {"annotations": {RESTARTED_AT_ANNOTATION: restarted_at}}}}}
+        return run_concurrently(
+            {
+                f"restart {_}": functools.partial(
+                    self._call,
+                    "PATCH",
+                    self._resource_path(_),
+                    content_type="application/strategic-merge-patch+json",
+                    body=patch,
+                )
+                for _ in resources
+                if _.kind in RESTARTABLE_KINDS
+            },
+            max_workers=self.max_workers,
+        )
+
+    def _apply_concurrently(self, resources: List[KubernetesResource]) -> List[TaskResult]:
+        return run_concurrently(
+            {f"apply {_} #{i}": functools.partial(self.apply_resource, _) for i, _ in enumerate(resources)},
+            max_workers=self.max_workers,
+        )
+
+    def _resource_path(self, resource: KubernetesResource) -> str:
+        plural, namespaced = self._discover(resource.api_version, resource.kind)
+        prefix = "/api/v1" if resource.api_version == "v1" else f"/apis/{resource.api_version}"
+        if namespaced:
+            namespace = resource.namespace or self.default_namespace
+            return f"{prefix}/namespaces/{namespace}/{plural}/{resource.name}"
+        return f"{prefix}/{plural}/{resource.name}"
+
+    def _discover(self, api_version: str, kind: str) -> Tuple[str, bool]:
+        """Looks up the endpoint for the given kind, listing the resources of its API group once
+
+        Args:
+            api_version: The API group and version, e.g. `apps/v1`
+            kind: The kind of the resource, e.g. `Deployment`
+
+        Returns:
+            The plural name of the resource, and whether it is namespaced
+        """
+        with self._discovery_lock:
+            if api_version not in self._discovery:
+                path = "/api/v1" if api_version == "v1" else f"/apis/{api_version}"
+                self._discovery[api_version] = {
+                    _["kind"]: (_["name"], _["namespaced"])
+                    for _ in self._call("GET", path)["resources"]
+                    # skip subresources, like deployments/scale
+                    if "/" not in _["name"]
+                }
+            if kind not in self._discovery[api_version]:
+                raise ValueError(f"Kind {kind} is not served by the cluster for apiVersion {api_version}")
+            return self._discovery[api_version][kind]
+
+    def _call(
+        self,
+        method: str,
+        path: str,
+        query_params: Optional[List[Tuple[str, str]]] = None,
+        content_type: str = "application/json",
+        body=None,
+    ) -> dict:
+        return self.api_client.call_api(
+            path,
+            method,
+            query_params=query_params or [],
+            header_params={"Accept": "application/json", "Content-Type": content_type},
+            body=body,
+            response_type="object",
+            auth_settings=["BearerToken"],
+            _return_http_data_only=True,
+        )
@@ -0,0 +1,236 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from kubernetes.client import ApiClient, AppsV1Api, CoreV1Api
+from kubernetes.watch import Watch
+
+from takeoff.azure.kubernetes_apply import RESTARTABLE_KINDS, KubernetesResource
+
+logger = logging.getLogger(__name__)
+
+# Waiting reasons of a container that will not resolve by waiting longer
+FAILED_CONTAINER_REASONS = (
+    "CrashLoopBackOff",
+    "ImagePullBackOff",
+    "ErrImagePull",
+    "InvalidImageName",
+    "CreateContainerConfigError",
+)
+
+
+class RolloutError(Exception):
+    """Raised when a workload can not become ready"""
+
+
+def _status(workload: dict, field: str) -> int:
+    return workload.get("status", {}).get(field) or 0
+
+
+def rollout_failure(kind: str, workload: dict) -> Optional[str]:
+    """Checks whether the rollout of a workload failed permanently
+
+    Args:
+        kind: The kind of the workload
+        workload: The workload, as returned by the API server
+
+    Returns:
+        The reason the rollout failed, or None if it did not fail
+    """
+    if kind != "Deployment":
+        return None
+    for condition in workload.get("status", {}).get("conditions") or []:
+        if condition.get("type") == "Progressing" and condition.get("reason") == "ProgressDeadlineExceeded":
+            return condition.get("message", "progress deadline exceeded")
+    return None
+
+
+def is_ready(kind: str, workload: dict) -> bool:
+    """Checks whether a workload is fully rolled out, following the same rules as `kubectl rollout status`
+
+    Args:
+        kind: The kind of the workload, one of Deployment, StatefulSet or DaemonSet
+        workload: The workload, as returned by the API server
+
+    Returns:
+        True if all replicas run the latest version and are available
+    """
+    metadata, spec = workload.get("metadata", {}), workload.get("spec", {})
+    if _status(workload, "observedGeneration") < (metadata.get("generation") or 0):
+        return False
+
+    if kind == "Deployment":
+        desired = spec.get("replicas", 1)
+        updated = _status(workload, "updatedReplicas")
+        return all(
+            [
+                updated >= desired,
+                _status(workload, "replicas") == updated,
+                _status(workload, "availableReplicas") >= updated,
+            ]
+        )
+    if kind == "StatefulSet":
+        status = workload.get("status", {})
+        revision_done = status.get("updateRevision") == status.get("currentRevision")
+        return revision_done and _status(workload, "readyReplicas") >= spec.get("replicas", 1)
+    desired = _status(workload, "desiredNumberScheduled")
+    return all(
+        [
+            _status(workload, "updatedNumberScheduled") >= desired,
+            _status(workload, "numberAvailable") >= desired,
+        ]
+    )
+
+
+def _selector(resource: KubernetesResource) -> Dict[str, str]:
+    spec = resource.body.get("spec", {})
+    labels = spec.get("selector", {}).get("matchLabels")
+    # Older API versions default the selector to the labels of the pod template
+    return labels or spec.get("template", {}).get("metadata", {}).get("labels", {})
+
+
+class RolloutTracker(object):
+    """Waits for workloads to be rolled out, using the watch API
+
+    One watch per kind and namespace, plus one on the pods of each namespace, feed a single stream of
+    events. Tracking ends as soon as all workloads are ready, or fails as soon as any of the workloads
+    fails, for example because pods created during the rollout are crash looping.
+
+    Args:
+        api_client: Client for the Kubernetes cluster, configured with the credentials to use
+        default_namespace: Namespace of workloads that don't specify one
+        timeout_seconds: The maximum time to wait for all workloads together
+    """
+
+    def __init__(self, api_client: ApiClient, default_namespace: str = "default", timeout_seconds: int = 600):
+        self.default_namespace = default_namespace
+        self.timeout_seconds = timeout_seconds
+        apps_api = AppsV1Api(api_client)
+        self._list_functions = {
+            "Deployment": apps_api.list_namespaced_deployment,
+            "StatefulSet": apps_api.list_namespaced_stateful_set,
+            "DaemonSet": apps_api.list_namespaced_daemon_set,
+            "Pod": CoreV1Api(api_client).list_namespaced_pod,
+        }
+
+    def wait(
+        self, resources: List[KubernetesResource], started_at: Optional[datetime.datetime] = None
+    ) -> Dict[str, float]:
+        """Waits until all workloads among the given resources are ready
+
+        Args:
+            resources: The applied resources, resources that aren't workloads are ignored
+            started_at: When the rollout started, before the resources were applied. Failing pods created
+                before then are ignored, as they may belong to a previous, broken, version. Defaults to now
+
+        Returns:
+            The number of seconds it took for each workload to become ready
+
+        Raises:
+            RolloutError if any of the workloads failed to roll out
+            TimeoutError if not all workloads were ready within the timeout
+        """
+        pending = {
+            (_.kind, _.namespace or self.default_namespace, _.name): _
+            for _ in resources
+            if _.kind in RESTARTABLE_KINDS
+        }
+        if not pending:
+            return {}
+
+        started = time.monotonic()
+        deadline = started + self.timeout_seconds
+        # creation timestamps of pods have a resolution of seconds
+        started_at = (started_at or datetime.datetime.now(datetime.timezone.utc)).replace(microsecond=0)
+        events: queue.Queue = queue.Queue()
+        watches = self._start_watches(events, {(kind, namespace) for kind, namespace, _ in pending})
+
+        ready_after = {}
+        try:
+            while pending:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(
+                        f"Timed out waiting for the rollout of {', '.join(str(_) for _ in pending.values())}"
+                    )
+                try:
+                    kind, obj = events.get(timeout=remaining)
+                except queue.Empty:
+                    continue
+                if isinstance(obj, Exception):
+                    raise obj
+                if kind == "Pod":
+                    self._check_pod(obj, pending, started_at)
+                    continue
+
+                resource = self._check_workload(kind, obj, pending)
+                if resource:
+                    ready_after[str(resource)] = time.monotonic() - started
+                    logger.info(f"{resource} is ready after {ready_after[str(resource)]:.1f}s")
+        finally:
+            for watch in watches:
+                watch.stop()
+        return ready_after
+
+    def _start_watches(self, events: queue.Queue, kinds: set) -> List[Watch]:
+        namespaces = {namespace for _, namespace in kinds}
+        watches = []
+        for kind, namespace in sorted(kinds) + [("Pod", _) for _ in sorted(namespaces)]:
+            watch = Watch()
+            thread = threading.Thread(target=self._watch, args=(watch, events, kind, namespace), daemon=True)
+            thread.start()
+            watches.append(watch)
+        return watches
+
+    def _watch(self, watch: Watch, events: queue.Queue, kind: str, namespace: str):
+        try:
+            for event in watch.stream(
+                self._list_functions[kind], namespace, timeout_seconds=self.timeout_seconds
+            ):
+                if event["type"] in ("ADDED", "MODIFIED"):
+                    events.put((kind, event["raw_object"]))
+        except Exception as e:
+            events.put((kind, e))
+
+    @staticmethod
+    def _check_workload(
+        kind: str, workload: dict, pending: Dict[Tuple[str, str, str], KubernetesResource]
+    ) -> Optional[KubernetesResource]:
+        """Removes the workload from the pending workloads once it is ready
+
+        Returns:
+            The workload if it became ready, None otherwise
+        """
+        key = (kind, workload["metadata"]["namespace"], workload["metadata"]["name"])
+        if key not in pending:
+            return None
+        failure = rollout_failure(kind, workload)
+        if failure:
+            raise RolloutError(f"Rollout of {pending[key]} failed: {failure}")
+        return pending.pop(key) if is_ready(kind, workload) else None
+
+    @staticmethod
+    def _check_pod(
+        pod: dict, pending: Dict[Tuple[str, str, str], KubernetesResource], started_at: datetime.datetime
+    ):
+        metadata = pod["metadata"]
+        created = datetime.datetime.strptime(metadata["creationTimestamp"], "%Y-%m-%dT%H:%M:%SZ")
+        if created.replace(tzinfo=datetime.timezone.utc) < started_at:
+            return
+
+        statuses = pod.get("status", {}).get("containerStatuses") or []
+        reasons = [(_.get("state") or {}).get("waiting", {}).get("reason") for _ in statuses]
+        failures = [_ for _ in reasons if _ in FAILED_CONTAINER_REASONS]
+        if not failures:
+            return
+
+        labels = metadata.get("labels") or {}
+        for (_, namespace, _), resource in pending.items():
+            selector = _selector(resource)
+            if namespace == metadata["namespace"] and selector and selector.items() <= labels.items():
+                raise RolloutError(
+                    f"Rollout of {resource} failed: pod {metadata['name']} is in {failures[0]}"
+                )
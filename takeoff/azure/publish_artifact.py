@@ -1,20 +1,64 @@
+import base64
+import functools
 import glob
+import hashlib
 import logging
+import os
+import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional
 
+
+import requests
 import voluptuous as vol
 from azure.storage.blob import BlockBlobService
+from databricks_cli.sdk import DbfsService
 from twine.commands.upload import upload
+from twine.settings import Settings
+from twine.utils import DEFAULT_REPOSITORY, TEST_REPOSITORY
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.credentials.artifact_store import ArtifactStore
+from takeoff.azure.credentials.databricks import Databricks
 from takeoff.azure.credentials.keyvault import KeyVaultClient
 from takeoff.azure.credentials.storage_account import BlobStore
 from takeoff.schemas import TAKEOFF_BASE_SCHEMA
 from takeoff.step import Step
-from takeoff.util import get_tag, get_whl_name, get_main_py_name, get_jar_name, run_shell_command
+from takeoff.util import (
+    get_tag,
+    get_whl_name,
+    get_main_py_name,
+    get_jar_name,
+    run_shell_command,
+    run_concurrently,
+)
 
 logger = logging.getLogger(__name__)
 
+# The maximum size of a single block added to a DBFS file
+DBFS_BLOCK_SIZE = 1024 * 1024
+# The number of blocks read and encoded ahead of their upload
+DBFS_PREFETCH_BLOCKS = 4
+DBFS_HASH_SUFFIX = ".sha256"
+# The simple API of indexes of which the upload url differs from the index url
+SIMPLE_INDEX_URLS = {
+    DEFAULT_REPOSITORY: "https://pypi.org/simple",
+    TEST_REPOSITORY: "https://test.pypi.org/simple",
+}
+
+
+def _project_name(dist: str) -> str:
+    """Normalized project name of a wheel or sdist as used by the simple API (PEP 503)"""
+    filename = os.path.basename(dist)
+    if filename.endswith(".whl"):
+        # hyphens in the project name of a wheel are escaped, the name is everything up to the first one
+        name = filename.split("-")[0]
+    else:
+        # sdists are named {name}-{version}, where the name may contain hyphens but the version can't
+        name = filename.rsplit("-", 1)[0]
+    return re.sub(r"[-_.]+", "-", name).lower()
+
 
 def language_must_match_target(fields):
     """Checks if incompatible lang/targets are used.
@@ -28,6 +72,12 @@ def language_must_match_target(fields):
     return fields
 
 
+def dbfs_target_needs_path(fields):
+    if "dbfs" in fields["target"] and "dbfs_path" not in fields:
+        raise vol.Invalid("Publishing to dbfs requires a dbfs_path")
+    return fields
+
+
 SCHEMA = vol.All(
     TAKEOFF_BASE_SCHEMA,
     vol.Schema(
@@ -38,7 +88,7 @@ SCHEMA = vol.All(
                     str, vol.In(["python", "scala"])
                 ),
                 vol.Required("target", description="List of targets to publish the artifact to"): vol.All(
-                    [str, vol.In(["cloud_storage", "pypi", "ivy"])]
+                    [str, vol.In(["cloud_storage", "pypi", "ivy", "dbfs"])]
                 ),
                 vol.Optional(
                     "python_file_path",
@@ -47,6 +97,18 @@ SCHEMA = vol.All(
                         "that serves as entrypoint for a databricks job"
                     ),
                 ): str,
+                vol.Optional(
+                    "pypi_index_url",
+                    description=(
+                        "The url of the simple API of the PyPi index. Defaults to the simple API of "
+                        "PyPi or TestPyPi when uploading there, otherwise to the repository url of the "
+                        "artifact store, postfixed with /simple"
+                    ),
+                ): str,
+                vol.Optional(
+                    "dbfs_path",
+                    description="The DBFS directory to upload the artifact to, e.g. dbfs:/libraries",
+                ): str,
                 "azure": vol.All(
                     {
                         "common": {
@@ -59,6 +121,7 @@ SCHEMA = vol.All(
                 ),
             },
             language_must_match_target,
+            dbfs_target_needs_path,
         ),
         extra=vol.ALLOW_EXTRA,
     ),
@@ -120,30 +183,54 @@ class PublishArtifact(Step):
         return wheels[0]
 
     def publish_python_package(self):
-        """Publishes the Python wheel to all specified targets"""
-        for target in self.config["target"]:
-            if target == "pypi":
-                self.publish_to_pypi()
-            elif target == "cloud_storage":
-                self.upload_to_cloud_storage(file=self._get_wheel(), file_extension=".whl")
-                # only upload a py file if the path has been specified
-                if "python_file_path" in self.config.keys():
-                    self.upload_to_cloud_storage(
-                        file=f"{self.config['python_file_path']}", file_extension=".py"
-                    )
-            else:
-                logging.info("Invalid target for artifact")
+        """Publishes the Python wheel to all specified targets concurrently"""
+        publishers = {
+            "pypi": self.publish_to_pypi,
+            "cloud_storage": self._upload_python_to_cloud_storage,
+            "dbfs": self._upload_python_to_dbfs,
+        }
+        self._publish_to_targets(publishers)
 
     def publish_jvm_package(self):
-        """Publishes the jar to all specified targets"""
+        """Publishes the jar to all specified targets concurrently"""
+        publishers = {
+            "cloud_storage": self._upload_jvm_to_cloud_storage,
+            "ivy": self.publish_to_ivy,
+            "dbfs": self._upload_jvm_to_dbfs,
+        }
+        self._publish_to_targets(publishers)
+
+    def _publish_to_targets(self, publishers: Dict[str, Callable[[], Any]]):
+        """Runs the publisher of every configured target concurrently.
+
+        A failing target does not interrupt the other targets. Once all targets are done,
+        a single error is raised containing all failed targets.
+
+        Args:
+            publishers: Mapping of target to the function publishing to that target
+
+        Raises:
+            ConcurrentTaskError if publishing to any of the targets failed
+        """
+        tasks = {}
         for target in self.config["target"]:
-            if target == "cloud_storage":
-                self.upload_to_cloud_storage(file=self._get_jar(), file_extension=".jar")
-            elif target == "ivy":
-                self.publish_to_ivy()
+            if target in publishers:
+                tasks[target] = publishers[target]
             else:
                 logging.info("Invalid target for artifact")
 
+        for result in run_concurrently(tasks):
+            logger.info(f"Published artifact to {result.name} in {result.duration:.1f}s")
+
+    def _upload_python_to_cloud_storage(self):
+        self.upload_to_cloud_storage(file=self._get_wheel(), file_extension=".whl")
+        # only upload a py file if the path has been specified
+        if "python_file_path" in self.config.keys():
+            self.upload_to_cloud_storage(file=f"{self.config['python_file_path']}", file_extension=".py")
+
+    def _upload_jvm_to_cloud_storage(self):
+        self.upload_to_cloud_storage(file=self._get_jar(), file_extension=".jar")
+
     def upload_to_cloud_storage(self, file: str, file_extension: str):
         """
         Args:
@@ -154,18 +241,24 @@ class PublishArtifact(Step):
             ValueError if the filetype is not supported.
         """
         blob_service = BlobStore(self.vault_name, self.vault_client).service_client(self.config)
+        filename = self._artifact_name(file_extension)
+        self._upload_file_to_azure_storage_account(blob_service, file, filename)
+
+    def _artifact_name(self, file_extension: str) -> str:
+        """The name of the artifact in storage, given default naming conventions
 
+        Raises:
+            ValueError if the filetype is not supported.
+        """
         if file_extension == ".py":
-            filename = get_main_py_name(self.application_name, self.env.artifact_tag, file_extension)
+            return get_main_py_name(self.application_name, self.env.artifact_tag, file_extension)
         elif file_extension == ".whl":
-            filename = get_whl_name(self.application_name, self.env.artifact_tag, file_extension)
+            return get_whl_name(self.application_name, self.env.artifact_tag, file_extension)
         elif file_extension == ".jar":
-            filename = get_jar_name(self.application_name, self.env.artifact_tag, file_extension)
+            return get_jar_name(self.application_name, self.env.artifact_tag, file_extension)
         else:
             raise ValueError(f"Unsupported filetype extension: {file_extension}")
 
-        self._upload_file_to_azure_storage_account(blob_service, file, filename)
-
     def _upload_file_to_azure_storage_account(
         self, client: BlockBlobService, source: str, destination: str, container: str = None
     ):
@@ -189,16 +282,230 @@ class PublishArtifact(Step):
 
         client.create_blob_from_path(container_name=container, blob_name=destination, file_path=source)
 
+    def _upload_python_to_dbfs(self):
+        files = {self._get_wheel(): ".whl"}
+        if "python_file_path" in self.config.keys():
+            files[self.config["python_file_path"]] = ".py"
+        self.upload_to_dbfs(files)
+
+    def _upload_jvm_to_dbfs(self):
+        self.upload_to_dbfs({self._get_jar(): ".jar"})
+
+    def upload_to_dbfs(self, files: Dict[str, str]):
+        """Uploads files concurrently to `dbfs_path`, using the same names as in cloud storage
+
+        Args:
+            files: Mapping of file to its extension, prefixed with `.`
+        """
+        dbfs = DbfsService(Databricks(self.vault_name, self.vault_client).api_client(self.config))
+        dbfs_path = self.config["dbfs_path"].rstrip("/")
+        run_concurrently(
+            {
+                source: functools.partial(
+                    self._upload_file_to_dbfs, dbfs, source, f"{dbfs_path}/{self._artifact_name(extension)}"
+                )
+                for source, extension in files.items()
+            }
+        )
+
+    def _upload_file_to_dbfs(self, dbfs: DbfsService, source: str, destination: str):
+        """Streams a file to DBFS in blocks, unless the same file is present already
+
+        DBFS doesn't provide hashes of files, so the sha256 hash of the file is uploaded next to it, once the
+        file is complete. If the upload fails, the partially uploaded file is removed.
+
+        Args:
+            dbfs: DBFS client
+            source: Path of the file
+            destination: DBFS path to upload the file to
+        """
+        sha256 = hashlib.sha256()
+        with open(source, "rb") as f:
+            for block in iter(functools.partial(f.read, DBFS_BLOCK_SIZE), b""):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        if self._dbfs_file_matches(dbfs, destination, os.path.getsize(source), digest):
+            logger.info(f"{destination} is up to date, skipping")
+            return
+
+        logger.info(f"Uploading {source} to {destination}")
+        handle = dbfs.create(destination, overwrite=True)["handle"]
+        try:
+            for block in self._encoded_blocks(source):
+                dbfs.add_block(handle, block)
+        except Exception:
+            try:
+                dbfs.close(handle)
+                dbfs.delete(destination)
+            except requests.exceptions.RequestException:
+                logger.warning(f"Could not remove the partial upload at {destination}")
+            raise
+        dbfs.close(handle)
+        encoded_digest = base64.b64encode(digest.encode()).decode()
+        dbfs.put(f"{destination}{DBFS_HASH_SUFFIX}", contents=encoded_digest, overwrite=True)
+
+    @staticmethod
+    def _dbfs_file_matches(dbfs: DbfsService, path: str, size: int, digest: str) -> bool:
+        """Whether the file at the DBFS path has the given size and sha256 hash"""
+
+        def _status(status_path: str) -> Optional[dict]:
+            try:
+                return dbfs.get_status(status_path)
+            except requests.exceptions.HTTPError as e:
+                if e.response is not None and e.response.status_code == 404:
+                    return None
+                raise
+
+        status = _status(path)
+        if status is None or status.get("file_size") != size or not _status(f"{path}{DBFS_HASH_SUFFIX}"):
+            return False
+        published_digest = base64.b64decode(dbfs.read(f"{path}{DBFS_HASH_SUFFIX}")["data"]).decode()
+        return published_digest == digest
+
+    @staticmethod
+    def _encoded_blocks(path: str) -> Iterator[str]:
+        """Reads and base64 encodes the blocks of a file on a thread pool, ahead of their upload
+
+        At most `DBFS_PREFETCH_BLOCKS` blocks are kept in memory, besides the one being uploaded.
+        """
+
+        def _encode(offset: int) -> str:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                return base64.b64encode(f.read(DBFS_BLOCK_SIZE)).decode()
+
+        with ThreadPoolExecutor(max_workers=DBFS_PREFETCH_BLOCKS) as executor:
+            pending: deque = deque()
+            for offset in range(0, os.path.getsize(path), DBFS_BLOCK_SIZE):
+                pending.append(executor.submit(_encode, offset))
+                if len(pending) > DBFS_PREFETCH_BLOCKS:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
     def publish_to_pypi(self):
-        """Uses `twine` to upload to PyPi"""
+        """Uses `twine` to upload all distributions in dist/ to PyPi
+
+        The simple API of the index is queried once per project. Distributions that are already present
+        with a matching sha256 hash are skipped, the remaining distributions are uploaded concurrently.
+
+        Raises:
+            ValueError if a distribution is already present on the index with a different hash, or if the
+            index can not be found
+        """
         if get_tag():
             credentials = ArtifactStore(
                 vault_name=self.vault_name, vault_client=self.vault_client
             ).store_settings(self.config)
-            upload(upload_settings=credentials, dists=["dist/*"])
+
+            dists = self._get_distributions()
+            index_url = self._get_index_url(credentials)
+            published = {
+                project: self._published_distributions(credentials, index_url, project)
+                for project in set(_project_name(_) for _ in dists)
+            }
+            new_dists = [_ for _ in dists if not self._is_published(_, published[_project_name(_)])]
+
+            logger.info(f"Uploading {new_dists} to PyPi, {len(dists) - len(new_dists)} already published")
+            uploads = {
+                os.path.basename(_): functools.partial(upload, credentials, self._with_signature(_))
+                for _ in new_dists
+            }
+            run_concurrently(uploads)
         else:
             logging.info("Not on a release tag, not publishing artifact on PyPi.")
 
+    @staticmethod
+    def _get_distributions() -> List[str]:
+        """Finds all distributions in the dist/ folder, leaving out their signatures
+
+        Raises:
+            FileNotFoundError if no distributions are present.
+        """
+        dists = sorted(_ for _ in glob.glob("dist/*") if not _.endswith(".asc"))
+        if not dists:
+            raise FileNotFoundError("No distributions found in dist/")
+        return dists
+
+    @staticmethod
+    def _with_signature(dist: str) -> List[str]:
+        """The distribution, followed by its signature if it has been signed
+
+        Twine attaches the signature to the upload of the distribution it belongs to.
+        """
+        signature = f"{dist}.asc"
+        return [dist, signature] if os.path.isfile(signature) else [dist]
+
+    def _get_index_url(self, credentials: Settings) -> str:
+        """The simple API url of the index
+
+        Defaults to the simple API of PyPi or TestPyPi when uploading there, and to `<repository_url>/simple`
+        otherwise.
+
+        Raises:
+            ValueError if the index can not be found at the url
+        """
+        repository = credentials.repository_config["repository"]
+        if "pypi_index_url" in self.config:
+            index_url = self.config["pypi_index_url"].rstrip("/")
+        elif repository in SIMPLE_INDEX_URLS:
+            index_url = SIMPLE_INDEX_URLS[repository]
+        else:
+            index_url = f"{repository.rstrip('/')}/simple"
+
+        response = requests.head(
+            f"{index_url}/",
+            auth=(credentials.username, credentials.password),
+            allow_redirects=True,
+            timeout=60,
+        )
+        if response.status_code == 404:
+            raise ValueError(
+                f"No PyPi index found at {index_url} for repository {repository}, "
+                "please provide the url of its simple API as pypi_index_url"
+            )
+        response.raise_for_status()
+        return index_url
+
+    @staticmethod
+    def _published_distributions(credentials: Settings, index_url: str, project: str) -> Dict[str, str]:
+        """Lists the distributions of a project present on the index using the simple API (PEP 503)
+
+        Args:
+            credentials: Settings containing the credentials for the index
+            index_url: The url of the simple API of the index
+            project: The normalized name of the project
+
+        Returns:
+            Mapping of filename to sha256 hash. The hash is empty if the index doesn't provide one.
+        """
+        response = requests.get(
+            f"{index_url}/{project}/", auth=(credentials.username, credentials.password), timeout=60
+        )
+        if response.status_code == 404:
+            return {}
+        response.raise_for_status()
+
+        published = {}
+        for url in re.findall(r'href="([^"]+)"', response.text):
+            path, _, fragment = url.partition("#")
+            algorithm, _, digest = fragment.partition("=")
+            published[path.split("/")[-1]] = digest if algorithm == "sha256" else ""
+        return published
+
+    @staticmethod
+    def _is_published(dist: str, published: Dict[str, str]) -> bool:
+        filename = os.path.basename(dist)
+        if filename not in published:
+            return False
+
+        with open(dist, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()
+        if published[filename] not in {"", digest}:
+            raise ValueError(f"{filename} has already been published with a different hash")
+        logger.info(f"{filename} has already been published, skipping")
+        return True
+
     def publish_to_ivy(self):
         """Uses `sbt` to upload to Ivy.
 
@@ -1,6 +1,6 @@
 import logging
 from enum import Enum, auto, unique
-from typing import Any, Dict
+from typing import Any, Callable, Dict
 
 logger = logging.getLogger(__name__)
 
@@ -92,3 +92,42 @@ class Context(metaclass=Singleton):
             True if the key exists, false otherwise
         """
         return key in self.__data
+
+
+class RunSummary(metaclass=Singleton):
+    """Collects statistics of a run, which are logged once all steps are done
+
+    Components register a function returning their statistics, so the statistics reflect the
+    state at the end of the run.
+    """
+
+    def __init__(self):
+        self.__providers: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+    def register(self, name: str, provider: Callable[[], Dict[str, Any]]) -> "RunSummary":
+        """Registers statistics to include in the summary. Registering a name again replaces it
+
+        Args:
+            name: Description of the statistics
+            provider: Function returning the statistics, indexed on their name
+
+        Returns:
+            Updated RunSummary
+        """
+        self.__providers[name] = provider
+        return self
+
+    def clear(self) -> "RunSummary":
+        """Clears all registered statistics
+
+        Returns:
+            Empty RunSummary
+        """
+        self.__providers = {}
+        return self
+
+    def log(self):
+        """Logs all registered statistics"""
+        for name, provider in self.__providers.items():
+            statistics = ", ".join(f"{k}: {v}" for k, v in provider().items())
+            logger.info(f"{name}: {statistics}")
@@ -2,6 +2,7 @@ import logging
 from typing import Callable, List
 
 from takeoff.application_version import ApplicationVersion
+from takeoff.context import RunSummary
 from takeoff.credentials.branch_name import BranchName
 from takeoff.util import get_tag, get_short_hash, get_full_yaml_filename, load_yaml, load_takeoff_plugins
 
@@ -76,12 +77,15 @@ def main(takeoff_dir: str = ".takeoff"):
     env = get_environment(config)
     logger.info(f"Running Takeoff with application version: {env}")
 
-    for task_config in deployment["steps"]:
-        task = task_config["task"]
-        logger.info("*" * 76)
-        logger.info("{:10s} {:13s} {:40s} {:10s}".format("*" * 10, "RUNNING TASK:", task, "*" * 10))
-        logger.info("*" * 76)
-        run_task(env, task, {**task_config, **config})
+    try:
+        for task_config in deployment["steps"]:
+            task = task_config["task"]
+            logger.info("*" * 76)
+            logger.info("{:10s} {:13s} {:40s} {:10s}".format("*" * 10, "RUNNING TASK:", task, "*" * 10))
+            logger.info("*" * 76)
+            run_task(env, task, {**task_config, **config})
+    finally:
+        RunSummary().log()
 
 
 def run_task(env: ApplicationVersion, task: str, task_config: dict):
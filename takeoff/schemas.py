@@ -92,6 +92,27 @@ CI_KEYS_SCHEMA = {
     ),
 }
 
+AZURE_TOKEN_CACHE = {
+    vol.Optional("path", default=".takeoff_token_cache"): str,
+    vol.Required(
+        "encryption_key",
+        description="Name of the environment variable containing the key to encrypt the token cache with",
+    ): str,
+}
+
+AZURE_KUBECONFIG_CACHE = {
+    vol.Optional("path", default=".takeoff_kubeconfig_cache"): str,
+    vol.Required(
+        "encryption_key",
+        description="Name of the environment variable containing the key to encrypt the kubeconfigs with",
+    ): str,
+    vol.Optional(
+        "max_age_seconds",
+        default=3600,
+        description="How long a kubeconfig is reused at most, even if its credentials are valid longer",
+    ): vol.All(int, vol.Range(min=0)),
+}
+
 AZURE_COMMON = {vol.Optional("artifacts_shared_storage_account_container_name", default="libraries"): str}
 
 AZURE_SCHEMA = {
@@ -114,6 +135,8 @@ AZURE_SCHEMA = {
     vol.Optional("location", default="west europe"): str,
     vol.Optional("keyvault_keys"): AZURE_KEYVAULT_KEYS_SCHEMA,
     vol.Optional("common"): AZURE_COMMON,
+    vol.Optional("token_cache"): AZURE_TOKEN_CACHE,
+    vol.Optional("kubeconfig_cache"): AZURE_KUBECONFIG_CACHE,
 }
 
 COMMON_SCHEMA = {vol.Optional("databricks_fs_libraries_mount_path"): str}
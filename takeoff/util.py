@@ -4,17 +4,24 @@ import logging
 import os
 import pkgutil
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
 from dataclasses import dataclass
-from typing import Callable, List, Pattern, Union, Tuple, Optional, Any
+from typing import Callable, Dict, Iterator, List, Mapping, Pattern, Union, Tuple, Optional, Any
 
 import jinja2
 from git import Repo
 from yaml import load, SafeLoader
 
+from takeoff.context import Singleton
+
 logger = logging.getLogger(__name__)
 
 
 DEFAULT_TAKEOFF_PLUGIN_PREFIX = "takeoff_"
+JINJA_BYTECODE_CACHE_ENV = "TAKEOFF_JINJA_BYTECODE_CACHE"
 
 
 @dataclass(frozen=True)
@@ -24,7 +31,293 @@ class AzureSp(object):
     password: str
 
 
-def render_string_with_jinja(path: str, params: dict) -> str:
+@dataclass(frozen=True)
+class TaskResult(object):
+    name: str
+    duration: float
+    result: Any = None
+    exception: Optional[BaseException] = None
+
+
+class ConcurrentTaskError(Exception):
+    """Raised when one or more tasks run by `run_concurrently` failed"""
+
+    def __init__(self, failures: List[TaskResult]):
+        self.failures = failures
+        super().__init__(
+            "The following tasks failed: " + ", ".join(f"{_.name} ({_.exception!r})" for _ in failures)
+        )
+
+
+class _LogBuffer(logging.Filter):
+    """Holds back the log records of capturing threads, to emit them as one block later
+
+    Installed as a filter on the handlers of the root logger. A record passes every handler, so it is
+    only buffered the first time.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._lock = threading.Lock()
+        self._replay_lock = threading.Lock()
+        self._buffers: Dict[int, List[logging.LogRecord]] = {}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        with self._lock:
+            buffer = self._buffers.get(record.thread)
+            if buffer is None:
+                return True
+            if not buffer or buffer[-1] is not record:
+                buffer.append(record)
+            return False
+
+    @contextmanager
+    def capture(self):
+        ident = threading.get_ident()
+        with self._lock:
+            self._buffers[ident] = []
+        try:
+            yield
+        finally:
+            with self._lock:
+                records = self._buffers.pop(ident)
+            # Keep the blocks of tasks finishing at the same time apart
+            with self._replay_lock:
+                for record in records:
+                    logging.getLogger(record.name).handle(record)
+
+
+@contextmanager
+def _buffered_logs():
+    log_buffer = _LogBuffer()
+    handlers = list(logging.getLogger().handlers)
+    for handler in handlers:
+        handler.addFilter(log_buffer)
+    try:
+        yield log_buffer
+    finally:
+        for handler in handlers:
+            handler.removeFilter(log_buffer)
+
+
+class _LogPrefix(logging.Filter):
+    """Prefixes the log records of threads running a task with the name of that task
+
+    Installed as a filter on the handlers of the root logger while any tasks with prefixed logs run.
+    Handlers filter in the thread that logs, so the prefix of the current thread applies. A record
+    passes every handler, so it is only prefixed the first time.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.local = threading.local()
+        self._lock = threading.Lock()
+        self._users = 0
+        self._handlers: List[logging.Handler] = []
+
+    @property
+    def prefix(self) -> Optional[str]:
+        return getattr(self.local, "prefix", None)
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.prefix and not getattr(record, "task_prefixed", False):
+            record.msg = f"[{self.prefix}] {record.getMessage()}"
+            record.args = ()
+            record.task_prefixed = True
+        return True
+
+    @contextmanager
+    def running(self, name: str, parent_prefix: Optional[str], prefix_logs: bool):
+        """Sets the prefix of the current thread while it runs the named task"""
+        if prefix_logs:
+            self.local.prefix = f"{parent_prefix} / {name}" if parent_prefix else name
+        else:
+            self.local.prefix = parent_prefix
+        try:
+            yield
+        finally:
+            self.local.prefix = None
+
+    @contextmanager
+    def installed(self):
+        with self._lock:
+            if not self._users:
+                self._handlers = list(logging.getLogger().handlers)
+                for handler in self._handlers:
+                    handler.addFilter(self)
+            self._users += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._users -= 1
+                if not self._users:
+                    for handler in self._handlers:
+                        handler.removeFilter(self)
+
+
+_LOG_PREFIX = _LogPrefix()
+
+
+def run_concurrently(
+    tasks: Dict[str, Callable[[], Any]],
+    max_workers: Optional[int] = None,
+    buffer_logs: bool = False,
+    prefix_logs: bool = False,
+) -> List[TaskResult]:
+    """Runs a set of named tasks concurrently on a thread pool
+
+    Every task runs to completion, regardless of failures of other tasks. The duration of each task
+    is logged once it is done.
+
+    Args:
+        tasks: Mapping of a descriptive name to a function without arguments
+        max_workers: The maximum number of tasks running at the same time. Defaults to one worker per task
+        buffer_logs: Whether to hold back the logs of a task until it is done, so they are emitted as one
+            block instead of interleaved with the logs of other tasks
+        prefix_logs: Whether to prefix the logs of a task with its name, so they can be told apart while
+            they are emitted as they happen. Tasks run concurrently by a task keep its prefix
+
+    Returns:
+        The results of all tasks, in the same order as `tasks`
+
+    Raises:
+        ConcurrentTaskError if any of the tasks raised an exception
+    """
+
+    def _timed(name: str, task: Callable[[], Any]) -> TaskResult:
+        start = time.monotonic()
+        try:
+            value = task()
+        except Exception as e:
+            logger.error(f"Task {name} failed after {time.monotonic() - start:.1f}s: {e!r}")
+            return TaskResult(name, time.monotonic() - start, exception=e)
+        duration = time.monotonic() - start
+        logger.info(f"Task {name} finished in {duration:.1f}s")
+        return TaskResult(name, duration, result=value)
+
+    if not tasks:
+        return []
+
+    parent_prefix = _LOG_PREFIX.prefix
+    with ExitStack() as stack:
+        log_buffer = stack.enter_context(_buffered_logs()) if buffer_logs else None
+        if prefix_logs:
+            stack.enter_context(_LOG_PREFIX.installed())
+
+        def _run(name: str, task: Callable[[], Any]) -> TaskResult:
+            with _LOG_PREFIX.running(name, parent_prefix, prefix_logs):
+                if log_buffer is None:
+                    return _timed(name, task)
+                with log_buffer.capture():
+                    return _timed(name, task)
+
+        with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as executor:
+            futures = [executor.submit(_run, name, task) for name, task in tasks.items()]
+            results = [_.result() for _ in futures]
+
+    failures = [_ for _ in results if _.exception]
+    if failures:
+        raise ConcurrentTaskError(failures)
+    return results
+
+
+class Lazy(object):
+    """A value that is only computed once it is used, for example by a template
+
+    The value is computed at most once, also when it is used by multiple templates or threads.
+    If computing the value fails, it is computed again on next use.
+
+    Args:
+        provider: Function without arguments computing the value
+    """
+
+    _UNSET = object()
+
+    def __init__(self, provider: Callable[[], Any]):
+        self._provider = provider
+        self._value = Lazy._UNSET
+        self._lock = threading.Lock()
+
+    def get(self) -> Any:
+        with self._lock:
+            if self._value is Lazy._UNSET:
+                self._value = self._provider()
+            return self._value
+
+
+class _TemplateContext(Mapping):
+    """Read-only view over template parameters, resolving `Lazy` values on lookup
+
+    The parameters are not copied, so a large mapping like `os.environ` can be passed as is. Lookups
+    go over the given mappings in order.
+    """
+
+    def __init__(self, *mappings: Mapping):
+        self._mappings = mappings
+
+    def __getitem__(self, key: str) -> Any:
+        for mapping in self._mappings:
+            if key in mapping:
+                value = mapping[key]
+                return value.get() if isinstance(value, Lazy) else value
+        raise KeyError(key)
+
+    def __contains__(self, key: object) -> bool:
+        return any(key in _ for _ in self._mappings)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter({key: None for mapping in self._mappings for key in mapping})
+
+    def __len__(self) -> int:
+        return len({key for mapping in self._mappings for key in mapping})
+
+    def copy(self) -> dict:
+        """Plain dict of the parameters, leaving lazy values uncomputed. Jinja uses it to build tracebacks."""
+        return {key: mapping[key] for mapping in reversed(self._mappings) for key in mapping}
+
+
+class TemplateEngine(metaclass=Singleton):
+    """Process wide jinja environment, used to render all templates
+
+    Templates are loaded by path and compiled once. A compiled template is reused until its file
+    changes. If the environment variable `TAKEOFF_JINJA_BYTECODE_CACHE` points to a directory, the
+    compiled templates are cached on disk as well, so consecutive Takeoff invocations skip compilation.
+    """
+
+    def __init__(self):
+        bytecode_cache_dir = os.environ.get(JINJA_BYTECODE_CACHE_ENV)
+        if bytecode_cache_dir:
+            os.makedirs(bytecode_cache_dir, exist_ok=True)
+        self.environment = jinja2.Environment(
+            loader=jinja2.FileSystemLoader("/"),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(bytecode_cache_dir) if bytecode_cache_dir else None,
+        )
+        self.environment.filters.update(b64_encode=b64_encode, b64_decode=b64_decode)
+
+    def render(self, path: str, params: Mapping) -> str:
+        """Render the template at the given path
+
+        Args:
+            path: path to the template, relative to the working directory or absolute
+            params: the values to fill into the template. Values wrapped in `Lazy` are only computed
+                when the template uses them
+
+        Returns:
+            str: the rendered template
+        """
+        template = self.environment.get_template(os.path.abspath(path))
+        # A shared context uses the parameters as is, instead of copying them into a new dict like
+        # `template.render` does, which would compute all lazy values
+        context = template.new_context(_TemplateContext(params, template.globals), shared=True)
+        try:
+            return jinja2.utils.concat(template.root_render_func(context))
+        except Exception:
+            # points the traceback at the line in the template, like `template.render` does
+            self.environment.handle_exception()
+
+
+def render_string_with_jinja(path: str, params: Mapping) -> str:
     """Read a file contents and render the jinja template
 
     Args:
@@ -34,13 +327,10 @@ def render_string_with_jinja(path: str, params: dict) -> str:
     Returns:
         str: rendered jinja template as a string
     """
-    with open(path) as file_:
-        template = jinja2.Template(file_.read())
-    rendered = template.render(**params)
-    return rendered
+    return TemplateEngine().render(path, params)
 
 
-def render_file_with_jinja(path: str, params: dict, parse_function: Callable) -> dict:
+def render_file_with_jinja(path: str, params: Mapping, parse_function: Callable) -> dict:
     """Render a file with jinja, with a provided callable.
 
     The callable is used to parse the file into a python object, once the jinja template has been rendered
@@ -92,11 +382,6 @@ def b64_decode(s: str) -> str:
     return base64.b64decode(s).decode()
 
 
-# register as a jinja2 filter to allow usage within jinja2 templates
-jinja2.filters.FILTERS["b64_encode"] = b64_encode
-jinja2.filters.FILTERS["b64_decode"] = b64_decode
-
-
 def is_base64(target: Union[str, bytes]) -> bool:
     """Determines whether a given target (either bytes or string) is base64 encoded
     Courtesy of
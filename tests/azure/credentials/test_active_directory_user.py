@@ -1,4 +1,5 @@
 from takeoff.azure.credentials.active_directory_user import ActiveDirectoryUserCredentials as victim
+from takeoff.azure.credentials.token_cache import AadTokenCache
 from tests.azure.credentials.base_keyvault_test import KeyVaultBaseTest
 
 
@@ -9,5 +10,5 @@ class TestActiveDirectoryUserCredentials(KeyVaultBaseTest):
     def test_credentials(self):
         self.execute(
             "takeoff.azure.credentials.active_directory_user.UserPassCredentials",
-            {'username': "azuser", 'password': "azpass"}
+            {'username': "azuser", 'password': "azpass", 'cache': AadTokenCache().cache}
         )
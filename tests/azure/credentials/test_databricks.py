@@ -1,8 +1,22 @@
-from takeoff.azure.credentials.databricks import Databricks as victim
-from tests.azure.credentials.base_keyvault_test import KeyVaultBaseTest
+import json
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+import requests
+from databricks_cli.sdk import ApiClient
+
+from takeoff.azure.credentials.databricks import Databricks as victim, DatabricksClientPool, DatabricksRetry
+from takeoff.context import RunSummary
+from tests.azure.credentials.base_keyvault_test import KeyVaultBaseTest, CONFIG
 
 
 class TestDatabricks(KeyVaultBaseTest):
+    def setUp(self):
+        DatabricksClientPool().clear()
+        RunSummary().clear()
+
     def call_victim(self, m_client, config):
         victim("vault", m_client).api_client(config)
 
@@ -11,3 +25,86 @@ class TestDatabricks(KeyVaultBaseTest):
             "takeoff.azure.credentials.databricks.ApiClient",
             {'token': "dbtoken", 'host': "dbhost"}
         )
+
+    def test_client_is_shared(self):
+        m_client = self.construct_keyvault_mock()
+        client = victim("vault", m_client).api_client(CONFIG)
+
+        assert victim("vault", m_client).api_client(CONFIG) is client
+        assert victim("other-vault", self.construct_keyvault_mock()).api_client(CONFIG) is not client
+        m_client.get_secrets.assert_called_once()
+
+
+def test_retry_throttled_requests_for_all_methods():
+    retry = DatabricksRetry(total=3, status_forcelist=[429, 503])
+
+    assert retry.is_retry("POST", 429)
+    assert retry.is_retry("GET", 503)
+    assert not retry.is_retry("POST", 503)
+    assert not DatabricksRetry(total=0).is_retry("POST", 429)
+
+
+@contextmanager
+def databricks_stand_in(responses):
+    """Serves the given (status, headers) responses in order, the last one repeatedly"""
+    requests_seen = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def _respond(self):
+            requests_seen.append(self.command)
+            status, headers = responses[min(len(requests_seen), len(responses)) - 1]
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(json.dumps({"jobs": []}).encode())
+
+        do_GET = _respond
+        do_POST = _respond
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(("localhost", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def create_client():
+        client = ApiClient(host="http://localhost", token="token")
+        # The client drops the port of the host
+        client.url = f"http://localhost:{server.server_port}/api/2.0"
+        return client
+
+    try:
+        yield DatabricksClientPool().get("stand-in", create_client), requests_seen
+    finally:
+        server.shutdown()
+
+
+@pytest.fixture(autouse=True)
+def clear():
+    DatabricksClientPool().clear()
+    RunSummary().clear()
+
+
+def test_retry_honors_retry_after():
+    with databricks_stand_in([(429, {"Retry-After": "0"}), (200, {})]) as (client, requests_seen):
+        assert client.perform_query("POST", "/jobs/create", data={}) == {"jobs": []}
+
+    assert requests_seen == ["POST", "POST"]
+
+
+def test_server_errors_are_not_retried_for_post():
+    with databricks_stand_in([(503, {}), (200, {})]) as (client, requests_seen):
+        with pytest.raises(requests.exceptions.HTTPError):
+            client.perform_query("POST", "/jobs/create", data={})
+
+    assert requests_seen == ["POST"]
+
+
+def test_request_counters():
+    with databricks_stand_in([(503, {}), (200, {})]) as (client, _):
+        client.perform_query("GET", "/jobs/list")
+        client.perform_query("GET", "/jobs/list")
+        counters = DatabricksClientPool()._counters[client.url]
+
+    assert counters == {"requests": 2, "retries": 1, "status 503": 1, "status 200": 2}
@@ -0,0 +1,100 @@
+import os
+from unittest import mock
+
+import pytest
+
+from takeoff.azure.credentials.kubeconfig_cache import KubeconfigCache as victim, credentials_expiry
+
+CLUSTER = ("my-subscription", "my-rg", "my-cluster")
+
+STATIC_KUBECONFIG = """apiVersion: v1
+kind: Config
+users:
+- name: my-user
+  user:
+    token: {token}
+"""
+CACHED = STATIC_KUBECONFIG.format(token="my-token")
+FETCHED = STATIC_KUBECONFIG.format(token="new-token")
+
+KUBECONFIG = """apiVersion: v1
+kind: Config
+users:
+- name: my-user
+  user:
+    auth-provider:
+      name: azure
+      config:
+        expires-on: "{expires_on}"
+"""
+
+
+@pytest.fixture(autouse=True)
+def clear():
+    victim().clear()
+
+
+def cache_config(path: str, max_age_seconds: int = 3600) -> dict:
+    cache = {"path": path, "encryption_key": "CACHE_KEY", "max_age_seconds": max_age_seconds}
+    return {"azure": {"kubeconfig_cache": cache}}
+
+
+def test_get_fetches_once():
+    fetch = mock.Mock(return_value=CACHED)
+
+    assert victim().get({}, CLUSTER, fetch) == CACHED
+    assert victim().get({}, CLUSTER, fetch) == CACHED
+    fetch.assert_called_once_with()
+
+
+def test_get_per_cluster():
+    victim().get({}, CLUSTER, lambda: "first")
+    assert victim().get({}, ("my-subscription", "my-rg", "other-cluster"), lambda: "second") == "second"
+
+
+def test_credentials_expiry():
+    assert credentials_expiry(KUBECONFIG.format(expires_on=1234)) == 1234
+    assert credentials_expiry(CACHED) is None
+
+
+@mock.patch.dict(os.environ, {"CACHE_KEY": "secret"})
+def test_persist_and_load(tmp_path):
+    config = cache_config(str(tmp_path / "cache"))
+    victim().get(config, CLUSTER, lambda: CACHED)
+
+    with open(tmp_path / "cache", "rb") as f:
+        assert b"my-token" not in f.read()
+    assert oct(os.stat(tmp_path / "cache").st_mode)[-3:] == "600"
+
+    victim().clear()
+    fetch = mock.Mock()
+    assert victim().get(config, CLUSTER, fetch) == CACHED
+    fetch.assert_not_called()
+
+
+@mock.patch.dict(os.environ, {"CACHE_KEY": "secret"})
+def test_expired_kubeconfig_is_fetched_again(tmp_path):
+    config = cache_config(str(tmp_path / "cache"), max_age_seconds=0)
+    victim().get(config, CLUSTER, lambda: CACHED)
+    victim().clear()
+
+    assert victim().get(config, CLUSTER, lambda: FETCHED) == FETCHED
+
+
+@mock.patch.dict(os.environ, {"CACHE_KEY": "secret"})
+def test_expiring_credentials_are_fetched_again(tmp_path):
+    config = cache_config(str(tmp_path / "cache"))
+    victim().get(config, CLUSTER, lambda: KUBECONFIG.format(expires_on=0))
+    victim().clear()
+
+    assert victim().get(config, CLUSTER, lambda: FETCHED) == FETCHED
+
+
+@mock.patch.dict(os.environ, {"CACHE_KEY": "secret"})
+def test_load_with_wrong_key(tmp_path):
+    config = cache_config(str(tmp_path / "cache"))
+    victim().get(config, CLUSTER, lambda: CACHED)
+    victim().clear()
+
+    with mock.patch.dict(os.environ, {"CACHE_KEY": "another-secret"}):
+        assert victim().get(config, CLUSTER, lambda: FETCHED) == FETCHED
@@ -2,6 +2,7 @@ import os
 from unittest import mock
 
 from takeoff.azure.credentials.service_principal import ServicePrincipalCredentials as victim
+from takeoff.azure.credentials.token_cache import AadTokenCache
 from tests.credentials.base_environment_keys_test import EnvironmentKeyBaseTest, OS_KEYS
 
 
@@ -13,5 +14,6 @@ class TestServicePrincipal(EnvironmentKeyBaseTest):
     def test_credentials(self):
         self.execute(
             "takeoff.azure.credentials.service_principal.SpCredentials",
-            {"client_id": "d0aaa0de-c1ef-456f-a025-c5d6341193bb", "secret": "3ceb401f-6462-48da-b42f-b1d1745c2590"}
+            {"client_id": "d0aaa0de-c1ef-456f-a025-c5d6341193bb", "secret": "3ceb401f-6462-48da-b42f-b1d1745c2590",
+             "cache": AadTokenCache().cache}
         )
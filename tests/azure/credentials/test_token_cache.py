@@ -0,0 +1,64 @@
+import os
+from unittest import mock
+
+import pytest
+
+from takeoff.azure.credentials.token_cache import AadTokenCache as victim
+
+TOKEN = {
+    "_authority": "https://login.microsoftonline.com/my-tenant",
+    "resource": "https://management.core.windows.net/",
+    "_clientId": "my-client",
+    "accessToken": "some-token",
+    "expiresOn": "2999-01-01 00:00:00.000000",
+}
+
+
+@pytest.fixture(autouse=True)
+def clear():
+    victim().clear()
+
+
+def cache_config(path: str) -> dict:
+    return {"azure": {"token_cache": {"path": path, "encryption_key": "CACHE_KEY"}}}
+
+
+def test_get_returns_shared_cache():
+    assert victim().get({}) is victim().get({})
+
+
+def test_persist_without_config():
+    victim().get({}).add([TOKEN])
+    victim().persist({})
+    assert victim().cache.has_state_changed
+
+
+@mock.patch.dict(os.environ, {"CACHE_KEY": "secret"})
+def test_persist_and_load(tmp_path):
+    config = cache_config(str(tmp_path / "cache"))
+    victim().get(config).add([TOKEN])
+    victim().persist(config)
+
+    with open(tmp_path / "cache", "rb") as f:
+        assert b"some-token" not in f.read()
+
+    victim().clear()
+    assert [_ for _ in victim().get(config).read_items()][0][1] == TOKEN
+
+
+@mock.patch.dict(os.environ, {"CACHE_KEY": "secret"})
+def test_load_with_wrong_key(tmp_path):
+    config = cache_config(str(tmp_path / "cache"))
+    victim().get(config).add([TOKEN])
+    victim().persist(config)
+    victim().clear()
+
+    with mock.patch.dict(os.environ, {"CACHE_KEY": "another-secret"}):
+        assert not list(victim().get(config).read_items())
+
+
+def test_missing_encryption_key(tmp_path):
+    config = cache_config(str(tmp_path / "cache"))
+    victim().get(config).add([TOKEN])
+    with pytest.raises(ValueError):
+        victim().persist(config)
@@ -1,4 +1,5 @@
 import os
+import time
 from dataclasses import dataclass
 from unittest import mock
 
@@ -11,9 +12,10 @@ from takeoff.azure.configure_eventhub import (
     EventHub,
     EventHubConsumerGroup,
     ConfigureEventHub,
-    EventHubProducerPolicy, ConnectingString)
+    EventHubProducerPolicy, ConnectingString, EventHubTopology)
 from takeoff.context import Context, ContextKey
 from takeoff.credentials.secret import Secret
+from takeoff.util import ConcurrentTaskError
 from tests.azure import takeoff_config
 
 BASE_CONF = {'task': 'configure_eventhub',
@@ -115,7 +117,7 @@ class TestConfigureEventHub(object):
     def test_create_producer_policy_with_databricks(self, victim):
         policy = EventHubProducerPolicy('my-entity', True)
 
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
+        with mock.patch.object(ConfigureEventHub, '_queue_databricks_secret') as databricks_call:
             victim._create_producer_policy(policy=policy,
                                            resource_group='my-group',
                                            eventhub_namespace='my-namespace',
@@ -136,7 +138,7 @@ class TestConfigureEventHub(object):
             resource_group_name='my-group',
         )
 
-        databricks_call.assert_called_once()
+        databricks_call.assert_called_once_with(Secret('my-entity-connection-string', 'potato-connection'))
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
     def test_create_eventhub_producer_policies_secrets(self, victim):
@@ -151,7 +153,7 @@ class TestConfigureEventHub(object):
     def test_create_producer_policy_without_databricks(self, victim):
         policy = EventHubProducerPolicy('my-entity', False)
 
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
+        with mock.patch.object(ConfigureEventHub, '_queue_databricks_secret') as databricks_call:
             victim._create_producer_policy(policy=policy,
                                            resource_group='my-group',
                                            eventhub_namespace='my-namespace',
@@ -186,6 +188,17 @@ class TestConfigureEventHub(object):
         result = victim._create_connection_string(EventHub('my-group', 'my-namespace', 'my-entity'))
         assert result == ConnectingString('my-entity', 'potato-connection')
 
+    @mock.patch.dict(os.environ, TEST_ENV_VARS)
+    def test_create_connection_string_once_per_hub(self, victim):
+        hub = EventHub('my-group', 'my-namespace', 'my-shared-entity')
+        victim.eventhub_client.event_hubs.list_keys.reset_mock()
+
+        results = [victim._create_connection_string(hub) for _ in range(3)]
+
+        assert results == [ConnectingString('my-shared-entity', 'potato-connection')] * 3
+        victim.eventhub_client.event_hubs.list_keys.assert_called_once_with(
+            'my-group', 'my-namespace', 'my-shared-entity', 'my_little_pony-policy')
+
     @mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._create_producer_policy")
     def test_create_eventhub_producer_policies(self, producer_policy_fun, victim):
         policies = [
@@ -198,7 +211,7 @@ class TestConfigureEventHub(object):
         calls = [mock.call(policies[0], 'rgdev', 'eventhubdev', 'my_little_pony'),
                  mock.call(policies[1], 'rgdev', 'eventhubdev', 'my_little_pony')]
 
-        producer_policy_fun.assert_has_calls(calls)
+        producer_policy_fun.assert_has_calls(calls, any_order=True)
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
     @mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._create_consumer_group")
@@ -215,12 +228,12 @@ class TestConfigureEventHub(object):
         calls = [mock.call(group=EventHubConsumerGroup(EventHub('my-group', 'my-namespace', 'entity1'), 'group1', False)),
                  mock.call(group=EventHubConsumerGroup(EventHub('my-group', 'my-namespace', 'entity2'), 'group2', True))]
 
-        consumer_group_fun.assert_has_calls(calls)
+        consumer_group_fun.assert_has_calls(calls, any_order=True)
 
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
     def test_create_eventhub_consumer_group(self, victim):
         group = EventHubConsumerGroup(EventHub('my-rg', 'my-namespace', 'my-entity'), 'my-group', False)
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
+        with mock.patch.object(ConfigureEventHub, '_queue_databricks_secret') as databricks_call:
             victim._create_consumer_group(group)
 
         victim.eventhub_client.consumer_groups.create_or_update.assert_called_with('my-rg',
@@ -233,7 +246,7 @@ class TestConfigureEventHub(object):
     @mock.patch.dict(os.environ, TEST_ENV_VARS)
     def test_create_eventhub_consumer_group(self, victim):
         group = EventHubConsumerGroup(EventHub('my-rg', 'my-namespace', 'my-entity'), 'my-group', True)
-        with mock.patch('takeoff.azure.configure_eventhub.ConfigureEventHub.create_databricks_secrets') as databricks_call:
+        with mock.patch.object(ConfigureEventHub, '_queue_databricks_secret') as databricks_call:
             victim._create_consumer_group(group)
 
         victim.eventhub_client.consumer_groups.create_or_update.assert_called_with('my-rg',
@@ -242,3 +255,137 @@ class TestConfigureEventHub(object):
                                                                                    'my-group')
 
         databricks_call.assert_called_once()
+
+    @mock.patch.dict(os.environ, TEST_ENV_VARS)
+    def test_create_eventhub_consumer_groups_keeps_config_order(self, victim):
+        groups = [EventHubConsumerGroup(EventHub('my-group', 'my-namespace', f'entity{i}'), 'group', False)
+                  for i in range(10)]
+
+        def create(group):
+            time.sleep(0.001 * (10 - int(group.eventhub.name[len('entity'):])))
+            return Secret(group.eventhub.name, 'connection')
+
+        with mock.patch.object(ConfigureEventHub, "_create_consumer_group", side_effect=create):
+            victim.create_eventhub_consumer_groups(groups)
+
+        secrets = Context().get(ContextKey.EVENTHUB_CONSUMER_GROUP_SECRETS)
+        assert secrets == [Secret(f'entity{i}', 'connection') for i in range(10)]
+
+    @mock.patch.dict(os.environ, TEST_ENV_VARS)
+    def test_create_eventhub_consumer_groups_failure(self, victim):
+        groups = [EventHubConsumerGroup(EventHub('my-group', 'my-namespace', 'entity1'), 'group', False)]
+
+        with mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._create_consumer_group",
+                        side_effect=ValueError("boom")):
+            with pytest.raises(ConcurrentTaskError):
+                victim.create_eventhub_consumer_groups(groups)
+
+
+def topology_client():
+    m_client = mock.MagicMock()
+    m_client.event_hubs.list_by_namespace.return_value = [
+        MockEventHubClientResponse("hub1"), MockEventHubClientResponse("hub2")
+    ]
+    m_client.consumer_groups.list_by_event_hub.return_value = [MockEventHubClientResponse("group1")]
+    m_client.event_hubs.list_authorization_rules.return_value = [MockEventHubClientResponse("rule1")]
+    return m_client
+
+
+class TestEventHubTopology(object):
+    def test_prefetch_lists_existing_hubs_once(self):
+        m_client = topology_client()
+        topology = EventHubTopology(m_client, "rg", "namespace")
+
+        topology.prefetch(["hub1", "hub2", "hub1", "idontexist"])
+        for hub in ("hub1", "hub2"):
+            assert topology.consumer_groups(hub) == {"group1"}
+            assert topology.authorization_rules(hub) == {"rule1"}
+
+        m_client.event_hubs.list_by_namespace.assert_called_once_with("rg", "namespace")
+        m_client.consumer_groups.list_by_event_hub.assert_has_calls(
+            [mock.call("rg", "namespace", "hub1"), mock.call("rg", "namespace", "hub2")], any_order=True)
+        assert m_client.consumer_groups.list_by_event_hub.call_count == 2
+        assert m_client.event_hubs.list_authorization_rules.call_count == 2
+
+    def test_add_resources(self):
+        m_client = topology_client()
+        topology = EventHubTopology(m_client, "rg", "namespace")
+
+        topology.add_consumer_group("hub1", "group2")
+        topology.add_authorization_rule("hub1", "rule2")
+
+        assert topology.consumer_groups("hub1") == {"group1", "group2"}
+        assert topology.authorization_rules("hub1") == {"rule1", "rule2"}
+        assert m_client.consumer_groups.list_by_event_hub.call_count == 1
+
+
+@mock.patch.dict(os.environ, TEST_ENV_VARS)
+@mock.patch("takeoff.step.ApplicationName.get", return_value="my_little_pony")
+@mock.patch("takeoff.azure.configure_eventhub.KeyVaultClient.vault_and_client", return_value=(None, None))
+def test_run_uses_topology_snapshot(_, __):
+    m_client = topology_client()
+    m_client.event_hubs.list_keys.return_value = MockEventHubClientResponse("key", "potato-connection")
+    conf = {**takeoff_config(), 'task': 'configure_eventhub',
+            'create_consumer_groups': [{'eventhub_entity_naming': 'hub1', 'consumer_group': 'group1'},
+                                       {'eventhub_entity_naming': 'hub1', 'consumer_group': 'group2'},
+                                       {'eventhub_entity_naming': 'hub2', 'consumer_group': 'group2'}]}
+    conf['azure'].update({"eventhub_naming": "eventhub{env}"})
+
+    with mock.patch.object(ConfigureEventHub, "_get_eventhub_client", return_value=m_client):
+        ConfigureEventHub(ApplicationVersion('DEV', 'local', 'foo'), conf).run()
+
+    m_client.event_hubs.list_by_namespace.assert_called_once()
+    assert m_client.consumer_groups.list_by_event_hub.call_count == 2
+    assert m_client.event_hubs.list_authorization_rules.call_count == 2
+    m_client.consumer_groups.create_or_update.assert_has_calls(
+        [mock.call('rgdev', 'eventhubdev', 'hub1', 'group2'),
+         mock.call('rgdev', 'eventhubdev', 'hub2', 'group2')])
+    assert m_client.consumer_groups.create_or_update.call_count == 2
+    m_client.event_hubs.create_or_update_authorization_rule.assert_has_calls(
+        [mock.call('rgdev', 'eventhubdev', 'hub1', 'my_little_pony-policy', [AccessRights.listen]),
+         mock.call('rgdev', 'eventhubdev', 'hub2', 'my_little_pony-policy', [AccessRights.listen])],
+        any_order=True)
+    assert m_client.event_hubs.create_or_update_authorization_rule.call_count == 2
+    assert m_client.event_hubs.list_keys.call_count == 2
+
+
+@mock.patch.dict(os.environ, TEST_ENV_VARS)
+@mock.patch("takeoff.step.ApplicationName.get", return_value="my_little_pony")
+@mock.patch("takeoff.azure.configure_eventhub.KeyVaultClient.vault_and_client", return_value=(None, None))
+def test_run_creates_databricks_secrets_in_one_batch(_, __):
+    m_client = topology_client()
+    m_client.event_hubs.list_keys.side_effect = lambda *args, **kwargs: MockEventHubClientResponse(
+        "key", f"{args[2] if args else kwargs['authorization_rule_name']}-connection")
+    conf = {**takeoff_config(), 'task': 'configure_eventhub',
+            'create_consumer_groups': [{'eventhub_entity_naming': 'hub1', 'consumer_group': 'group2',
+                                        'create_databricks_secret': True},
+                                       {'eventhub_entity_naming': 'hub2', 'consumer_group': 'group2',
+                                        'create_databricks_secret': False}],
+            'create_producer_policies': [{'eventhub_entity_naming': 'hub2',
+                                          'create_databricks_secret': True}]}
+    conf['azure'].update({"eventhub_naming": "eventhub{env}"})
+
+    with mock.patch.object(ConfigureEventHub, "_get_eventhub_client", return_value=m_client), \
+            mock.patch("takeoff.azure.configure_eventhub.CreateDatabricksSecretFromValue") as m_secrets:
+        ConfigureEventHub(ApplicationVersion('DEV', 'local', 'foo'), conf).run()
+
+    m_secrets.assert_called_once()
+    m_secrets.return_value._create_scope.assert_called_once_with('my_little_pony')
+    m_secrets.return_value._add_secrets.assert_called_once_with(
+        'my_little_pony', [Secret('hub1-connection-string', 'hub1-connection'),
+                           Secret('hub2-connection-string', 'my_little_pony-send-policy-connection')])
+
+
+@mock.patch.dict(os.environ, TEST_ENV_VARS)
+@mock.patch("takeoff.step.ApplicationName.get", return_value="my_little_pony")
+@mock.patch("takeoff.azure.configure_eventhub.KeyVaultClient.vault_and_client", return_value=(None, None))
+def test_run_without_databricks_secrets(_, __):
+    conf = {**takeoff_config(), **BASE_CONF}
+    conf['azure'].update({"eventhub_naming": "eventhub{env}"})
+
+    with mock.patch("takeoff.azure.configure_eventhub.ConfigureEventHub._get_eventhub_client",
+                    return_value=topology_client()), \
+            mock.patch("takeoff.azure.configure_eventhub.CreateDatabricksSecretFromValue") as m_secrets:
+        ConfigureEventHub(ApplicationVersion('DEV', 'local', 'foo'), conf).run()
+
+    m_secrets.assert_not_called()
@@ -5,7 +5,12 @@ from unittest import mock
 import pytest
 
 from takeoff.application_version import ApplicationVersion
-from takeoff.azure.create_databricks_secrets import CreateDatabricksSecretsFromVault, CreateDatabricksSecretFromValue, CreateDatabricksSecretsMixin
+from takeoff.azure.create_databricks_secrets import (
+    CreateDatabricksSecretFromValue,
+    CreateDatabricksSecretsFromVault,
+    CreateDatabricksSecretsMixin,
+    SecretScopeRegistry,
+)
 from takeoff.credentials.secret import Secret
 from tests.azure import takeoff_config
 
@@ -13,7 +18,7 @@ from tests.azure import takeoff_config
 @dataclass
 class MockDatabricksClient:
     def api_client(self, config):
-        return None
+        return mock.Mock(url="https://my-workspace/api/2.0")
 
 
 BASE_CONF = {'task': 'create_databricks_secrets_from_vault'}
@@ -56,6 +61,11 @@ def setup_victim(add_secrets: bool):
         return CreateDatabricksSecretsFromVault(ApplicationVersion('ACP', '0.0.0', 'my-branch'), conf)
 
 
+@pytest.fixture(autouse=True)
+def clear_scopes():
+    SecretScopeRegistry().clear()
+
+
 @pytest.fixture(autouse=True)
 def victim():
     return setup_victim(add_secrets=True)
@@ -76,10 +86,11 @@ class TestCreateDatabricksSecretsFromVault(object):
         CreateDatabricksSecretsFromVault(ApplicationVersion('ACP', 'bar', 'foo'), conf)
 
     def test_scope_exists(self, victim):
-        scopes = {"scopes": [{"name": "foo"}, {"name": "bar"}]}
+        victim.secret_api.list_scopes.return_value = {"scopes": [{"name": "foo"}, {"name": "bar"}]}
 
-        assert victim._scope_exists(scopes, "foo")
-        assert not victim._scope_exists(scopes, "foobar")
+        assert victim._scope_exists("foo")
+        assert not victim._scope_exists("foobar")
+        victim.secret_api.list_scopes.assert_called_once()
 
     @mock.patch('takeoff.azure.create_databricks_secrets.KeyVaultCredentialsMixin.get_keyvault_secrets',
                 return_value=[Secret('key1', 'foo'), Secret('key2', 'bar')])
@@ -119,13 +130,82 @@ class TestCreateDatabricksSecretsFromVault(object):
         victim._create_scope("scope1")
         victim.secret_api.create_scope.assert_not_called()
 
+    def test_create_scope_lists_scopes_once(self, victim, victim_without_secrets):
+        victim._create_scope("my-awesome-scope")
+        victim._create_scope("my-awesome-scope")
+        victim_without_secrets._create_scope("my-awesome-scope")
+
+        victim.secret_api.create_scope.assert_called_once_with("my-awesome-scope", None)
+        victim.secret_api.list_scopes.assert_called_once()
+        victim_without_secrets.secret_api.list_scopes.assert_not_called()
+        victim_without_secrets.secret_api.create_scope.assert_not_called()
+
     def test_add_secrets(self, victim):
         secrets = [Secret("foo", "oof"), Secret("bar", "rab")]
 
         victim._add_secrets("my-scope", secrets)
         calls = [mock.call("my-scope", "foo", "oof", None),
                  mock.call("my-scope", "bar", "rab", None)]
-        victim.secret_api.put_secret.assert_has_calls(calls)
+        victim.secret_api.put_secret.assert_has_calls(calls, any_order=True)
+
+    def test_sync_secrets_first_time(self, victim, tmp_path):
+        fingerprint_file = str(tmp_path / "fingerprints" / "scope.json")
+        victim.secret_api.list_secrets.side_effect = [
+            {},
+            {"secrets": [
+                {"key": "foo", "last_updated_timestamp": 1},
+                {"key": "bar", "last_updated_timestamp": 2},
+            ]},
+        ]
+        victim._sync_secrets("my-scope", [Secret("foo", "oof"), Secret("bar", "rab")], fingerprint_file)
+
+        assert victim.secret_api.put_secret.call_count == 2
+        with open(fingerprint_file) as f:
+            content = f.read()
+        assert "oof" not in content and "rab" not in content
+
+    def test_sync_secrets_only_changed(self, victim, tmp_path):
+        fingerprint_file = str(tmp_path / "scope.json")
+        timestamps = {"secrets": [{"key": "foo", "last_updated_timestamp": 1},
+                                  {"key": "bar", "last_updated_timestamp": 2},
+                                  {"key": "baz", "last_updated_timestamp": 3}]}
+        victim.secret_api.list_secrets.return_value = timestamps
+        victim._sync_secrets("my-scope", [Secret("foo", "oof"), Secret("bar", "rab"), Secret("baz", "zab")],
+                             fingerprint_file)
+        victim.secret_api.put_secret.reset_mock()
+
+        # bar has a new value, baz was updated outside of Takeoff
+        timestamps["secrets"][2]["last_updated_timestamp"] = 4
+        victim._sync_secrets("my-scope", [Secret("foo", "oof"), Secret("bar", "new"), Secret("baz", "zab")],
+                             fingerprint_file)
+
+        calls = [mock.call("my-scope", "bar", "new", None), mock.call("my-scope", "baz", "zab", None)]
+        victim.secret_api.put_secret.assert_has_calls(calls, any_order=True)
+        assert victim.secret_api.put_secret.call_count == 2
+
+    def test_sync_secrets_delete_removed(self, victim, tmp_path):
+        fingerprint_file = str(tmp_path / "scope.json")
+        victim.secret_api.list_secrets.return_value = {"secrets": [
+            {"key": "foo", "last_updated_timestamp": 1},
+            {"key": "bar", "last_updated_timestamp": 2},
+            {"key": "not-synced", "last_updated_timestamp": 3},
+        ]}
+        victim._sync_secrets("my-scope", [Secret("foo", "oof"), Secret("bar", "rab")], fingerprint_file)
+        victim.secret_api.put_secret.reset_mock()
+
+        victim._sync_secrets("my-scope", [Secret("foo", "oof")], fingerprint_file, delete_removed=True)
+
+        victim.secret_api.put_secret.assert_not_called()
+        victim.secret_api.delete_secret.assert_called_once_with("my-scope", "bar")
+
+    @mock.patch('takeoff.azure.create_databricks_secrets.KeyVaultCredentialsMixin.get_keyvault_secrets',
+                return_value=[Secret('key1', 'foo')])
+    def test_create_databricks_secrets_sync(self, _, victim_without_secrets, tmp_path):
+        victim_without_secrets.config["sync"] = {"fingerprint_path": str(tmp_path), "delete_removed": False}
+        victim_without_secrets.secret_api.list_secrets.return_value = {}
+        victim_without_secrets.create_databricks_secrets()
+
+        assert os.path.isfile(tmp_path / "ACP-my_little_pony.json")
 
 
 class TestCreateDatabricksSecretFromVault(object):
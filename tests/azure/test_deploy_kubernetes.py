@@ -1,16 +1,21 @@
+import datetime
+import json
 import os
 from dataclasses import dataclass
-from pathlib import Path
 from typing import List
 from unittest import mock
 
 import pytest
+from kubernetes.client import Configuration, V1Secret
+from kubernetes.client.rest import ApiException
 
 from takeoff.application_version import ApplicationVersion
-from takeoff.azure.deploy_to_kubernetes import DeployToKubernetes, BaseKubernetes
-from takeoff.context import Context
+from takeoff.azure.credentials.kubeconfig_cache import KubeconfigCache
+from takeoff.azure.deploy_to_kubernetes import DeployToKubernetes, BaseKubernetes, KubernetesCluster
+from takeoff.azure.kubernetes_apply import AppliedResource, KubernetesResource
+from takeoff.context import Context, RunSummary
 from takeoff.credentials.container_registry import DockerCredentials
-from takeoff.util import run_shell_command
+from takeoff.util import ConcurrentTaskError, b64_encode, run_shell_command
 from tests.azure import takeoff_config
 
 env_variables = {'AZURE_TENANTID': 'David',
@@ -46,6 +51,15 @@ class RegistryCredentials:
         return self
 
 
+DOCKER_CONFIG = {
+    "auths": {"registry.io": {"username": "myuser", "password": "secret", "auth": "bXl1c2VyOnNlY3JldA=="}}
+}
+
+
+def mock_cluster() -> KubernetesCluster:
+    return KubernetesCluster("my-cluster", mock.Mock(), mock.Mock())
+
+
 BASE_CONF = {'task': 'deploy_to_kubernetes', 'kubernetes_config_path': 'kubernetes_config/k8s.yml.j2'}
 
 
@@ -70,12 +84,9 @@ class TestDeployToKubernetes(object):
         assert res.config['kubernetes_config_path'] == "kubernetes_config/k8s.yml.j2"
 
     @mock.patch.dict(os.environ, env_variables)
-    @mock.patch("takeoff.azure.deploy_to_kubernetes.DeployToKubernetes._get_docker_registry_secret",
-                return_value="nonbase64encodedstring")
-    def test_create_docker_registry_secret(self, _, victim):
+    def test_create_docker_registry_secret(self, victim):
         Context().clear()
-        with mock.patch("takeoff.azure.deploy_to_kubernetes.DeployToKubernetes._write_kubernetes_config") as m_write:
-            victim._create_image_pull_secret("myapp")
+        result = victim._create_image_pull_secret("myapp", "nonbase64encodedstring")
 
         expected_result = """kind: Namespace
 apiVersion: v1
@@ -90,7 +101,7 @@ data:
 metadata:
   name: registry-auth
   namespace: default"""
-        m_write.assert_called_once_with(expected_result)
+        assert result == expected_result
 
     def test_render_kubernetes_config(self, victim):
         result = victim._render_kubernetes_config('tests/azure/files/valid_k8s.yml.j2', 'my-little-pony',
@@ -128,8 +139,10 @@ spec:
     @pytest.mark.skip(reason="kubectl can't work without a valid kube context :(")
     @mock.patch("takeoff.azure.deploy_to_kubernetes.DockerRegistry.credentials",
                 return_value=DockerCredentials("myuser", "secretpassword", "registry.io"))
-    def test_validate_yaml(self, _, victim):
-        path = victim._create_image_pull_secret("myapp")
+    def test_validate_yaml(self, _, victim, tmp_path):
+        path = str(tmp_path / "pull_secret.yml")
+        with open(path, "w") as f:
+            f.write(victim._create_image_pull_secret("myapp", victim._get_docker_registry_secret()))
 
         cmd = ["kubectl", "apply", "--dry-run", "--validate", "-f", path]
         code, lines = run_shell_command(cmd)
@@ -170,6 +183,127 @@ spec:
         with pytest.raises(ValueError):
             res._get_custom_values()
 
+    def test_apply_kubernetes_config(self, victim):
+        cluster = mock_cluster()
+        victim._apply_kubernetes_config(cluster, "apiVersion: v1\nkind: Namespace\nmetadata:\n  name: foo\n")
+
+        resources = list(cluster.applier.apply.call_args[0][0])
+        assert [str(_) for _ in resources] == ["Namespace/foo"]
+
+    @pytest.mark.parametrize("live_secret, applied", [
+        (V1Secret(data={".dockerconfigjson": b64_encode(json.dumps(DOCKER_CONFIG))}), False),
+        (V1Secret(data={".dockerconfigjson": b64_encode(json.dumps(DOCKER_CONFIG, indent=2))}), False),
+        (V1Secret(data={".dockerconfigjson": b64_encode(json.dumps({"auths": {}}))}), True),
+        (V1Secret(data={".dockerconfigjson": "bm90IGpzb24="}), True),
+        (V1Secret(data=None), True),
+        (ApiException(status=404), True),
+    ])
+    def test_ensure_image_pull_secret(self, live_secret, applied, victim):
+        with mock.patch("takeoff.azure.deploy_to_kubernetes.CoreV1Api") as m_api, \
+                mock.patch.object(victim, "_create_image_pull_secret", return_value="path") as m_create, \
+                mock.patch.object(victim, "_apply_kubernetes_config") as m_apply:
+            m_api.return_value.read_namespaced_secret.side_effect = [live_secret]
+            victim._ensure_image_pull_secret(mock_cluster(), "myapp", b64_encode(json.dumps(DOCKER_CONFIG)))
+
+        m_api.return_value.read_namespaced_secret.assert_called_once_with("registry-auth", "default")
+        assert m_create.called == applied
+        assert m_apply.called == applied
+
+    def test_ensure_image_pull_secret_api_error(self, victim):
+        with mock.patch("takeoff.azure.deploy_to_kubernetes.CoreV1Api") as m_api:
+            m_api.return_value.read_namespaced_secret.side_effect = ApiException(status=403)
+            with pytest.raises(ApiException):
+                victim._ensure_image_pull_secret(mock_cluster(), "myapp", "nonbase64encodedstring")
+
+    def test_restart_unchanged_resources(self, victim):
+        changed = KubernetesResource("apps/v1", "Deployment", "changed", None, {})
+        unchanged = KubernetesResource("apps/v1", "Deployment", "unchanged", None, {})
+
+        cluster = mock_cluster()
+        victim._restart_unchanged_resources(
+            cluster, [AppliedResource(changed, True), AppliedResource(unchanged, False)]
+        )
+
+        cluster.applier.restart.assert_called_once_with([unchanged])
+
+    def test_cluster_names(self, victim):
+        assert victim._cluster_names() == ["kubernetesdev"]
+
+        with mock.patch.dict(victim.config, {"clusters": ["aks-westeurope-{env}", "aks-northeurope-{env}"]}):
+            assert victim._cluster_names() == ["aks-westeurope-dev", "aks-northeurope-dev"]
+
+    def test_cluster_names_with_naming_plugin(self, victim):
+        plugin = mock.Mock()
+        plugin.get_kubernetes_name = lambda config, env: f"{config['azure']['kubernetes_naming']}-plugin"
+
+        with mock.patch.dict(victim.config, {"clusters": ["first", "second"]}), \
+                mock.patch("takeoff.azure.util.load_takeoff_plugins", return_value={"plugin": plugin}):
+            assert victim._cluster_names() == ["first-plugin", "second-plugin"]
+
+    @mock.patch("takeoff.azure.deploy_to_kubernetes.KeyVaultCredentialsMixin.get_keyvault_secrets",
+                return_value=[])
+    def test_deploy_to_kubernetes_renders_once(self, _, victim):
+        with mock.patch.dict(victim.config, {"clusters": ["first", "second"]}), \
+                mock.patch.object(victim, "_get_docker_registry_secret", return_value="pull") as m_secret, \
+                mock.patch.object(victim, "_render_kubernetes_manifest", return_value="config") as m_render, \
+                mock.patch.object(victim, "_deploy_to_cluster") as m_deploy:
+            victim.deploy_to_kubernetes("k8s.yml.j2", "myapp")
+
+        m_secret.assert_called_once_with()
+        m_render.assert_called_once_with("k8s.yml.j2", "myapp", [], {})
+        m_deploy.assert_has_calls([
+            mock.call("first", "myapp", "config", "pull"),
+            mock.call("second", "myapp", "config", "pull"),
+        ], any_order=True)
+
+    @mock.patch("takeoff.azure.deploy_to_kubernetes.KeyVaultCredentialsMixin.get_keyvault_secrets",
+                return_value=[])
+    def test_deploy_to_kubernetes_failing_cluster(self, _, victim):
+        def deploy(cluster_name, *args):
+            if cluster_name == "first":
+                raise ValueError("boom")
+
+        with mock.patch.dict(victim.config, {"clusters": ["first", "second"]}), \
+                mock.patch.object(victim, "_get_docker_registry_secret", return_value="pull-secret"), \
+                mock.patch.object(victim, "_render_kubernetes_manifest", return_value="manifest"), \
+                mock.patch.object(victim, "_deploy_to_cluster", side_effect=deploy) as m_deploy:
+            with pytest.raises(ConcurrentTaskError) as e:
+                victim.deploy_to_kubernetes("k8s.yml.j2", "myapp")
+
+        # the other cluster is deployed to regardless
+        assert m_deploy.call_count == 2
+        assert [_.name for _ in e.value.failures] == ["deploy to first"]
+
+    def test_deploy_to_cluster(self, victim):
+        applied = [AppliedResource(KubernetesResource("v1", "Secret", "my-secret", None, {}), True)]
+        cluster = mock_cluster()
+        cluster.applier.apply.return_value = applied
+        RunSummary().clear()
+
+        with mock.patch.object(victim, "_connect", return_value=cluster) as m_connect, \
+                mock.patch.object(victim, "_ensure_image_pull_secret") as m_ensure:
+            assert victim._deploy_to_cluster("first", "myapp", "config", "pull") == applied
+
+        m_connect.assert_called_once_with("first")
+        m_ensure.assert_called_once_with(cluster, "myapp", "pull")
+        with mock.patch("takeoff.context.logger") as m_logger:
+            RunSummary().log()
+        assert "changed: 1, total: 1" in str(m_logger.mock_calls)
+
+    def test_deploy_to_cluster_waits_from_before_apply(self, victim):
+        cluster = mock_cluster()
+        applied_at = []
+        cluster.applier.apply.side_effect = \
+            lambda _: applied_at.append(datetime.datetime.now(datetime.timezone.utc)) or []
+
+        with mock.patch.dict(victim.config, {"wait_for_rollout": True}), \
+                mock.patch.object(victim, "_connect", return_value=cluster), \
+                mock.patch.object(victim, "_wait_for_rollout") as m_wait:
+            victim._deploy_to_cluster("first", "myapp", "config", None)
+
+        started_at = m_wait.call_args[0][2]
+        assert started_at <= applied_at[0]
+
 
 @dataclass(frozen=True)
 class MockValue:
@@ -181,14 +315,59 @@ class MockCredentialResults:
     kubeconfigs: List[MockValue]
 
 
+KUBECONFIG = """apiVersion: v1
+kind: Config
+clusters:
+- name: my-cluster
+  cluster:
+    server: https://my-cluster.hcp.westeurope.azmk8s.io:443
+contexts:
+- name: my-cluster
+  context:
+    cluster: my-cluster
+    user: my-user
+current-context: my-cluster
+users:
+- name: my-user
+  user:
+    token: my-token
+"""
+
+
 class TestBaseKubernetes():
-    @mock.patch.dict(os.environ, {"HOME": "myhome"})
-    def test_write_kube_config(self, victim: BaseKubernetes):
-        mopen = mock.mock_open()
-        with mock.patch("pathlib.Path.mkdir") as m_mkdir:
-            with mock.patch("builtins.open", mopen):
-                victim._write_kube_config(MockCredentialResults([MockValue("foo".encode(encoding="UTF-8"))]))
-
-        m_mkdir.assert_called_once_with(exist_ok=True)
-        mopen.assert_called_once_with(Path("myhome", ".kube", "config"), "w")
-        mopen().write.assert_called_once_with("foo")
+    @mock.patch("takeoff.azure.deploy_to_kubernetes.SubscriptionId.subscription_id",
+                return_value="my-subscription")
+    def test_authenticate_with_kubernetes(self, _, victim: BaseKubernetes):
+        KubeconfigCache().clear()
+        with mock.patch.object(victim, "_fetch_kubeconfig", return_value=KUBECONFIG) as m_fetch:
+            first = victim._authenticate_with_kubernetes()
+            second = victim._authenticate_with_kubernetes()
+
+        m_fetch.assert_called_once_with("my-subscription", "rgdev", "kubernetesdev")
+        assert first.host == second.host == "https://my-cluster.hcp.westeurope.azmk8s.io:443"
+        assert first.api_key == {"authorization": "Bearer my-token"}
+
+    @mock.patch("takeoff.azure.deploy_to_kubernetes.SubscriptionId.subscription_id",
+                return_value="my-subscription")
+    def test_authenticate_with_two_clusters(self, _, victim: BaseKubernetes):
+        KubeconfigCache().clear()
+        kubeconfigs = {"first": KUBECONFIG, "second": KUBECONFIG.replace("my-token", "other-token")}
+        with mock.patch.object(victim, "_fetch_kubeconfig", side_effect=lambda *args: kubeconfigs[args[2]]):
+            first = victim._authenticate_with_kubernetes("first")
+            second = victim._authenticate_with_kubernetes("second")
+
+        assert first.api_key == {"authorization": "Bearer my-token"}
+        assert second.api_key == {"authorization": "Bearer other-token"}
+        assert "authorization" not in Configuration().api_key
+
+    def test_fetch_kubeconfig(self, victim: BaseKubernetes):
+        with mock.patch("takeoff.azure.deploy_to_kubernetes.ActiveDirectoryUserCredentials"), \
+                mock.patch("takeoff.azure.deploy_to_kubernetes.ContainerServiceClient") as m_client:
+            m_client.return_value.managed_clusters.list_cluster_user_credentials.return_value = \
+                MockCredentialResults([MockValue(KUBECONFIG.encode(encoding="UTF-8"))])
+            result = victim._fetch_kubeconfig("my-subscription", "my-rg", "my-cluster")
+
+        assert result == KUBECONFIG
+        m_client.assert_called_once_with(credentials=mock.ANY, subscription_id="my-subscription")
+        m_client.return_value.managed_clusters.list_cluster_user_credentials.assert_called_once_with(
+            resource_group_name="my-rg", resource_name="my-cluster")
@@ -1,5 +1,5 @@
 import os
-from dataclasses import dataclass
+import threading
 from unittest import mock
 
 import pytest
@@ -7,6 +7,7 @@ import voluptuous as vol
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.deploy_to_databricks import JobConfig, SCHEMA, DeployToDatabricks
+from takeoff.util import ConcurrentTaskError
 from tests.azure import takeoff_config
 
 jobs = [
@@ -34,19 +35,18 @@ TEST_ENV_VARS = {
 }
 
 
-@dataclass
-class MockDatabricksClient:
-    def api_client(self, config):
-        return None
+def job_config_named(name, _):
+    return {"name": name}
 
 
 @pytest.fixture(autouse=True)
 @mock.patch.dict(os.environ, TEST_ENV_VARS)
 def victim():
+    m_databricks = mock.MagicMock()
     m_jobs_api_client = mock.MagicMock()
     m_runs_api_client = mock.MagicMock()
 
-    m_jobs_api_client.list_jobs.return_value = {
+    m_databricks.api_client.return_value.perform_query.return_value = {
         "jobs": [
             {"job_id": "id1", "settings": {"name": "job1"}},
             {"job_id": "id2", "settings": {"name": "job2"}},
@@ -62,9 +62,10 @@ def victim():
 
     with mock.patch("takeoff.azure.deploy_to_databricks.KeyVaultClient.vault_and_client", return_value=(None, None)), \
          mock.patch("takeoff.step.ApplicationName.get", return_value="my_app"), \
-         mock.patch("takeoff.azure.deploy_to_databricks.Databricks", return_value=MockDatabricksClient()), \
+         mock.patch("takeoff.azure.deploy_to_databricks.Databricks", return_value=m_databricks), \
          mock.patch("takeoff.azure.deploy_to_databricks.JobsApi", return_value=m_jobs_api_client), \
-         mock.patch("takeoff.azure.deploy_to_databricks.RunsApi", return_value=m_runs_api_client):
+         mock.patch("takeoff.azure.deploy_to_databricks.RunsApi", return_value=m_runs_api_client), \
+         mock.patch("takeoff.azure.deploy_to_databricks.InstancePoolsApi"):
         conf = {**takeoff_config(), **BASE_CONF}
         return DeployToDatabricks(ApplicationVersion('ACP', 'bar', 'foo'), conf)
 
@@ -602,10 +603,8 @@ class TestDeployToDatabricks(object):
             ) as kill_mock:
                 victim.remove_job("my-branch", {'name': ""}, True)
 
-        calls = [mock.call("id1"), mock.call("id2")]
-
-        victim.jobs_api.delete_job.assert_has_calls(calls)
-        kill_mock.assert_has_calls(calls)
+        victim.jobs_api.delete_job.assert_has_calls([mock.call("id1"), mock.call("id2")])
+        kill_mock.assert_has_calls([mock.call("id1", False), mock.call("id2", False)])
 
     def test_remove_non_existing_job(self, victim):
         with mock.patch(
@@ -616,11 +615,97 @@ class TestDeployToDatabricks(object):
 
         victim.jobs_api.delete_job.assert_not_called()
 
+    def test_list_jobs_paginated(self, victim):
+        victim.databricks_client.perform_query.side_effect = [
+            {"jobs": [{"job_id": 1, "settings": {"name": "job1"}}], "has_more": True},
+            {"jobs": [{"job_id": 2, "settings": {"name": "job2"}}], "has_more": False},
+        ]
+
+        assert victim._list_jobs() == [JobConfig("job1", 1), JobConfig("job2", 2)]
+
+        calls = [
+            mock.call("GET", "/jobs/list", data={"offset": 0, "limit": 25}),
+            mock.call("GET", "/jobs/list", data={"offset": 1, "limit": 25}),
+        ]
+        victim.databricks_client.perform_query.assert_has_calls(calls)
+
+    def test_job_index(self, victim):
+        victim.config["jobs"] = [{"name": ""}, {"name": "postfix"}]
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=[
+            JobConfig("my_app-SNAPSHOT", 1),
+            JobConfig("my_app-postfix-SNAPSHOT", 2),
+            JobConfig("my_app-postfix-1.2.3--my-version-postfix", 3),
+            JobConfig("other_app-SNAPSHOT", 4),
+        ]) as m:
+            assert victim.job_index == {
+                "my_app": [
+                    JobConfig("my_app-SNAPSHOT", 1),
+                    JobConfig("my_app-postfix-SNAPSHOT", 2),
+                    JobConfig("my_app-postfix-1.2.3--my-version-postfix", 3),
+                ],
+                "my_app-postfix": [
+                    JobConfig("my_app-postfix-SNAPSHOT", 2),
+                    JobConfig("my_app-postfix-1.2.3--my-version-postfix", 3),
+                ],
+            }
+            victim.remove_job("SNAPSHOT", {"name": "postfix"}, False)
+            victim.remove_job("SNAPSHOT", {"name": ""}, False)
+
+        m.assert_called_once()
+        victim.jobs_api.delete_job.assert_has_calls([mock.call(2), mock.call(3), mock.call(1)])
+        assert victim.job_index == {"my_app": [], "my_app-postfix": []}
+
     def test_kill_it_with_fire(self, victim):
         victim._kill_it_with_fire("my-id")
 
         calls = [mock.call("run1"), mock.call("run2")]
-        victim.runs_api.cancel_run.assert_has_calls(calls)
+        victim.runs_api.cancel_run.assert_has_calls(calls, any_order=True)
+        victim.runs_api.get_run.assert_not_called()
+
+    def test_kill_it_with_fire_paginated(self, victim):
+        victim.runs_api.list_runs.side_effect = [
+            {"runs": [{"run_id": "run1"}], "has_more": True},
+            {"runs": [{"run_id": "run2"}], "has_more": False},
+        ]
+        victim._kill_it_with_fire("my-id")
+
+        victim.runs_api.list_runs.assert_has_calls([
+            mock.call("my-id", active_only=True, completed_only=None, offset=0, limit=25),
+            mock.call("my-id", active_only=True, completed_only=None, offset=1, limit=25),
+        ])
+        victim.runs_api.cancel_run.assert_has_calls([mock.call("run1"), mock.call("run2")], any_order=True)
+
+    def test_kill_it_with_fire_no_runs(self, victim):
+        victim.runs_api.list_runs.return_value = {}
+        victim._kill_it_with_fire("my-id", True)
+
+        victim.runs_api.cancel_run.assert_not_called()
+
+    @mock.patch("takeoff.azure.deploy_to_databricks.time.sleep")
+    def test_kill_it_with_fire_wait_for_termination(self, m_sleep, victim):
+        states = {
+            "run1": iter(["RUNNING", "TERMINATING", "TERMINATED"]),
+            "run2": iter(["TERMINATING", "TERMINATED"]),
+        }
+        victim.runs_api.get_run.side_effect = lambda run_id: {
+            "state": {"life_cycle_state": next(states[run_id])}
+        }
+        victim._kill_it_with_fire("my-id", True)
+
+        m_sleep.assert_has_calls([mock.call(2), mock.call(4)])
+
+    def test_kill_it_with_fire_wait_for_termination_timeout(self, victim):
+        clock = [0]
+        victim.config["run_termination_timeout_seconds"] = 10
+        victim.runs_api.get_run.return_value = {"state": {"life_cycle_state": "TERMINATING"}}
+        with mock.patch("takeoff.azure.deploy_to_databricks.time") as m_time:
+            m_time.monotonic.side_effect = lambda: clock[0]
+            m_time.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+            with pytest.raises(TimeoutError):
+                victim._kill_it_with_fire("my-id", True)
+
+        m_time.sleep.assert_has_calls([mock.call(2), mock.call(4)])
+        assert m_time.sleep.call_count == 2
 
     def test_deploy_job_batch(self, victim):
         victim.deploy_job({}, False, True)
@@ -648,3 +733,286 @@ class TestDeployToDatabricks(object):
         victim.jobs_api.create_job.assert_called_with({})
 
         victim.jobs_api.run_now.assert_not_called()
+
+    def test_job_settings_equal(self, victim):
+        desired = {"name": "job", "new_cluster": {"num_workers": 1}, "libraries": [{"whl": "some.whl"}]}
+        current = {
+            "name": "job",
+            "new_cluster": {"num_workers": 1, "enable_elastic_disk": True},
+            "libraries": [{"whl": "some.whl"}],
+            "email_notifications": {},
+            "max_concurrent_runs": 1,
+        }
+        assert victim._job_settings_equal(desired, current)
+        assert not victim._job_settings_equal({**desired, "new_cluster": {"num_workers": 2}}, current)
+        assert not victim._job_settings_equal({**desired, "libraries": []}, current)
+        schedule = {"quartz_cron_expression": "0 * * * * ?"}
+        assert not victim._job_settings_equal(desired, {**current, "schedule": schedule})
+
+    def test_deploy_to_databricks_reconcile_unchanged(self, victim):
+        victim.config["reconcile_jobs"] = True
+        victim.jobs_api.get_job.return_value = {"settings": {"name": "my_app-bar"}}
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=[JobConfig("my_app-bar", 1)]), \
+                mock.patch.object(DeployToDatabricks, "create_config", return_value={"name": "my_app-bar"}):
+            victim.deploy_to_databricks()
+
+        victim.jobs_api.delete_job.assert_not_called()
+        victim.jobs_api.reset_job.assert_not_called()
+        victim.jobs_api.create_job.assert_not_called()
+        victim.runs_api.list_runs.assert_not_called()
+        victim.runs_api.cancel_run.assert_not_called()
+        victim.jobs_api.run_now.assert_not_called()
+
+    def test_deploy_to_databricks_reconcile_unchanged_snapshot(self, victim):
+        victim.config["reconcile_jobs"] = True
+        victim.jobs_api.get_job.return_value = {"settings": {"name": "my_app-SNAPSHOT"}}
+        job_config = {"name": "my_app-SNAPSHOT"}
+        with mock.patch.object(victim, "env", ApplicationVersion("ACP", "SNAPSHOT", "foo")), \
+                mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=[
+                    JobConfig("my_app-SNAPSHOT", 1),
+                    JobConfig("my_app-1.0.0", 2),
+                ]), \
+                mock.patch.object(DeployToDatabricks, "create_config", return_value=job_config):
+            victim.deploy_to_databricks()
+
+        victim.jobs_api.delete_job.assert_called_once_with(2)
+        victim.jobs_api.reset_job.assert_not_called()
+        victim.jobs_api.create_job.assert_not_called()
+        victim.runs_api.cancel_run.assert_has_calls([mock.call("run1"), mock.call("run2")], any_order=True)
+        victim.jobs_api.run_now.assert_called_once_with(
+            job_id=1, jar_params=None, notebook_params=None, python_params=None, spark_submit_params=None
+        )
+
+    def test_deploy_to_databricks_reconcile_changed(self, victim):
+        victim.config["reconcile_jobs"] = True
+        victim.jobs_api.get_job.return_value = {"settings": {"name": "my_app-bar", "max_retries": 1}}
+        job_config = {"name": "my_app-bar", "max_retries": 5, "schedule": {}}
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=[JobConfig("my_app-bar", 1)]), \
+                mock.patch.object(DeployToDatabricks, "create_config", return_value=job_config):
+            victim.deploy_to_databricks()
+
+        victim.jobs_api.reset_job.assert_called_once_with({"job_id": 1, "new_settings": job_config})
+        victim.jobs_api.delete_job.assert_not_called()
+        victim.jobs_api.create_job.assert_not_called()
+        victim.jobs_api.run_now.assert_not_called()
+
+    def test_deploy_to_databricks_reconcile_new_name(self, victim):
+        victim.config["reconcile_jobs"] = True
+        jobs = [JobConfig("my_app-SNAPSHOT", 2)]
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=jobs), \
+                mock.patch.object(DeployToDatabricks, "create_config", return_value={"name": "my_app-bar"}):
+            victim.deploy_to_databricks()
+
+        victim.jobs_api.get_job.assert_not_called()
+        victim.jobs_api.delete_job.assert_called_once_with(2)
+        victim.jobs_api.create_job.assert_called_once_with({"name": "my_app-bar"})
+
+    def test_deploy_to_databricks_multiple_jobs(self, victim):
+        victim.config["jobs"] = [
+            {"main_name": "Dave", "name": "first", "is_batch": True, "run_stream_job_immediately": True},
+            {"main_name": "Dave", "name": "second", "is_batch": True, "run_stream_job_immediately": True},
+            {"main_name": "Dave", "name": "first", "is_batch": True, "run_stream_job_immediately": True},
+        ]
+        victim.jobs_api.create_job.side_effect = lambda config: {"job_id": config["name"]}
+        jobs = [JobConfig("my_app-first-SNAPSHOT", 1), JobConfig("my_app-second-SNAPSHOT", 2)]
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=jobs), \
+                mock.patch.object(DeployToDatabricks, "create_config", side_effect=job_config_named):
+            victim.deploy_to_databricks()
+
+        # Jobs with the same name are deployed in order, so the second one replaces the first
+        victim.jobs_api.delete_job.assert_has_calls(
+            [mock.call(1), mock.call(2), mock.call("my_app-first-bar")], any_order=True
+        )
+        assert victim.jobs_api.create_job.call_count == 3
+        assert victim.job_index["my_app-first"] == [JobConfig("my_app-first-bar", "my_app-first-bar")]
+
+    def test_deploy_to_databricks_aggregates_failures(self, victim):
+        victim.config["jobs"] = [
+            {"main_name": "Dave", "name": "fails", "is_batch": True, "run_stream_job_immediately": True},
+            {"main_name": "Dave", "name": "succeeds", "is_batch": True, "run_stream_job_immediately": True},
+        ]
+
+        def create_job(config):
+            if config["name"].startswith("my_app-fails"):
+                raise ValueError("invalid job")
+            return {"job_id": 1}
+
+        victim.jobs_api.create_job.side_effect = create_job
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=[]), \
+                mock.patch.object(DeployToDatabricks, "create_config", side_effect=job_config_named):
+            with pytest.raises(ConcurrentTaskError) as e:
+                victim.deploy_to_databricks()
+
+        assert [_.name for _ in e.value.failures] == ["my_app-fails"]
+        victim.jobs_api.create_job.assert_any_call({"name": "my_app-succeeds-bar"})
+
+    @mock.patch("takeoff.azure.deploy_to_databricks.time.sleep")
+    def test_deploy_to_databricks_handover(self, m_sleep, victim):
+        victim.config["jobs"][0].update({"name": "", "is_batch": False, "run_stream_job_immediately": True,
+                                         "handover": True, "wait_for_termination": False})
+        actions = []
+        states = iter(["PENDING", "RUNNING"])
+        victim.runs_api.get_run.side_effect = lambda run_id: {"state": {"life_cycle_state": next(states)}}
+        victim.runs_api.cancel_run.side_effect = lambda run_id: actions.append(f"cancel {run_id}")
+        victim.jobs_api.run_now.side_effect = lambda **_: actions.append("run_now") or {"run_id": "new-run"}
+        jobs = [JobConfig("my_app-SNAPSHOT", 2)]
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=jobs), \
+                mock.patch.object(DeployToDatabricks, "create_config", return_value={"name": "my_app-bar"}):
+            victim.deploy_to_databricks()
+
+        assert actions == ["run_now", "cancel run1", "cancel run2"]
+        victim.runs_api.get_run.assert_has_calls([mock.call("new-run"), mock.call("new-run")])
+        victim.jobs_api.delete_job.assert_called_once_with(2)
+        assert victim.job_index["my_app"] == [JobConfig("my_app-bar", "job1")]
+
+    def test_deploy_to_databricks_handover_failed_run(self, victim):
+        victim.config["jobs"][0].update({"name": "", "is_batch": False, "run_stream_job_immediately": True,
+                                         "handover": True, "wait_for_termination": False})
+        victim.runs_api.get_run.return_value = {"state": {"life_cycle_state": "INTERNAL_ERROR"}}
+        jobs = [JobConfig("my_app-SNAPSHOT", 2)]
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=jobs), \
+                mock.patch.object(DeployToDatabricks, "create_config", return_value={"name": "my_app-bar"}):
+            with pytest.raises(ConcurrentTaskError) as e:
+                victim.deploy_to_databricks()
+
+        assert isinstance(e.value.failures[0].exception, RuntimeError)
+        # only the new job is removed, the old job keeps running
+        victim.runs_api.list_runs.assert_called_once_with("job1", active_only=True, completed_only=None,
+                                                          offset=0, limit=mock.ANY)
+        victim.jobs_api.delete_job.assert_called_once_with("job1")
+        assert victim.job_index["my_app"] == [JobConfig("my_app-SNAPSHOT", 2)]
+
+    def test_deploy_to_databricks_handover_timeout(self, victim):
+        victim.config["jobs"][0].update({"name": "", "is_batch": False, "run_stream_job_immediately": True,
+                                         "handover": True, "wait_for_termination": False})
+        # shorter than the first poll interval, so the wait times out right away
+        victim.config["handover_timeout_seconds"] = 1
+        victim.runs_api.get_run.return_value = {"state": {"life_cycle_state": "PENDING"}}
+        jobs = [JobConfig("my_app-SNAPSHOT", 2)]
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=jobs), \
+                mock.patch.object(DeployToDatabricks, "create_config", return_value={"name": "my_app-bar"}):
+            with pytest.raises(ConcurrentTaskError) as e:
+                victim.deploy_to_databricks()
+
+        assert isinstance(e.value.failures[0].exception, TimeoutError)
+        victim.runs_api.cancel_run.assert_has_calls([mock.call("run1"), mock.call("run2")], any_order=True)
+        victim.jobs_api.delete_job.assert_called_once_with("job1")
+        assert victim.job_index["my_app"] == [JobConfig("my_app-SNAPSHOT", 2)]
+
+    def test_wait_for_run_ready_pending(self, victim):
+        victim.config["handover_ready_state"] = "PENDING"
+        victim.runs_api.get_run.return_value = {"state": {"life_cycle_state": "RUNNING"}}
+        victim._wait_for_run_ready("new-run")
+
+        victim.runs_api.get_run.assert_called_once_with("new-run")
+
+    def instance_pool_config(self, **kwargs):
+        return {"name": "my-pool", "node_type_id": "Standard_DS3_v2", "min_idle_instances": 0,
+                "idle_instance_autotermination_minutes": 60, "preloaded_spark_versions": [],
+                "prewarm_instances": 0, "prewarm_timeout_seconds": 10, **kwargs}
+
+    def test_ensure_instance_pool_creates_pool(self, victim):
+        victim.config["instance_pool"] = self.instance_pool_config(prewarm_instances=2)
+        victim.instance_pools_api.list_instance_pools.return_value = {}
+        victim.instance_pools_api.create_instance_pool.return_value = {"instance_pool_id": "pool1"}
+
+        assert victim._ensure_instance_pool() == "pool1"
+        victim.instance_pools_api.create_instance_pool.assert_called_once_with({
+            "instance_pool_name": "my-pool",
+            "node_type_id": "Standard_DS3_v2",
+            "min_idle_instances": 2,
+            "idle_instance_autotermination_minutes": 60,
+            "preloaded_spark_versions": [],
+        })
+
+    def test_ensure_instance_pool_updates_pool(self, victim):
+        victim.config["instance_pool"] = self.instance_pool_config(max_capacity=10)
+        existing = {"instance_pool_id": "pool1", "instance_pool_name": "my-pool",
+                    "node_type_id": "Standard_DS3_v2", "min_idle_instances": 0,
+                    "idle_instance_autotermination_minutes": 60, "preloaded_spark_versions": [],
+                    "max_capacity": 5, "stats": {"idle_count": 0}}
+        victim.instance_pools_api.list_instance_pools.return_value = {"instance_pools": [existing]}
+
+        assert victim._ensure_instance_pool() == "pool1"
+        victim.instance_pools_api.edit_instance_pool.assert_called_once()
+        assert victim.instance_pools_api.edit_instance_pool.call_args[0][0]["max_capacity"] == 10
+
+        existing["max_capacity"] = 10
+        victim.instance_pools_api.edit_instance_pool.reset_mock()
+        victim._ensure_instance_pool()
+        victim.instance_pools_api.edit_instance_pool.assert_not_called()
+
+    def test_attach_instance_pool(self, victim):
+        victim._instance_pool_id = "pool1"
+        job_config = {"new_cluster": {"node_type_id": "Standard_DS3_v2", "num_workers": 1}}
+        victim._attach_instance_pool(job_config)
+        assert job_config == {"new_cluster": {"instance_pool_id": "pool1", "num_workers": 1}}
+
+        cluster = {"instance_pool_id": "other-pool", "node_type_id": "Standard_DS3_v2"}
+        job_config = {"new_cluster": dict(cluster)}
+        victim._attach_instance_pool(job_config)
+        assert job_config == {"new_cluster": cluster}
+
+        job_config = {"existing_cluster_id": "cluster1"}
+        victim._attach_instance_pool(job_config)
+        assert job_config == {"existing_cluster_id": "cluster1"}
+
+    @mock.patch("takeoff.azure.deploy_to_databricks.time.sleep")
+    def test_deploy_to_databricks_with_prewarm(self, m_sleep, victim):
+        victim.config["jobs"][0].update({"name": "", "is_batch": False, "run_stream_job_immediately": True,
+                                         "handover": False, "wait_for_termination": False})
+        victim.config["instance_pool"] = self.instance_pool_config(prewarm_instances=2)
+        victim.instance_pools_api.list_instance_pools.return_value = {}
+        victim.instance_pools_api.create_instance_pool.return_value = {"instance_pool_id": "pool1"}
+        victim.instance_pools_api.get_instance_pool.side_effect = [
+            {"stats": {"idle_count": 0}}, {"stats": {"idle_count": 2}}
+        ]
+        job_config = {"name": "my_app-bar", "new_cluster": {"node_type_id": "DS3"}}
+        with mock.patch.object(DeployToDatabricks, "_list_jobs", return_value=[]), \
+                mock.patch.object(DeployToDatabricks, "_construct_job_config", return_value=job_config):
+            victim.deploy_to_databricks()
+
+        victim.jobs_api.create_job.assert_called_once_with(
+            {"name": "my_app-bar", "new_cluster": {"instance_pool_id": "pool1"}}
+        )
+        victim.jobs_api.run_now.assert_called_once()
+        m_sleep.assert_called_once_with(2)
+        victim.instance_pools_api.edit_instance_pool.assert_called_once()
+        assert victim.instance_pools_api.edit_instance_pool.call_args[0][0]["min_idle_instances"] == 0
+
+    def test_wait_for_warm_instance_pool_timeout(self, victim):
+        clock = [0]
+        victim._instance_pool_id = "pool1"
+        victim.config["instance_pool"] = self.instance_pool_config(prewarm_instances=2)
+        victim.instance_pools_api.get_instance_pool.return_value = {"stats": {"idle_count": 1}}
+        with mock.patch("takeoff.azure.deploy_to_databricks.time") as m_time:
+            m_time.monotonic.side_effect = lambda: clock[0]
+            m_time.sleep.side_effect = lambda seconds: clock.__setitem__(0, clock[0] + seconds)
+            victim._wait_for_warm_instance_pool()
+            victim._wait_for_warm_instance_pool()
+
+        assert m_time.sleep.call_count == 2
+
+    def test_wait_for_warm_instance_pool_concurrently(self, victim):
+        victim._instance_pool_id = "pool1"
+        victim.config["instance_pool"] = self.instance_pool_config(prewarm_instances=2)
+        polling = threading.Event()
+        release = threading.Event()
+
+        def _poll(*args):
+            polling.set()
+            release.wait(5)
+
+        with mock.patch.object(victim, "_poll_with_backoff", side_effect=_poll) as m_poll:
+            first = threading.Thread(target=victim._wait_for_warm_instance_pool)
+            first.start()
+            polling.wait(5)
+            second = threading.Thread(target=victim._wait_for_warm_instance_pool)
+            second.start()
+            # give the second thread time to reach the pool, while the first one is still polling
+            second.join(0.2)
+            release.set()
+            first.join(5)
+            second.join(5)
+
+        m_poll.assert_called_once()
@@ -0,0 +1,250 @@
+import json
+from unittest import mock
+
+import pytest
+
+from kubernetes.client.rest import ApiException
+
+from takeoff.azure.kubernetes_apply import (
+    CONFIG_HASH_ANNOTATION,
+    INPUTS_HASH_ANNOTATION,
+    KubernetesApplier,
+    KubernetesResource,
+    parse_manifest,
+    with_config_hashes,
+)
+from takeoff.util import ConcurrentTaskError
+
+MANIFEST = """apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: my-app
+  namespace: my-namespace
+---
+apiVersion: v1
+kind: Secret
+metadata:
+  name: my-secret
+---
+---
+apiVersion: v1
+kind: List
+items:
+- apiVersion: v1
+  kind: Namespace
+  metadata:
+    name: my-namespace
+"""
+
+DISCOVERY = {
+    "/api/v1": {
+        "resources": [
+            {"name": "namespaces", "kind": "Namespace", "namespaced": False},
+            {"name": "secrets", "kind": "Secret", "namespaced": True},
+            {"name": "pods/log", "kind": "Pod", "namespaced": True},
+        ]
+    },
+    "/apis/apps/v1": {
+        "resources": [
+            {"name": "deployments", "kind": "Deployment", "namespaced": True},
+            {"name": "deployments/scale", "kind": "Scale", "namespaced": True},
+        ]
+    },
+}
+
+
+class FakeApiServer(object):
+    """Serves discovery, and stores resources that are applied"""
+
+    def __init__(self):
+        self.resources = {}
+
+    def call_api(self, path, method, body=None, **kwargs):
+        if method == "GET" and path in DISCOVERY:
+            return DISCOVERY[path]
+        if method == "GET":
+            if path not in self.resources:
+                raise ApiException(status=404)
+            return self.resources[path]
+        if method == "POST":
+            path = f"{path}/{body['metadata']['name']}"
+            if path in self.resources:
+                raise ApiException(status=409)
+            self.resources[path] = body
+        if kwargs["header_params"]["Content-Type"] == "application/apply-patch+yaml":
+            self.resources[path] = json.loads(body)
+        return body
+
+
+@pytest.fixture
+def api_client():
+    m_client = mock.Mock()
+    m_client.call_api.side_effect = FakeApiServer().call_api
+    return m_client
+
+
+def patches(api_client):
+    return [_ for _ in api_client.call_api.call_args_list if _[0][1] == "PATCH"]
+
+
+def test_parse_manifest():
+    resources = list(parse_manifest(MANIFEST))
+
+    assert [str(_) for _ in resources] == ["Deployment/my-app", "Secret/my-secret", "Namespace/my-namespace"]
+    assert resources[0] == KubernetesResource(
+        "apps/v1", "Deployment", "my-app", "my-namespace",
+        {
+            "apiVersion": "apps/v1",
+            "kind": "Deployment",
+            "metadata": {"name": "my-app", "namespace": "my-namespace"},
+        },
+    )
+    assert resources[1].namespace is None
+
+
+def test_apply(api_client):
+    applied = KubernetesApplier(api_client).apply(parse_manifest(MANIFEST))
+
+    calls = patches(api_client)
+    # the namespace goes first, as the other resources may live in it
+    assert calls[0][0][0] == "/api/v1/namespaces/my-namespace"
+    assert {_[0][0] for _ in calls[1:]} == {
+        "/apis/apps/v1/namespaces/my-namespace/deployments/my-app",
+        "/api/v1/namespaces/default/secrets/my-secret",
+    }
+    for call in calls:
+        assert call[1]["query_params"] == [("fieldManager", "takeoff"), ("force", "true")]
+        assert call[1]["header_params"]["Content-Type"] == "application/apply-patch+yaml"
+    assert json.loads(calls[0][1]["body"])["metadata"]["name"] == "my-namespace"
+    assert [str(_.resource) for _ in applied] == [
+        "Namespace/my-namespace", "Secret/my-secret", "Deployment/my-app"
+    ]
+    assert all(_.changed for _ in applied)
+
+
+def test_apply_discovers_each_group_once(api_client):
+    applier = KubernetesApplier(api_client)
+    applier.apply(parse_manifest(MANIFEST))
+    applier.apply(parse_manifest(MANIFEST))
+
+    discoveries = [_[0][0] for _ in api_client.call_api.call_args_list if _[0][0] in DISCOVERY]
+    assert sorted(discoveries) == ["/api/v1", "/apis/apps/v1"]
+
+
+def test_apply_unknown_kind(api_client):
+    manifest = """apiVersion: apps/v1
+kind: Potato
+metadata:
+  name: my-potato
+"""
+    with pytest.raises(ConcurrentTaskError):
+        KubernetesApplier(api_client).apply(parse_manifest(manifest))
+
+
+def test_restart(api_client):
+    KubernetesApplier(api_client).restart(parse_manifest(MANIFEST))
+
+    calls = patches(api_client)
+    assert len(calls) == 1
+    assert calls[0][0][0] == "/apis/apps/v1/namespaces/my-namespace/deployments/my-app"
+    assert calls[0][1]["header_params"]["Content-Type"] == "application/strategic-merge-patch+json"
+    annotations = calls[0][1]["body"]["spec"]["template"]["metadata"]["annotations"]
+    assert "kubectl.kubernetes.io/restartedAt" in annotations
+
+
+WORKLOADS = """apiVersion: v1
+kind: Secret
+metadata:
+  name: my-secret
+data:
+  password: {password}
+---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: uses-secret
+spec:
+  template:
+    spec:
+      containers:
+      - name: app
+        env:
+        - name: PASSWORD
+          valueFrom:
+            secretKeyRef:
+              name: my-secret
+              key: password
+---
+apiVersion: apps/v1
+kind: Deployment
+metadata:
+  name: no-secret
+spec:
+  template:
+    spec:
+      containers:
+      - name: app
+"""
+
+
+KEY = b"0123456789abcdef"
+
+
+def test_with_config_hashes():
+    first = with_config_hashes(parse_manifest(WORKLOADS.format(password="aaa")), KEY)
+    second = with_config_hashes(parse_manifest(WORKLOADS.format(password="bbb")), KEY)
+
+    assert all(_.config_hash for _ in first)
+    assert [a.config_hash == b.config_hash for a, b in zip(first, second)] == [False, False, True]
+    assert INPUTS_HASH_ANNOTATION in first[1].body["spec"]["template"]["metadata"]["annotations"]
+    assert "metadata" not in first[2].body["spec"]["template"]
+
+
+def test_with_config_hashes_depend_on_key():
+    first = with_config_hashes(parse_manifest(WORKLOADS.format(password="aaa")), KEY)
+    second = with_config_hashes(parse_manifest(WORKLOADS.format(password="aaa")), b"another key")
+
+    assert [a.config_hash == b.config_hash for a, b in zip(first, second)] == [False, False, False]
+
+
+def test_with_config_hashes_default_namespace():
+    manifest = WORKLOADS.replace("  name: my-secret\n", "  name: my-secret\n  namespace: default\n", 1)
+    annotated = with_config_hashes(parse_manifest(manifest.format(password="aaa")), KEY, "default")
+
+    assert INPUTS_HASH_ANNOTATION in annotated[1].body["spec"]["template"]["metadata"]["annotations"]
+
+
+def test_with_config_hashes_does_not_modify_resources():
+    resources = list(parse_manifest(WORKLOADS.format(password="aaa")))
+    with_config_hashes(resources, KEY)
+    assert CONFIG_HASH_ANNOTATION not in str(resources)
+
+
+def test_apply_creates_hash_key(api_client):
+    server = FakeApiServer()
+    api_client.call_api.side_effect = server.call_api
+    KubernetesApplier(api_client).apply(parse_manifest(WORKLOADS.format(password="aaa")))
+    key_path = "/api/v1/namespaces/default/secrets/takeoff-config-hash-key"
+    key = server.resources[key_path]["data"]["key"]
+
+    # another deployment reuses the key, so it finds the resources unchanged
+    applied = KubernetesApplier(api_client).apply(parse_manifest(WORKLOADS.format(password="aaa")))
+
+    assert not any(_.changed for _ in applied)
+    assert server.resources[key_path]["data"]["key"] == key
+
+
+def test_apply_skips_unchanged(api_client):
+    applier = KubernetesApplier(api_client)
+    applier.apply(parse_manifest(WORKLOADS.format(password="aaa")))
+    api_client.call_api.reset_mock()
+
+    applied = applier.apply(parse_manifest(WORKLOADS.format(password="bbb")))
+
+    assert [(str(_.resource), _.changed) for _ in applied] == [
+        ("Secret/my-secret", True), ("Deployment/uses-secret", True), ("Deployment/no-secret", False)
+    ]
+    assert {_[0][0] for _ in patches(api_client)} == {
+        "/api/v1/namespaces/default/secrets/my-secret",
+        "/apis/apps/v1/namespaces/default/deployments/uses-secret",
+    }
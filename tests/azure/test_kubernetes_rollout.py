@@ -0,0 +1,142 @@
+import datetime
+from unittest import mock
+
+import pytest
+
+from takeoff.azure.kubernetes_apply import KubernetesResource
+from takeoff.azure.kubernetes_rollout import RolloutError, RolloutTracker, is_ready, rollout_failure
+
+
+def deployment(name: str, generation: int = 2, observed: int = 2, updated: int = 2, available: int = 2,
+               replicas: int = 2, conditions=None) -> dict:
+    return {
+        "metadata": {"name": name, "namespace": "default", "generation": generation},
+        "spec": {"replicas": 2},
+        "status": {"observedGeneration": observed, "replicas": replicas, "updatedReplicas": updated,
+                   "availableReplicas": available, "conditions": conditions},
+    }
+
+
+def pod(name: str, reason: str, labels: dict, created: datetime.datetime) -> dict:
+    return {
+        "metadata": {"name": name, "namespace": "default", "labels": labels,
+                     "creationTimestamp": created.strftime("%Y-%m-%dT%H:%M:%SZ")},
+        "status": {"containerStatuses": [{"state": {"waiting": {"reason": reason}}}]},
+    }
+
+
+def resource(kind: str, name: str) -> KubernetesResource:
+    return KubernetesResource("apps/v1", kind, name, None,
+                              {"spec": {"selector": {"matchLabels": {"app": name}}}})
+
+
+def tracker() -> RolloutTracker:
+    victim = RolloutTracker(mock.Mock(), timeout_seconds=2)
+    victim._list_functions = {kind: kind for kind in ("Deployment", "StatefulSet", "DaemonSet", "Pod")}
+    return victim
+
+
+def watching(events: dict):
+    def stream(kind, namespace, **kwargs):
+        return iter([{"type": "MODIFIED", "raw_object": _} for _ in events.get(kind, [])])
+
+    m_watch = mock.Mock()
+    m_watch.return_value.stream.side_effect = stream
+    return mock.patch("takeoff.azure.kubernetes_rollout.Watch", m_watch)
+
+
+def test_is_ready_deployment():
+    assert is_ready("Deployment", deployment("app"))
+    assert not is_ready("Deployment", deployment("app", observed=1))
+    assert not is_ready("Deployment", deployment("app", updated=1))
+    assert not is_ready("Deployment", deployment("app", replicas=3))
+    assert not is_ready("Deployment", deployment("app", available=1))
+
+
+def test_is_ready_stateful_set():
+    stateful_set = {"metadata": {"generation": 1}, "spec": {"replicas": 2},
+                    "status": {"observedGeneration": 1, "readyReplicas": 2, "updateRevision": "b",
+                               "currentRevision": "a"}}
+    assert not is_ready("StatefulSet", stateful_set)
+    stateful_set["status"]["currentRevision"] = "b"
+    assert is_ready("StatefulSet", stateful_set)
+
+
+def test_is_ready_daemon_set():
+    daemon_set = {"metadata": {"generation": 1},
+                  "status": {"observedGeneration": 1, "desiredNumberScheduled": 3,
+                             "updatedNumberScheduled": 3, "numberAvailable": 2}}
+    assert not is_ready("DaemonSet", daemon_set)
+    daemon_set["status"]["numberAvailable"] = 3
+    assert is_ready("DaemonSet", daemon_set)
+
+
+def test_rollout_failure():
+    conditions = [{"type": "Progressing", "reason": "ProgressDeadlineExceeded", "message": "too slow"}]
+    assert rollout_failure("Deployment", deployment("app", conditions=conditions)) == "too slow"
+    assert rollout_failure("Deployment", deployment("app")) is None
+
+
+def test_wait():
+    events = {"Deployment": [deployment("first", updated=1), deployment("second"), deployment("first"),
+                             deployment("unrelated", updated=0)]}
+
+    with watching(events):
+        ready_after = tracker().wait([resource("Deployment", "first"), resource("Deployment", "second"),
+                                      KubernetesResource("v1", "Secret", "secret", None, {})])
+
+    assert set(ready_after) == {"Deployment/first", "Deployment/second"}
+
+
+def test_wait_without_workloads():
+    assert tracker().wait([KubernetesResource("v1", "Secret", "secret", None, {})]) == {}
+
+
+def test_wait_fails_on_crash_looping_pod():
+    started_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(minutes=1)
+    now = datetime.datetime.utcnow()
+    events = {"Deployment": [deployment("first", updated=1)],
+              "Pod": [pod("other-pod", "CrashLoopBackOff", {"app": "other"}, now),
+                      pod("first-pod", "CrashLoopBackOff", {"app": "first"}, now)]}
+
+    with watching(events):
+        with pytest.raises(RolloutError, match="first-pod is in CrashLoopBackOff"):
+            tracker().wait([resource("Deployment", "first")], started_at)
+
+
+def test_wait_fails_on_pod_created_before_waiting():
+    started_at = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(seconds=30)
+    # created while the resources were applied, before waiting started
+    created = datetime.datetime.utcnow() - datetime.timedelta(seconds=10)
+    events = {"Deployment": [deployment("first", updated=1)],
+              "Pod": [pod("first-pod", "CrashLoopBackOff", {"app": "first"}, created)]}
+
+    with watching(events):
+        with pytest.raises(RolloutError, match="first-pod is in CrashLoopBackOff"):
+            tracker().wait([resource("Deployment", "first")], started_at)
+
+
+def test_wait_ignores_pods_from_before_the_rollout():
+    before = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+    events = {"Pod": [pod("first-pod", "CrashLoopBackOff", {"app": "first"}, before)],
+              "Deployment": [deployment("first")]}
+
+    with watching(events):
+        assert set(tracker().wait([resource("Deployment", "first")])) == {"Deployment/first"}
+
+
+def test_wait_timeout():
+    events = {"Deployment": [deployment("first", updated=1)]}
+
+    with watching(events):
+        victim = tracker()
+        victim.timeout_seconds = 0.1
+        with pytest.raises(TimeoutError, match="Deployment/first"):
+            victim.wait([resource("Deployment", "first")])
+
+
+def test_wait_watch_error():
+    with mock.patch("takeoff.azure.kubernetes_rollout.Watch") as m_watch:
+        m_watch.return_value.stream.side_effect = ValueError("connection lost")
+        with pytest.raises(ValueError, match="connection lost"):
+            tracker().wait([resource("Deployment", "first")])
@@ -1,17 +1,74 @@
+import base64
 import glob
+import hashlib
 import os
+import tempfile
+import threading
 import unittest
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from unittest import mock
 
 import azure
 import pytest
+import requests
 import voluptuous as vol
+from twine.settings import Settings
 
 from takeoff.application_version import ApplicationVersion
 from takeoff.azure.publish_artifact import PublishArtifact as victim
-from takeoff.azure.publish_artifact import language_must_match_target
+from takeoff.azure.publish_artifact import _project_name, language_must_match_target
+from takeoff.util import ConcurrentTaskError
 from tests.azure import takeoff_config
 
+STORE_SETTINGS = "takeoff.azure.publish_artifact.ArtifactStore.store_settings"
+
+
+@contextmanager
+def pypi_stand_in(wheel_hash: str = None, projects=("my-app",)):
+    """Serves a simple API (PEP 503) index on localhost containing the wheel of `my-app`"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        dists = [
+            os.path.join(tmp_dir, "my_app-1.0.0-py3-none-any.whl"),
+            os.path.join(tmp_dir, "my-app-1.0.0.tar.gz"),
+        ]
+        for dist in dists:
+            with open(dist, "wb") as f:
+                f.write(dist.encode())
+        with open(dists[0], "rb") as f:
+            digest = wheel_hash or hashlib.sha256(f.read()).hexdigest()
+
+        class SimpleIndex(BaseHTTPRequestHandler):
+            def do_HEAD(self):
+                self.send_response(200 if self.path == "/simple/" else 404)
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path not in [f"/simple/{_}/" for _ in projects]:
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.end_headers()
+                self.wfile.write(
+                    f'<a href="../../packages/my_app-1.0.0-py3-none-any.whl#sha256={digest}">'
+                    f'my_app-1.0.0-py3-none-any.whl</a>'.encode()
+                )
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("localhost", 0), SimpleIndex)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            yield Settings(
+                repository_url=f"http://localhost:{server.server_port}", username="user", password="pass"
+            ), dists
+        finally:
+            server.shutdown()
+
+
 BASE_CONF = {
     "task": "publish_artifact",
     "language": "python",
@@ -132,6 +189,34 @@ class TestPublishArtifact(unittest.TestCase):
                  mock.call(file="main.py", file_extension=".py")]
         m.assert_has_calls(calls)
 
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    @mock.patch.object(victim, "_get_wheel", return_value="some.whl")
+    def test_publish_python_package_multiple_targets(self, m1, m2, m3):
+        conf = {**takeoff_config(), **BASE_CONF, "target": ["pypi", "cloud_storage"]}
+
+        with mock.patch.object(victim, 'upload_to_cloud_storage') as m_blob, \
+                mock.patch.object(victim, 'publish_to_pypi') as m_pypi:
+            victim(FAKE_ENV, conf).publish_python_package()
+
+        m_pypi.assert_called_once()
+        m_blob.assert_called_once_with(file="some.whl", file_extension=".whl")
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    @mock.patch.object(victim, "_get_jar", return_value="some.jar")
+    def test_publish_jvm_package_failing_target(self, m1, m2, m3):
+        conf = {**takeoff_config(), **BASE_CONF, "language": "scala", "target": ["ivy", "cloud_storage"]}
+
+        with mock.patch.object(victim, 'upload_to_cloud_storage') as m_blob, \
+                mock.patch.object(victim, 'publish_to_ivy', side_effect=ChildProcessError) as m_ivy:
+            with pytest.raises(ConcurrentTaskError) as e:
+                victim(FAKE_ENV, conf).publish_jvm_package()
+
+        m_ivy.assert_called_once()
+        m_blob.assert_called_once_with(file="some.jar", file_extension=".jar")
+        assert [_.name for _ in e.value.failures] == ["ivy"]
+
     @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
     @mock.patch.object(victim, "_get_jar", return_value="some.jar")
@@ -184,15 +269,98 @@ class TestPublishArtifact(unittest.TestCase):
         m.assert_not_called()
 
     @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
-    @mock.patch("takeoff.azure.publish_artifact.ArtifactStore.store_settings", return_value="foo")
     @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "my-app"})
     @mock.patch("takeoff.azure.publish_artifact.get_tag", return_value="a tag")
-    def test_publish_to_pypi(self, m1, m2, m3):
+    def test_publish_to_pypi(self, m1, m2):
         conf = {**takeoff_config(), **BASE_CONF, "language": "python", "target": ["pypi"]}
         env = ApplicationVersion('prd', '1.0.0', 'branch')
-        with mock.patch("takeoff.azure.publish_artifact.upload") as m:
-            victim(env, conf).publish_to_pypi()
-        m.assert_called_once_with(upload_settings="foo", dists=["dist/*"])
+        with pypi_stand_in() as (settings, dists):
+            with mock.patch(STORE_SETTINGS, return_value=settings), \
+                    mock.patch.object(victim, "_get_distributions", return_value=dists), \
+                    mock.patch("takeoff.azure.publish_artifact.upload") as m:
+                victim(env, conf).publish_to_pypi()
+        # the wheel is already present on the index with the same hash
+        m.assert_called_once_with(settings, [dists[1]])
+
+    @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "my-app"})
+    @mock.patch("takeoff.azure.publish_artifact.get_tag", return_value="a tag")
+    def test_publish_to_pypi_hash_mismatch(self, m1, m2):
+        conf = {**takeoff_config(), **BASE_CONF, "language": "python", "target": ["pypi"]}
+        env = ApplicationVersion('prd', '1.0.0', 'branch')
+        with pypi_stand_in(wheel_hash="not-the-same") as (settings, dists):
+            with mock.patch(STORE_SETTINGS, return_value=settings), \
+                    mock.patch.object(victim, "_get_distributions", return_value=dists), \
+                    mock.patch("takeoff.azure.publish_artifact.upload") as m:
+                with pytest.raises(ValueError):
+                    victim(env, conf).publish_to_pypi()
+        m.assert_not_called()
+
+    @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "my-app"})
+    @mock.patch("takeoff.azure.publish_artifact.get_tag", return_value="a tag")
+    def test_publish_to_pypi_new_project(self, m1, m2):
+        env = ApplicationVersion('prd', '1.0.0', 'branch')
+        with pypi_stand_in(projects=()) as (settings, dists):
+            conf = {
+                **takeoff_config(),
+                **BASE_CONF,
+                "language": "python",
+                "target": ["pypi"],
+                "pypi_index_url": f"{settings.repository_config['repository']}/simple/",
+            }
+            with mock.patch(STORE_SETTINGS, return_value=settings), \
+                    mock.patch.object(victim, "_get_distributions", return_value=dists), \
+                    mock.patch("takeoff.azure.publish_artifact.upload") as m:
+                victim(env, conf).publish_to_pypi()
+        m.assert_has_calls([mock.call(settings, [dists[0]]), mock.call(settings, [dists[1]])], any_order=True)
+
+    @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "my-app"})
+    @mock.patch("takeoff.azure.publish_artifact.get_tag", return_value="a tag")
+    def test_publish_to_pypi_with_signature(self, m1, m2):
+        conf = {**takeoff_config(), **BASE_CONF, "language": "python", "target": ["pypi"]}
+        env = ApplicationVersion("prd", "1.0.0", "branch")
+        with pypi_stand_in() as (settings, dists):
+            with open(f"{dists[1]}.asc", "w") as f:
+                f.write("signature")
+            with mock.patch(STORE_SETTINGS, return_value=settings), \
+                    mock.patch.object(victim, "_get_distributions", return_value=dists), \
+                    mock.patch("takeoff.azure.publish_artifact.upload") as m:
+                victim(env, conf).publish_to_pypi()
+        m.assert_called_once_with(settings, [dists[1], f"{dists[1]}.asc"])
+
+    @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "my-app"})
+    @mock.patch("takeoff.azure.publish_artifact.get_tag", return_value="a tag")
+    def test_publish_to_pypi_index_not_found(self, m1, m2):
+        env = ApplicationVersion("prd", "1.0.0", "branch")
+        with pypi_stand_in() as (settings, dists):
+            conf = {
+                **takeoff_config(),
+                **BASE_CONF,
+                "language": "python",
+                "target": ["pypi"],
+                "pypi_index_url": f"{settings.repository_config['repository']}/other-index/",
+            }
+            with mock.patch(STORE_SETTINGS, return_value=settings), \
+                    mock.patch.object(victim, "_get_distributions", return_value=dists), \
+                    mock.patch("takeoff.azure.publish_artifact.upload") as m:
+                with pytest.raises(ValueError):
+                    victim(env, conf).publish_to_pypi()
+        m.assert_not_called()
+
+    @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch.dict(os.environ, {"CI_PROJECT_NAME": "my-app"})
+    def test_get_index_url_pypi(self, _):
+        conf = {**takeoff_config(), **BASE_CONF, "language": "python", "target": ["pypi"]}
+        settings = Settings(
+            repository_url="https://upload.pypi.org/legacy/", username="user", password="pass"
+        )
+        with mock.patch("takeoff.azure.publish_artifact.requests.head") as m_head:
+            m_head.return_value.status_code = 200
+            index_url = victim(FAKE_ENV, conf)._get_index_url(settings)
+        assert index_url == "https://pypi.org/simple"
 
     @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
     @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
@@ -212,3 +380,112 @@ class TestPublishArtifact(unittest.TestCase):
         with mock.patch("takeoff.azure.publish_artifact.run_shell_command", return_value=(0, ['output_lines'])) as m:
             victim(env, conf).publish_to_ivy()
         m.assert_called_once_with(["sbt", 'set version := "1.0.0"', "publish"])
+
+    @mock.patch("takeoff.step.KeyVaultClient.vault_and_client", return_value=(None, None))
+    def test_validate_schema_dbfs_requires_path(self, _):
+        conf = {**takeoff_config(), **BASE_CONF, "target": ["dbfs"]}
+        with pytest.raises(vol.Invalid):
+            victim(ApplicationVersion("dev", "v", "branch"), conf)
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    @mock.patch.object(victim, "_get_jar", return_value="some.jar")
+    def test_publish_jar_to_dbfs(self, m1, m2, m3):
+        conf = {**takeoff_config(), **BASE_CONF, "language": "scala", "target": ["dbfs"],
+                "dbfs_path": "dbfs:/libraries/"}
+
+        with mock.patch("takeoff.azure.publish_artifact.Databricks"), \
+                mock.patch("takeoff.azure.publish_artifact.DbfsService") as m_dbfs, \
+                mock.patch.object(victim, "_upload_file_to_dbfs") as m_upload:
+            victim(FAKE_ENV, conf).publish_jvm_package()
+
+        m_upload.assert_called_once_with(
+            m_dbfs.return_value, "some.jar", "dbfs:/libraries/my_app/my_app-v.jar"
+        )
+
+    @mock.patch("takeoff.azure.publish_artifact.DBFS_BLOCK_SIZE", 4)
+    def test_encoded_blocks(self):
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"0123456789abcdefghijklmnopqrstuvwxyz")
+            f.flush()
+            blocks = list(victim._encoded_blocks(f.name))
+
+        assert len(blocks) == 9
+        assert b"".join(base64.b64decode(_) for _ in blocks) == b"0123456789abcdefghijklmnopqrstuvwxyz"
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    @mock.patch("takeoff.azure.publish_artifact.DBFS_BLOCK_SIZE", 4)
+    def test_upload_file_to_dbfs(self, m1, m2):
+        conf = {**takeoff_config(), **BASE_CONF, "target": ["dbfs"], "dbfs_path": "dbfs:/libraries"}
+        not_found = requests.exceptions.HTTPError(response=mock.Mock(status_code=404))
+        m_dbfs = mock.Mock()
+        m_dbfs.get_status.side_effect = not_found
+        m_dbfs.create.return_value = {"handle": 1}
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+            victim(FAKE_ENV, conf)._upload_file_to_dbfs(m_dbfs, f.name, "dbfs:/libraries/some.whl")
+
+        m_dbfs.create.assert_called_once_with("dbfs:/libraries/some.whl", overwrite=True)
+        m_dbfs.add_block.assert_has_calls(
+            [mock.call(1, "MDEyMw=="), mock.call(1, "NDU2Nw=="), mock.call(1, "ODk=")]
+        )
+        m_dbfs.close.assert_called_once_with(1)
+        digest = hashlib.sha256(b"0123456789").hexdigest()
+        encoded_digest = base64.b64encode(digest.encode()).decode()
+        m_dbfs.put.assert_called_once_with(
+            "dbfs:/libraries/some.whl.sha256", contents=encoded_digest, overwrite=True
+        )
+
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    @mock.patch("takeoff.azure.publish_artifact.DBFS_BLOCK_SIZE", 4)
+    def test_upload_file_to_dbfs_failure(self, m1, m2):
+        conf = {**takeoff_config(), **BASE_CONF, "target": ["dbfs"], "dbfs_path": "dbfs:/libraries"}
+        m_dbfs = mock.Mock()
+        m_dbfs.get_status.side_effect = requests.exceptions.HTTPError(response=mock.Mock(status_code=404))
+        m_dbfs.create.return_value = {"handle": 1}
+        m_dbfs.add_block.side_effect = [None, requests.exceptions.ConnectionError()]
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+            with pytest.raises(requests.exceptions.ConnectionError):
+                victim(FAKE_ENV, conf)._upload_file_to_dbfs(m_dbfs, f.name, "dbfs:/libraries/some.whl")
+
+        m_dbfs.close.assert_called_once_with(1)
+        m_dbfs.delete.assert_called_once_with("dbfs:/libraries/some.whl")
+        m_dbfs.put.assert_not_called()
+
+    # smaller than the file, so the file is hashed in several blocks
+    @mock.patch("takeoff.azure.publish_artifact.DBFS_BLOCK_SIZE", 3)
+    @mock.patch("takeoff.azure.publish_artifact.KeyVaultClient.vault_and_client", return_value=(None, None))
+    @mock.patch("takeoff.step.ApplicationName.get", return_value="my_app")
+    def test_upload_file_to_dbfs_unchanged(self, m1, m2):
+        conf = {**takeoff_config(), **BASE_CONF, "target": ["dbfs"], "dbfs_path": "dbfs:/libraries"}
+        digest = hashlib.sha256(b"0123456789").hexdigest()
+        m_dbfs = mock.Mock()
+        m_dbfs.get_status.return_value = {"file_size": 10}
+        m_dbfs.read.return_value = {"data": base64.b64encode(digest.encode()).decode()}
+
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(b"0123456789")
+            f.flush()
+            victim(FAKE_ENV, conf)._upload_file_to_dbfs(m_dbfs, f.name, "dbfs:/libraries/some.whl")
+
+        m_dbfs.read.assert_called_once_with("dbfs:/libraries/some.whl.sha256")
+        m_dbfs.create.assert_not_called()
+        m_dbfs.put.assert_not_called()
+
+
+@pytest.mark.parametrize("dist, name", [
+    ("dist/my_app-1.0.0-py3-none-any.whl", "my-app"),
+    ("dist/My.App-1.0.0-py3-none-any.whl", "my-app"),
+    ("dist/my_app-1.0.0.tar.gz", "my-app"),
+    ("dist/my-pkg-1.0.tar.gz", "my-pkg"),
+    ("dist/my-pkg-1.0.0rc1.zip", "my-pkg"),
+])
+def test_project_name(dist, name):
+    assert _project_name(dist) == name
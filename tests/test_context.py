@@ -1,6 +1,8 @@
+import logging
+
 import pytest
 
-from takeoff.context import Context
+from takeoff.context import Context, RunSummary
 
 
 @pytest.fixture(scope='module', autouse=True)
@@ -46,3 +48,15 @@ def test_get_or_else():
     Context().create_or_update("Alice", "Cooper")
     assert Context().get_or_else("Not exists", {}) == {}
     assert Context().get_or_else("Alice", {}) == "Cooper"
+
+
+def test_run_summary(caplog):
+    counter = {"requests": 1}
+    RunSummary().clear().register("Requests", lambda: counter)
+    counter["requests"] = 2
+
+    with caplog.at_level(logging.INFO):
+        RunSummary().log()
+
+    assert "Requests: requests: 2" in caplog.messages
+    RunSummary().clear()
@@ -1,5 +1,9 @@
+import logging
 import os
 import re
+import threading
+import traceback
+from unittest import mock
 
 import pytest
 
@@ -74,3 +78,140 @@ def test_ensure_base64_non_encoded():
 def test_ensure_base64_encoded():
     result = victim.ensure_base64("c29tZXRoaW5n")
     assert result == "c29tZXRoaW5n"
+
+
+def test_run_concurrently_keeps_order():
+    results = victim.run_concurrently({"a": lambda: 1, "b": lambda: 2, "c": lambda: 3}, max_workers=2)
+    assert [(_.name, _.result) for _ in results] == [("a", 1), ("b", 2), ("c", 3)]
+
+
+def test_run_concurrently_isolates_failures():
+    done = []
+
+    def fail():
+        raise ValueError("boom")
+
+    with pytest.raises(victim.ConcurrentTaskError) as e:
+        victim.run_concurrently({"fail": fail, "succeed": lambda: done.append("succeed")})
+
+    assert done == ["succeed"]
+    assert [_.name for _ in e.value.failures] == ["fail"]
+    assert isinstance(e.value.failures[0].exception, ValueError)
+
+
+def test_run_concurrently_no_tasks():
+    assert victim.run_concurrently({}) == []
+
+
+def test_run_concurrently_buffers_logs():
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    task_logger = logging.getLogger("test_run_concurrently")
+    task_logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    logging.getLogger().addHandler(handler)
+    a_started, b_logged = threading.Event(), threading.Event()
+
+    def a():
+        task_logger.info("a1")
+        a_started.set()
+        b_logged.wait(timeout=5)
+        task_logger.info("a2")
+
+    def b():
+        a_started.wait(timeout=5)
+        task_logger.info("b1")
+        task_logger.info("b2")
+        b_logged.set()
+
+    try:
+        victim.run_concurrently({"a": a, "b": b}, buffer_logs=True)
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+    messages = [_ for _ in handler.messages if _ in {"a1", "a2", "b1", "b2"}]
+    assert messages == ["b1", "b2", "a1", "a2"]
+
+
+def test_run_concurrently_prefix_logs():
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.messages = []
+
+        def emit(self, record):
+            self.messages.append(record.getMessage())
+
+    task_logger = logging.getLogger("test_run_concurrently")
+    task_logger.setLevel(logging.INFO)
+    handler = ListHandler()
+    logging.getLogger().addHandler(handler)
+
+    def a():
+        task_logger.info("a%s", 1)
+        victim.run_concurrently({"nested": lambda: task_logger.info("nested1")})
+
+    try:
+        victim.run_concurrently({"a": a, "b": lambda: task_logger.info("b1")}, prefix_logs=True)
+        task_logger.info("after")
+    finally:
+        logging.getLogger().removeHandler(handler)
+
+    assert {"[a] a1", "[a] nested1", "[b] b1", "after"} <= set(handler.messages)
+    assert handler not in logging.getLogger().handlers
+    assert not handler.filters
+
+
+def test_render_string_with_jinja(tmp_path):
+    template = tmp_path / "template.j2"
+    template.write_text("{{ name | b64_encode }} {{ env.HOME_DIR }}{% for _ in range(2) %}!{% endfor %}")
+
+    rendered = victim.render_string_with_jinja(str(template), {"name": "foo", "env": {"HOME_DIR": "/home"}})
+    assert rendered == "Zm9v /home!!"
+
+
+def test_render_string_with_jinja_compiles_once(tmp_path):
+    template = tmp_path / "template.j2"
+    template.write_text("{{ value }}")
+
+    with mock.patch.object(victim.TemplateEngine().environment, "compile",
+                           wraps=victim.TemplateEngine().environment.compile) as m_compile:
+        assert victim.render_string_with_jinja(str(template), {"value": 1}) == "1"
+        assert victim.render_string_with_jinja(str(template), {"value": 2}) == "2"
+
+    m_compile.assert_called_once()
+
+
+def test_render_string_with_jinja_lazy_values(tmp_path):
+    template = tmp_path / "template.j2"
+    template.write_text("{{ used }}")
+    unused = mock.Mock()
+
+    rendered = victim.render_string_with_jinja(
+        str(template), {"used": victim.Lazy(lambda: "computed"), "unused": victim.Lazy(unused)}
+    )
+    assert rendered == "computed"
+    unused.assert_not_called()
+
+
+def test_render_string_with_jinja_error_points_at_template(tmp_path):
+    template = tmp_path / "template.j2"
+    template.write_text("first line\n{{ 1 / value }}")
+
+    with pytest.raises(ZeroDivisionError) as e:
+        victim.render_string_with_jinja(str(template), {"value": 0})
+    assert (str(template), 2) in [(_.filename, _.lineno) for _ in traceback.extract_tb(e.value.__traceback__)]
+
+
+def test_lazy_computes_once():
+    provider = mock.Mock(return_value="value")
+    lazy = victim.Lazy(provider)
+
+    assert lazy.get() == lazy.get() == "value"
+    provider.assert_called_once()